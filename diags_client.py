@@ -0,0 +1,38 @@
+#! /usr/bin/env python
+"""
+Submit a job to diags_server.py; takes the same arguments as driver.py (plus --socket)
+"""
+
+import sys
+from marbl_diags import driver_tools, server
+
+#######################################
+
+def _parse_args():
+    """ Parse command line arguments (validated here so errors are reported before connecting)
+    """
+
+    parser = driver_tools.get_parser()
+    parser.add_argument('-s', '--socket', action='store', dest='socket', default=server.DEFAULT_SOCKET,
+                        help='Unix socket diags_server.py is listening on')
+    args = parser.parse_args()
+
+    # Forward everything except --socket to the server
+    argv = ['-i', args.input_file]
+    if args.debug:
+        argv.append('-d')
+    if args.build_manifests:
+        argv.append('--build-manifests')
+    if args.build_cache:
+        argv += ['--build-cache', '--nprocs', str(args.nprocs)]
+    if args.resume:
+        argv.append('--resume')
+    if args.journal is not None:
+        argv += ['--journal', args.journal]
+    return args.socket, argv
+
+#######################################
+
+if __name__ == "__main__":
+    socket_path, argv = _parse_args()
+    sys.exit(0 if server.submit_job(argv, socket_path) else 1)
@@ -0,0 +1,43 @@
+#! /usr/bin/env python
+""" Start a diagnostics server that keeps data sources warm between driver.py-style jobs """
+
+import argparse
+import logging
+from marbl_diags import server
+
+#######################################
+
+def _parse_args():
+    """ Parse command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Run MARBL diagnostics jobs submitted with diags_client.py",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-s', '--socket', action='store', dest='socket', default=server.DEFAULT_SOCKET,
+                        help='Unix socket to listen on')
+    parser.add_argument('--max-data-sources', action='store', dest='max_data_sources', type=int, default=8,
+                        help='Number of opened data sources to keep in memory')
+    parser.add_argument('--max-data-sources-mb', action='store', dest='max_data_sources_mb', type=float,
+                        default=8192, help='Memory (MB) for data sources kept between jobs (estimated from '
+                                           'the variables they hold in memory)')
+    parser.add_argument('--max-reduced-fields-mb', action='store', dest='max_reduced_fields_mb', type=float,
+                        default=4096, help='Memory (MB) for reduced fields kept between jobs')
+
+    return parser.parse_args()
+
+#######################################
+
+if __name__ == "__main__":
+    args = _parse_args()
+    logging.basicConfig(format='%(levelname)s (%(funcName)s): %(message)s', level=logging.INFO)
+
+    diags_server = server.DiagnosticsServer(args.socket, args.max_data_sources, args.max_reduced_fields_mb,
+                                            args.max_data_sources_mb)
+    logging.info('Listening on %s', args.socket)
+    try:
+        diags_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        diags_server.server_close()
@@ -4,28 +4,47 @@ on data_sources of data."""
 
 import logging
 import os
+import json
 from . import data_source_classes
 from . import analysis_ops
+from . import field_store
+from .figure_writer import FigureWriter
 from .generic_classes import GenericAnalysisElement
 
 ######################################################################
 
 class AnalysisCategory(object):
 
-    def __init__(self, category_name, analysis_dicts, ds_dict, var_dict, global_config):
-        """ Set up many AnalysisElement objects for the same type of plots """
+    def __init__(self, category_name, analysis_dicts, ds_dict, var_dict, global_config, resident_cache=None,
+                 open_datasets=True, journal=None):
+        """
+        Set up many AnalysisElement objects for the same type of plots
+        (resident_cache is a server.ResidentCache when running inside the diagnostics server;
+         open_datasets = False => only set up elements, e.g. to build caches with cache_data_source();
+         journal is a run_journal.RunJournal, elements it lists as finished are not opened or analyzed)
+        """
 
         # (1) Define logger on type, save category name, and save ds_dict
         self.logger = logging.getLogger(category_name)
         self.logger.info("Initializing %s category...", category_name)
         self.category_name = category_name
         self._ds_dict = ds_dict
+        self._resident_cache = resident_cache
+        self._journal = journal
 
         # (2) Define operations based on category
         if category_name == "3d_ann_climo_maps_on_levels":
             self.operation = 'plot_ann_climo'
+        elif category_name == "3d_mon_climo_maps_on_levels":
+            self.operation = 'plot_mon_climo'
         elif category_name == "plot_regional_time_series":
-            pass
+            self.operation = 'plot_regional_time_series'
+        elif category_name == "zonal_mean_ann_climo_sections":
+            self.operation = 'plot_ann_climo_zonal_mean_sections'
+        elif category_name == "ensemble_summary_maps_on_levels":
+            self.operation = 'plot_ensemble_mon_climo_summary'
+        elif category_name == "climo_skill_metrics":
+            self.operation = 'compute_mon_climo_skill_metrics'
         else:
             raise ValueError("'{}' is not a valid analysis category".format(category_name))
         # (2) Store analysis category configuration in self.category_settings
@@ -35,6 +54,32 @@ class AnalysisCategory(object):
         category_settings_defaults['cache_data'] = False
         category_settings_defaults['plot_format'] = 'png'
         category_settings_defaults['keep_figs'] = False
+        # per-format output settings (e.g. {'png': {'dpi': 150, 'compress_level': 1}}; see
+        # figure_writer.DEFAULT_FORMAT_OPTIONS), and threads that encode / write figures
+        # (0 => write each figure before starting the next one)
+        category_settings_defaults['plot_format_options'] = None
+        category_settings_defaults['figure_writer_threads'] = 2
+        # layout of cached data (only used if cache_data is True)
+        category_settings_defaults['cache_compressor'] = {'cname': 'zstd', 'clevel': 3, 'shuffle': 'bitshuffle'}
+        category_settings_defaults['cache_float32'] = False
+        # directory for persistent catalogs of input files (None => glob for files on every run)
+        category_settings_defaults['file_catalog_dir'] = None
+        # directory for reference manifests of multi-file datasets (None => open_mfdataset)
+        # build_manifests = True => write manifests that do not exist yet (driver.py --build-manifests)
+        category_settings_defaults['manifest_dir'] = None
+        category_settings_defaults['build_manifests'] = False
+        # largest block of a field (MB) read into memory at once when reducing it to plotted levels
+        category_settings_defaults['max_block_mb'] = 512
+        # True => maps at a single depth are linearly interpolated between the two nearest levels
+        #         (False => nearest level), so sources with different vertical grids are compared
+        #         at the same depth
+        category_settings_defaults['vertical_interp'] = False
+        # True => quick look: maps show fields averaged (area-weighted) over blocks of
+        #         preview_coarsen_factor x preview_coarsen_factor cells, and every plot is written
+        #         at preview_dpi to {dirout}/preview with a PREVIEW label
+        category_settings_defaults['preview'] = False
+        category_settings_defaults['preview_coarsen_factor'] = 4
+        category_settings_defaults['preview_dpi'] = 72
         #         (some settings may be category-specific)
         if category_name == "3d_ann_climo_maps_on_levels":
             # Set up dictionary of default values to use for this category
@@ -46,6 +91,68 @@ class AnalysisCategory(object):
             category_settings_defaults['stats_in_title'] = True
             category_settings_defaults['grid'] = None
             category_settings_defaults['climo_time_periods'] = ['ANN']
+        elif category_name == "3d_mon_climo_maps_on_levels":
+            category_settings_defaults['variables'] = ['nitrate', 'phosphate', 'silicate', 'oxygen',
+                                                     'dic', 'alkalinity', 'iron']
+            category_settings_defaults['levels'] = [depth for depth in range(0, 4001, 500)]
+            category_settings_defaults['reference'] = None
+            category_settings_defaults['plot_diff_from_reference'] = False
+            category_settings_defaults['stats_in_title'] = True
+            category_settings_defaults['grid'] = None
+            # any time period in analysis_ops.CLIMO_TIME_PERIODS
+            category_settings_defaults['climo_time_periods'] = ['ANN', 'DJF', 'MAM', 'JJA', 'SON']
+        elif category_name == "plot_regional_time_series":
+            category_settings_defaults['variables'] = ['nitrate', 'phosphate', 'silicate', 'oxygen',
+                                                     'dic', 'alkalinity', 'iron']
+            category_settings_defaults['levels'] = [0]
+            category_settings_defaults['grid'] = None
+            # regions are names from grid_tools.POP_REGIONS (None => all regions)
+            category_settings_defaults['regions'] = None
+            # number of time levels read into memory for each regional reduction
+            category_settings_defaults['time_chunk_size'] = 120
+        elif category_name == "zonal_mean_ann_climo_sections":
+            category_settings_defaults['variables'] = ['nitrate', 'phosphate', 'silicate', 'oxygen',
+                                                     'dic', 'alkalinity', 'iron']
+            category_settings_defaults['reference'] = None
+            category_settings_defaults['plot_diff_from_reference'] = False
+            category_settings_defaults['grid'] = None
+            category_settings_defaults['climo_time_periods'] = ['ANN']
+            # basins are names from grid_tools.POP_BASINS (None => all basins)
+            category_settings_defaults['basins'] = None
+            category_settings_defaults['lat_bin_width'] = 1.0
+        elif category_name == "ensemble_summary_maps_on_levels":
+            category_settings_defaults['variables'] = ['nitrate', 'phosphate', 'silicate', 'oxygen',
+                                                     'dic', 'alkalinity', 'iron']
+            category_settings_defaults['levels'] = [depth for depth in range(0, 4001, 500)]
+            category_settings_defaults['reference'] = None
+            category_settings_defaults['stats_in_title'] = True
+            category_settings_defaults['grid'] = None
+            category_settings_defaults['climo_time_periods'] = ['ANN']
+            # {data_source: [case, ...]} => every case (with every datestr) of data_source is a member
+            # (None => members are the datestrs of each data source)
+            category_settings_defaults['ensemble_cases'] = None
+            # number of members to read ahead while accumulating statistics, and memory limit for them
+            category_settings_defaults['prefetch_depth'] = 1
+            category_settings_defaults['prefetch_max_mb'] = 2048
+        elif category_name == "climo_skill_metrics":
+            category_settings_defaults['variables'] = ['nitrate', 'phosphate', 'silicate', 'oxygen',
+                                                     'dic', 'alkalinity', 'iron']
+            category_settings_defaults['levels'] = [depth for depth in range(0, 4001, 500)]
+            # metrics are computed against reference (required)
+            category_settings_defaults['reference'] = None
+            category_settings_defaults['grid'] = None
+            category_settings_defaults['climo_time_periods'] = ['ANN', 'DJF', 'MAM', 'JJA', 'SON']
+            # 'csv' or 'parquet' (parquet requires pyarrow)
+            category_settings_defaults['metrics_format'] = 'csv'
+            category_settings_defaults['prefetch_depth'] = 1
+            category_settings_defaults['prefetch_max_mb'] = 2048
+        #         (settings shared by all categories that plot maps of climatologies)
+        if category_name in ["3d_ann_climo_maps_on_levels", "3d_mon_climo_maps_on_levels"]:
+            # number of variables to read ahead while plotting, and memory limit for data read ahead
+            category_settings_defaults['prefetch_depth'] = 1
+            category_settings_defaults['prefetch_max_mb'] = 2048
+            # keep the 2D fields that are plotted in a memory-mapped store in cache_dir
+            category_settings_defaults['cache_reduced_fields'] = False
 
         #     (b) To start, category_settings = analysis_dicts['_settings'] (if it exists)
         if '_settings' in analysis_dicts:
@@ -69,17 +176,25 @@ class AnalysisCategory(object):
         # (3) Make sure no extraneous keys were included
         #     (a) Only allowable keys are ones in category_settings_defaults
         #         (with exception that cache_dir is REQUIRED if cache_data is True)
-        expected_keys = category_settings_defaults.keys()
-        if self.category_settings['cache_data']:
-            if 'cache_dir' not in self.category_settings:
-                raise KeyError("Must provide 'cache_dir' if setting 'cache_data' to True")
-            expected_keys.append('cache_dir')
+        #         (same for cache_reduced_fields)
+        expected_keys = list(category_settings_defaults.keys())
+        for cache_key in ['cache_data', 'cache_reduced_fields']:
+            if self.category_settings.get(cache_key, False):
+                if 'cache_dir' not in self.category_settings:
+                    raise KeyError("Must provide 'cache_dir' if setting '{}' to True".format(cache_key))
+                if 'cache_dir' not in expected_keys:
+                    expected_keys.append('cache_dir')
 
         #     (b) Abort if any category_settings keys are not in expected_keys
         for settings_key in self.category_settings:
             if settings_key not in expected_keys:
                 raise KeyError("Unrecognized setting: '{}'".format(settings_key))
 
+        #     (c) Previews are written to their own directory, so they never replace full plots
+        if self.category_settings['preview'] and self.category_settings['dirout']:
+            self.category_settings = dict(self.category_settings,
+                                          dirout=os.path.join(self.category_settings['dirout'], 'preview'))
+
         # (4) Create analysis elements
         self.AnalysisElements = dict()
         for element_key, analysis_dict in analysis_dicts.items():
@@ -89,26 +204,92 @@ class AnalysisCategory(object):
             self.AnalysisElements[element_key] = AnalysisElement(element_key, analysis_dict,
                                                                  var_dict,
                                                                  config=self.category_settings)
-            self._open_datasets(element_key)
+            self._init_element(self.AnalysisElements[element_key])
+            if self._element_is_done(element_key):
+                self.logger.info('Skipping %s: finished in a previous run', element_key)
+            elif open_datasets:
+                self._open_datasets(element_key)
 
     ###################
     # PUBLIC ROUTINES #
     ###################
 
     def do_analysis(self):
-        """ Perform requested analysis operations on each dataset """
-        for AnalysisElement in self.AnalysisElements.values():
+        """
+        Perform requested analysis operations on each dataset; returns list of plots that failed
+        (a failing plot is logged and skipped so the remaining plots are still produced)
+        """
+        failed_plots = []
+        for element_key, AnalysisElement in self.AnalysisElements.items():
+            if self._element_is_done(element_key):
+                continue
             self.logger.info('Calling %s for %s', self.operation, AnalysisElement.analysis_sname)
             func = getattr(analysis_ops, self.operation)
-            func(AnalysisElement)
+            if AnalysisElement._global_config['figure_writer_threads'] > 0:
+                AnalysisElement.figure_writer = FigureWriter(AnalysisElement._global_config['figure_writer_threads'])
+            try:
+                func(AnalysisElement)
+            finally:
+                # every figure of the element is on disk (or reported as failed) before moving on
+                if AnalysisElement.figure_writer is not None:
+                    AnalysisElement.failed_plots += AnalysisElement.figure_writer.close()
+                    AnalysisElement.figure_writer = None
+            if AnalysisElement.failed_plots:
+                failed_plots += AnalysisElement.failed_plots
+            elif self._journal is not None:
+                self._journal.mark_done('element', '{}/{}'.format(self.category_name, element_key))
+        return failed_plots
+
+    def get_uncached_data_sources(self):
+        """
+        Return list of (element_key, data_source_label, ds_kwargs, datestr) for every data source
+        whose climatology is not in cache_dir yet (each cache appears once, even if it is used by
+        several elements); empty unless cache_data is True and the operation uses climatologies
+        """
+        if not (self.category_settings['cache_data'] and 'climo' in self.operation):
+            return []
+        uncached = []
+        cached_locations = set()
+        for element_key, AnalysisElement in self.AnalysisElements.items():
+            if self.operation == 'plot_ensemble_mon_climo_summary':
+                self._set_ensemble_members(AnalysisElement)
+                data_source_kwargs = AnalysisElement.ensemble_members
+            else:
+                data_source_kwargs = dict()
+                for data_source in AnalysisElement.datestrs:
+                    for datestr in AnalysisElement.datestrs[data_source]:
+                        data_source_kwargs[data_source + '.' + datestr] = (self._ds_dict[data_source], datestr)
+            for data_source_label, (ds_kwargs, datestr) in data_source_kwargs.items():
+                cached_location = self._set_cache_locations(AnalysisElement, data_source_label)
+                if cached_location in cached_locations or os.path.exists(cached_location):
+                    continue
+                cached_locations.add(cached_location)
+                uncached.append((element_key, data_source_label, ds_kwargs, datestr))
+        return uncached
+
+    def cache_data_source(self, element_key, data_source_label, ds_kwargs, datestr):
+        """
+        Compute climatology of one data source (see get_uncached_data_sources) and write it to
+        cache_dir; unlike caching during analysis, sources that are already climatologies are
+        also written (the cache layout is faster to read than the original files)
+        """
+        AnalysisElement = self.AnalysisElements[element_key]
+        data_source = self._open_data_source(AnalysisElement, ds_kwargs, datestr, data_source_label)
+        if isinstance(data_source, data_source_classes.CachedClimoData):
+            return
+        self.logger.info('Computing climatology of %s', data_source_label)
+        data_source.compute_mon_climatology()
+        data_source.cache_dataset(AnalysisElement._cached_locations[data_source_label],
+                                  AnalysisElement._cached_var_dicts[data_source_label],
+                                  compressor=AnalysisElement._global_config['cache_compressor'],
+                                  float32=AnalysisElement._global_config['cache_float32'])
 
     ####################
     # PRIVATE ROUTINES #
     ####################
 
-    def _open_datasets(self, element_key):
-        """ Open datasets requested by AnalysisElement[element_key] """
-        AnalysisElement = self.AnalysisElements[element_key]
+    def _init_element(self, AnalysisElement):
+        """ Settings that do not require opening data sources """
         # Determine if operator acts on climatology
         AnalysisElement.climo = None
         if 'climo' in self.operation:
@@ -118,12 +299,51 @@ class AnalysisCategory(object):
                 AnalysisElement.climo = 'mon_climo'
             else:
                 raise ValueError("'{}' is not a valid operation".format(self.operation))
+        AnalysisElement.data_sources = dict()
+        AnalysisElement._cached_locations = dict()
+        AnalysisElement._cached_var_dicts = dict()
+        AnalysisElement.journal = self._journal
+        AnalysisElement.failed_plots = []
+        AnalysisElement.figure_writer = None
+
+    def _element_is_done(self, element_key):
+        """ True if the journal records that every output of this element was written """
+        if self._journal is None:
+            return False
+        return self._journal.is_done('element', '{}/{}'.format(self.category_name, element_key))
+
+    def _open_datasets(self, element_key):
+        """ Open datasets requested by AnalysisElement[element_key] """
+        AnalysisElement = self.AnalysisElements[element_key]
 
         # AnalysisElement.datestrs details what years of data to read from each source
         # E.g. {JRA: 0033-0052} => will be working with years 33 - 52 of CESM run using JRA forcing
         # Data will be stored in AnalysisElement.data_sources['JRA.0033-0052']
         # (AnalysisElement.data_sources is a new dictionary, can be thought of as intent(out))
         AnalysisElement.data_sources = dict()
+        AnalysisElement.data_source_labels = [data_source + '.' + datestr
+                                              for data_source in AnalysisElement.datestrs
+                                              for datestr in AnalysisElement.datestrs[data_source]]
+        AnalysisElement.resident_cache = self._resident_cache
+        AnalysisElement._resident_data_sources = set()
+        AnalysisElement.field_store = None
+
+        # Ensemble members are opened one at a time by the analysis operation
+        if self.operation == 'plot_ensemble_mon_climo_summary':
+            self._set_ensemble_members(AnalysisElement)
+            return
+
+        # If every field that will be plotted is in the reduced field store, do not open data sources
+        if AnalysisElement._global_config.get('cache_reduced_fields', False):
+            # fields interpolated to exact depths are stored separately from nearest-level fields
+            AnalysisElement.field_store = field_store.ReducedFieldStore('{}/{}{}.reduced_fields'.format(
+                AnalysisElement._global_config['cache_dir'], self.category_name,
+                '.vertical_interp' if AnalysisElement._global_config['vertical_interp'] else ''))
+            if analysis_ops.fields_in_store(AnalysisElement):
+                self.logger.info("All fields for %s found in %s, not opening data sources",
+                                 element_key, AnalysisElement.field_store.store_dir)
+                return
+
         for data_source in AnalysisElement.datestrs:
             self.logger.info("Creating data object for %s in %s", data_source, element_key)
 
@@ -133,53 +353,128 @@ class AnalysisCategory(object):
 
             # (2) Read data from source
             for datestr, data_source_label in data_sources.items():
-                # Is dataset already cached?
-                still_unread = True
-                if AnalysisElement._global_config['cache_data']:
-                    AnalysisElement._cached_locations = dict()
-                    AnalysisElement._cached_var_dicts = dict()
-                    if AnalysisElement.climo:
-                        climo_str = AnalysisElement.climo
-                    else:
-                        climo_str = 'no_climo'
-                    AnalysisElement._cached_locations[data_source_label] = "{}/{}.{}.{}.{}".format(
-                        AnalysisElement._global_config['cache_dir'],
-                        self.category_name,
-                        datestr,
-                        climo_str,
-                        'zarr')
-                    AnalysisElement._cached_var_dicts[data_source_label] = "{}/{}.{}.{}.json".format(
-                        AnalysisElement._global_config['cache_dir'],
-                        self.category_name,
-                        datestr,
-                        climo_str)
-                    if os.path.exists(AnalysisElement._cached_locations[data_source_label]):
-                        AnalysisElement.logger.debug('Reading %s', AnalysisElement._cached_locations[data_source_label])
-                        AnalysisElement.data_sources[data_source_label] = data_source_classes.CachedClimoData(
-                            data_root=AnalysisElement._cached_locations[data_source_label],
-                            var_dict_in=AnalysisElement._cached_var_dicts[data_source_label],
-                            data_type='zarr',
-                            **self._ds_dict[data_source])
-                        still_unread = False
-                if still_unread:
-                    self.logger.debug('Reading %s output', self._ds_dict[data_source]['source'])
-                    if self._ds_dict[data_source]['source'] == 'cesm':
-                        AnalysisElement.data_sources[data_source_label] = data_source_classes.CESMData(
-                            AnalysisElement._global_config['variables'],
-                            AnalysisElement.climo,
-                            datestr, **self._ds_dict[data_source])
-                    elif self._ds_dict[data_source]['source'] in ['woa2005', 'woa2013']:
-                        AnalysisElement.data_sources[data_source_label] = data_source_classes.WOAData(
-                            var_dict=AnalysisElement._var_dict,
-                            **self._ds_dict[data_source])
-                    else:
-                        raise ValueError("Unknown source '%s'" %
-                                         self._ds_dict[data_source]['source'])
+                # Is dataset already open in the diagnostics server?
+                if self._resident_cache is not None:
+                    resident_key = self._get_resident_key(AnalysisElement, self._ds_dict[data_source], datestr)
+                    resident_data_source = self._resident_cache.get_data_source(resident_key)
+                    if resident_data_source is not None:
+                        self.logger.info("Using resident data source for %s", data_source_label)
+                        AnalysisElement.data_sources[data_source_label] = resident_data_source
+                        AnalysisElement._resident_data_sources.add(data_source_label)
+                        continue
+                AnalysisElement.data_sources[data_source_label] = self._open_data_source(
+                    AnalysisElement, self._ds_dict[data_source], datestr, data_source_label)
                 self.logger.debug('ds = %s', AnalysisElement.data_sources[data_source_label].ds)
 
         # Call any necessary operations on datasets
         AnalysisElement._operate_on_datasets(self.operation)
 
+        # Keep newly opened data sources in the diagnostics server for later jobs
+        if self._resident_cache is not None:
+            for data_source in AnalysisElement.datestrs:
+                for datestr in AnalysisElement.datestrs[data_source]:
+                    data_source_label = data_source + '.' + datestr
+                    if data_source_label not in AnalysisElement._resident_data_sources:
+                        self._resident_cache.put_data_source(
+                            self._get_resident_key(AnalysisElement, self._ds_dict[data_source], datestr),
+                            AnalysisElement.data_sources[data_source_label])
+
+    def _open_data_source(self, AnalysisElement, ds_kwargs, datestr, data_source_label):
+        """
+        Return data source object for datestr of the data source described by ds_kwargs
+        (an entry of ds_dict), read from cache_dir if it has already been cached
+        """
+        if AnalysisElement._global_config['cache_data']:
+            self._set_cache_locations(AnalysisElement, data_source_label)
+            if os.path.exists(AnalysisElement._cached_locations[data_source_label]):
+                AnalysisElement.logger.debug('Reading %s', AnalysisElement._cached_locations[data_source_label])
+                return data_source_classes.CachedClimoData(
+                    data_root=AnalysisElement._cached_locations[data_source_label],
+                    var_dict_in=AnalysisElement._cached_var_dicts[data_source_label],
+                    data_type='zarr',
+                    **ds_kwargs)
+
+        self.logger.debug('Reading %s output', ds_kwargs['source'])
+        if ds_kwargs['source'] == 'cesm':
+            return data_source_classes.CESMData(
+                AnalysisElement._global_config['variables'],
+                AnalysisElement.climo,
+                datestr,
+                catalog_dir=AnalysisElement._global_config['file_catalog_dir'],
+                manifest_dir=AnalysisElement._global_config['manifest_dir'],
+                build_manifests=AnalysisElement._global_config['build_manifests'],
+                **ds_kwargs)
+        if ds_kwargs['source'] in ['woa2005', 'woa2013']:
+            return data_source_classes.WOAData(
+                var_dict=AnalysisElement._var_dict,
+                climo=AnalysisElement.climo,
+                catalog_dir=AnalysisElement._global_config['file_catalog_dir'],
+                **ds_kwargs)
+        raise ValueError("Unknown source '%s'" % ds_kwargs['source'])
+
+    def _set_cache_locations(self, AnalysisElement, data_source_label):
+        """ Set (and return) location of the cached dataset for data_source_label, and of its var_dict """
+        if AnalysisElement.climo:
+            climo_str = AnalysisElement.climo
+        else:
+            climo_str = 'no_climo'
+        AnalysisElement._cached_locations[data_source_label] = "{}/{}.{}.{}.{}".format(
+            AnalysisElement._global_config['cache_dir'],
+            self.category_name,
+            data_source_label,
+            climo_str,
+            'zarr')
+        AnalysisElement._cached_var_dicts[data_source_label] = "{}/{}.{}.{}.json".format(
+            AnalysisElement._global_config['cache_dir'],
+            self.category_name,
+            data_source_label,
+            climo_str)
+        return AnalysisElement._cached_locations[data_source_label]
+
+    def _set_ensemble_members(self, AnalysisElement):
+        """
+        Set AnalysisElement.ensemble_members[data_source_label] = (ds_kwargs, datestr) for every
+        member (and the reference), and AnalysisElement.open_data_source(data_source_label), which
+        opens one of them into AnalysisElement.data_sources (the caller removes it when done)
+        """
+        ensemble_cases = AnalysisElement._global_config['ensemble_cases'] or dict()
+        AnalysisElement.ensemble_members = dict()
+        for data_source in AnalysisElement.datestrs:
+            if data_source not in self._ds_dict:
+                raise KeyError("Can not find data source '{}'".format(data_source))
+            for case in ensemble_cases.get(data_source, [None]):
+                ds_kwargs = dict(self._ds_dict[data_source])
+                prefix = data_source
+                if case is not None:
+                    ds_kwargs['case'] = case
+                    prefix = '{}.{}'.format(data_source, case)
+                for datestr in AnalysisElement.datestrs[data_source]:
+                    AnalysisElement.ensemble_members[prefix + '.' + datestr] = (ds_kwargs, datestr)
+
+        # reference is opened with the case from ds_dict
+        if AnalysisElement._global_config['reference']:
+            for data_source, datestr in AnalysisElement._global_config['reference'].items():
+                AnalysisElement.ensemble_members[data_source + '.' + datestr] = (self._ds_dict[data_source], datestr)
+        AnalysisElement.data_source_labels = list(AnalysisElement.ensemble_members.keys())
+
+        def open_data_source(data_source_label):
+            ds_kwargs, datestr = AnalysisElement.ensemble_members[data_source_label]
+            self.logger.info("Creating data object for %s in %s", data_source_label, AnalysisElement.analysis_sname)
+            AnalysisElement.data_sources[data_source_label] = self._open_data_source(
+                AnalysisElement, ds_kwargs, datestr, data_source_label)
+            AnalysisElement._operate_on_dataset(data_source_label)
+        AnalysisElement.open_data_source = open_data_source
+
+    def _get_resident_key(self, AnalysisElement, ds_kwargs, datestr):
+        """
+        Key for a data source in the diagnostics server: everything that determines what
+        _open_datasets and _operate_on_datasets produce for it
+        """
+        return json.dumps([ds_kwargs, datestr, AnalysisElement.climo,
+                           sorted(AnalysisElement._global_config['variables']),
+                           AnalysisElement._global_config['file_catalog_dir'],
+                           AnalysisElement._global_config['manifest_dir']], sort_keys=True)
+
 ######################################################################
 
 class AnalysisElement(GenericAnalysisElement): # pylint: disable=useless-object-inheritance,too-few-public-methods
@@ -204,16 +499,25 @@ class AnalysisElement(GenericAnalysisElement): # pylint: disable=useless-object-
 
     def _operate_on_datasets(self, operation):
         """ perform requested operations on datasets """
-        if operation in ['plot_mon_climo', 'plot_ann_climo']:
+        for data_source in self.data_sources:
+            self._operate_on_dataset(data_source)
+
+    def _operate_on_dataset(self, data_source):
+        """ perform requested operations on self.data_sources[data_source] """
+        if self.climo:
+            # data sources kept by the diagnostics server are already climatologies
+            if data_source in self._resident_data_sources:
+                return
             op = 'compute_mon_climatology'
-            for data_source in self.data_sources:
-                self.logger.info('Computing %s on %s', op, data_source)
-                func = getattr(self.data_sources[data_source], op)
-                func()
-                self.logger.debug('ds = %s', self.data_sources[data_source].ds)
-
-                # write to cache
-                if self._global_config['cache_data']:
-                    if not (self.data_sources[data_source]._is_mon_climo or self.data_sources[data_source]._is_ann_climo):
-                        self.data_sources[data_source].cache_dataset(self._cached_locations[data_source],
-                                                                   self._cached_var_dicts[data_source])
+            self.logger.info('Computing %s on %s', op, data_source)
+            func = getattr(self.data_sources[data_source], op)
+            func()
+            self.logger.debug('ds = %s', self.data_sources[data_source].ds)
+
+            # write to cache
+            if self._global_config['cache_data']:
+                if self.data_sources[data_source].should_cache():
+                    self.data_sources[data_source].cache_dataset(self._cached_locations[data_source],
+                                                               self._cached_var_dicts[data_source],
+                                                               compressor=self._global_config['cache_compressor'],
+                                                               float32=self._global_config['cache_float32'])
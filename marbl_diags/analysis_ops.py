@@ -2,8 +2,12 @@
 Functions that can be called from analysis elements"""
 
 import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import call
 import numpy as np
+import pandas as pd
+import xarray as xr
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
@@ -12,45 +16,135 @@ import cartopy
 import cartopy.crs as ccrs
 import esmlab
 from . import plottools as pt
+from . import grid_tools as gt
+from . import figure_writer
+from .figure_template import MapFigureTemplate
+from .ensemble_tools import EnsembleStatistics
+from .generic_classes import NOLEAP_DAYS_PER_MONTH
+
+# Months (indices into a 12-month climatology) that make up each climatological time period
+CLIMO_TIME_PERIODS = {'ANN': list(range(0, 12)),
+                      'DJF': [11, 0, 1],
+                      'MAM': [2, 3, 4],
+                      'JJA': [5, 6, 7],
+                      'SON': [8, 9, 10]}
+for _month, _month_name in enumerate(['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+                                      'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']):
+    CLIMO_TIME_PERIODS[_month_name] = [_month]
+
+# Columns of the table written by compute_mon_climo_skill_metrics()
+SKILL_METRICS = ['bias', 'rmse', 'pattern_corr', 'std_ratio']
 
 def plot_ann_climo(AnalysisElement):
     """ Regardless of data source, generate plots based on annual climatology"""
     # set up time dimension for averaging
-    valid_time_dims = dict()
+    time_weights = dict()
     for ds_name in AnalysisElement.data_sources:
         # 1. data source needs time dimension of 1 or 12
         if AnalysisElement.data_sources[ds_name].ds.dims['time'] not in [1, 12]:
             raise ValueError("Dataset '{}' must have time dimension of 1 or 12".format(ds_name))
         # 2. set up averages to reflect proper dimensions
-        valid_time_dims[ds_name] = dict()
-        valid_time_dims[ds_name]['ANN'] = range(0, AnalysisElement.data_sources[ds_name].ds.dims['time'])
-    _plot_climo(AnalysisElement, valid_time_dims)
+        time_weights[ds_name] = _get_time_period_weights(AnalysisElement.data_sources[ds_name], ['ANN'])
+    _plot_climo(AnalysisElement, time_weights)
 
 def plot_mon_climo(AnalysisElement):
     """ Regardless of data source, generate plots based on monthly climatology"""
     # set up time dimension for averaging
-    valid_time_dims = dict()
+    time_weights = dict()
     for ds_name in AnalysisElement.data_sources:
         # 1. data source needs time dimension of 12
         if AnalysisElement.data_sources[ds_name].ds.dims['time'] != 12:
             raise ValueError("Dataset '{}' must have time dimension of 12".format(ds_name))
         # 2. set up averages to reflect proper dimensions
-        valid_time_dims[ds_name] = dict()
-        valid_time_dims[ds_name]['ANN'] = range(0,12)
-        valid_time_dims[ds_name]['DJF'] = [11, 0, 1]
-        valid_time_dims[ds_name]['MAM'] = range(2,5)
-        valid_time_dims[ds_name]['JJA'] = range(5,8)
-        valid_time_dims[ds_name]['SON'] = range(8,11)
-    _plot_climo(AnalysisElement, valid_time_dims)
-
-def _plot_climo(AnalysisElement, valid_time_dims):
-    """ Regardless of data source, generate plots """
-    # look up grid (move to known grids database)
-    if AnalysisElement._global_config['grid'] == 'POP_gx1v7':
-        # and is tracer....
-        depth_coord_name = 'z_t'
-    else:
-        raise ValueError('unknown grid')
+        time_weights[ds_name] = _get_time_period_weights(AnalysisElement.data_sources[ds_name],
+                                                         AnalysisElement._global_config['climo_time_periods'])
+    _plot_climo(AnalysisElement, time_weights)
+
+def plot_regional_time_series(AnalysisElement):
+    """ Regardless of data source, generate plots of area-weighted regional means over time"""
+    depth_coord_name = gt.get_grid_info(AnalysisElement._global_config['grid'])['depth_coord_name']
+
+    # where will plots be written?
+    if not os.path.exists(AnalysisElement._global_config['dirout']):
+        call(['mkdir', '-p', AnalysisElement._global_config['dirout']])
+
+    region_names = gt.get_region_names(AnalysisElement._global_config['regions'])
+    nrow, ncol = pt.get_plot_dims(len(region_names))
+
+    #-- loop over variables
+    for v in AnalysisElement._global_config['variables']:
+        for sel_z in AnalysisElement._global_config['levels']:
+            indexer, is_depth_range, depth_str = _get_depth_indexer(sel_z, depth_coord_name)
+
+            #-- name of the plot
+            plot_name = 'regional-time-series_{}_{}_{}'.format(AnalysisElement.analysis_sname,
+                                                               v,
+                                                               depth_str)
+            if _plot_is_done(AnalysisElement, plot_name):
+                continue
+            AnalysisElement.logger.info('generating plot: %s', plot_name)
+            try:
+                #-- generate figure object
+                AnalysisElement.fig[plot_name] = plt.figure(figsize=(ncol*6,nrow*4))
+                AnalysisElement.axs[plot_name] = np.empty(ncol*nrow, dtype=type(None))
+                AnalysisElement.fig[plot_name].suptitle("{} at {}".format(v, depth_str))
+                for i, region_name in enumerate(region_names):
+                    AnalysisElement.axs[plot_name][i] = AnalysisElement.fig[plot_name].add_subplot(nrow, ncol, i+1)
+                    AnalysisElement.axs[plot_name][i].set_title(region_name)
+                    AnalysisElement.axs[plot_name][i].set_xlabel('Year')
+
+                for ds_name in AnalysisElement.data_sources:
+                    data_source = AnalysisElement.data_sources[ds_name]
+                    ds = data_source.ds
+
+                    # Find appropriate variable name in dataset or move to next dataset
+                    if v not in data_source._var_dict or data_source._var_dict[v] not in ds:
+                        AnalysisElement.logger.info('Can not find %s in %s, skipping', v, ds_name)
+                        continue
+                    var_name = data_source._var_dict[v]
+
+                    field = ds[var_name].sel(**indexer)
+                    if is_depth_range:
+                        field = field.mean(depth_coord_name)
+                    regional_means = _compute_regional_means(field,
+                                                             _get_static_field(ds, 'REGION_MASK'),
+                                                             _get_static_field(ds, 'TAREA'),
+                                                             AnalysisElement._global_config['grid'],
+                                                             region_names,
+                                                             AnalysisElement._global_config['time_chunk_size'])
+
+                    # time axis (in years) is taken from the middle of each averaging interval
+                    try:
+                        tb_name, tb_dim = data_source._time_bound_var()
+                        time = ds[tb_name].mean(tb_dim).values / 365.
+                    except ValueError:
+                        time = ds['time'].values / 365.
+                    for i in range(len(region_names)):
+                        AnalysisElement.axs[plot_name][i].plot(time, regional_means[i, :], label=ds_name)
+
+                AnalysisElement.axs[plot_name][0].legend()
+                AnalysisElement.fig[plot_name].subplots_adjust(hspace=0.45)
+
+                _save_figure(AnalysisElement, plot_name)
+            except Exception: # pylint: disable=broad-except
+                _plot_failed(AnalysisElement, plot_name)
+
+def plot_ann_climo_zonal_mean_sections(AnalysisElement):
+    """ Regardless of data source, generate depth-latitude sections of zonal means of annual climatology"""
+    # set up time dimension for averaging
+    time_weights = dict()
+    for ds_name in AnalysisElement.data_sources:
+        # 1. data source needs time dimension of 1 or 12
+        if AnalysisElement.data_sources[ds_name].ds.dims['time'] not in [1, 12]:
+            raise ValueError("Dataset '{}' must have time dimension of 1 or 12".format(ds_name))
+        # 2. set up averages to reflect proper dimensions
+        time_weights[ds_name] = _get_time_period_weights(AnalysisElement.data_sources[ds_name],
+                                                         AnalysisElement._global_config['climo_time_periods'])
+    _plot_zonal_mean_sections(AnalysisElement, time_weights)
+
+def _plot_zonal_mean_sections(AnalysisElement, time_weights):
+    """ Regardless of data source, generate depth-latitude sections """
+    depth_coord_name = gt.get_grid_info(AnalysisElement._global_config['grid'])['depth_coord_name']
 
     # where will plots be written?
     if not os.path.exists(AnalysisElement._global_config['dirout']):
@@ -61,15 +155,500 @@ def _plot_climo(AnalysisElement, valid_time_dims):
     if AnalysisElement._global_config['reference']:
         for source, datestr in AnalysisElement._global_config['reference'].items():
             ref_data_source_name = "{}.{}".format(source, datestr)
-        if ref_data_source_name in AnalysisElement.data_sources:
-            AnalysisElement.logger.info("Reference dataset: '%s'", ref_data_source_name)
-        else:
+        if ref_data_source_name not in AnalysisElement.data_sources:
             ref_data_source_name = None
+    plot_diff_from_reference = ref_data_source_name and AnalysisElement._global_config['plot_diff_from_reference']
+
+    data_source_name_list = list(AnalysisElement.data_sources.keys())
+    if ref_data_source_name:
+        data_source_name_list = [ref_data_source_name] + \
+                                [data_source_name for data_source_name in data_source_name_list
+                                    if data_source_name != ref_data_source_name]
+    plt_count = len(data_source_name_list)
+    if plot_diff_from_reference:
+        plt_count = 2*plt_count - 1
+    nrow, ncol = pt.get_plot_dims(plt_count)
+
+    basin_names = gt.get_basin_names(AnalysisElement._global_config['basins'])
+    lat_bin_edges = gt.get_lat_bin_edges(AnalysisElement._global_config['lat_bin_width'])
+    lat = 0.5*(lat_bin_edges[:-1] + lat_bin_edges[1:])
+
+    #-- loop over variables
+    for v in AnalysisElement._global_config['variables']:
+
+        # Compute (or read cached) zonal means for every data source
+        # (a variable that can not be reduced is logged as failed and its plots are skipped)
+        zonal_means = dict()
+        try:
+            for ds_name in data_source_name_list:
+                zonal_mean = _get_zonal_mean(AnalysisElement, ds_name, v, basin_names, depth_coord_name)
+                if zonal_mean is not None:
+                    zonal_means[ds_name] = zonal_mean
+        except Exception: # pylint: disable=broad-except
+            _plot_failed(AnalysisElement, 'zonal-mean-section_{}_{}'.format(AnalysisElement.analysis_sname, v))
+            continue
+
+        for time_period in AnalysisElement._global_config['climo_time_periods']:
+            for basin_name in basin_names:
+
+                #-- name of the plot
+                plot_name = 'zonal-mean-section_{}_{}_{}_{}'.format(AnalysisElement.analysis_sname,
+                                                                    v,
+                                                                    basin_name,
+                                                                    time_period)
+                if _plot_is_done(AnalysisElement, plot_name):
+                    continue
+                AnalysisElement.logger.info('generating plot: %s', plot_name)
+                try:
+                    #-- generate figure object
+                    AnalysisElement.fig[plot_name] = plt.figure(figsize=(ncol*6,nrow*4))
+                    AnalysisElement.axs[plot_name] = np.empty(ncol*nrow, dtype=type(None))
+                    AnalysisElement.fig[plot_name].suptitle("{} zonal mean ({})".format(v, basin_name))
+
+                    i = -1
+                    ref_field = None
+                    for ds_name in data_source_name_list:
+                        if ds_name not in zonal_means:
+                            continue
+                        i = i+1
+                        field = xr.dot(time_weights[ds_name].sel(period=time_period),
+                                       zonal_means[ds_name].sel(basin=basin_name), dims='time')
+                        depth = field[depth_coord_name].values
+                        if ds_name == ref_data_source_name:
+                            ref_field = field
+
+                        levels = AnalysisElement._var_dict[v]['contours']['levels']
+                        ax = AnalysisElement.fig[plot_name].add_subplot(nrow, ncol, i+1)
+                        AnalysisElement.axs[plot_name][i], cf = _gen_section_panel(ax, ds_name, lat, depth, field.values,
+                                                                                   levels,
+                                                                                   AnalysisElement._var_dict[v]['contours']['extend'],
+                                                                                   AnalysisElement._var_dict[v]['contours']['cmap'])
+
+                        if plot_diff_from_reference:
+                            AnalysisElement.fig[plot_name].colorbar(cf, ax=AnalysisElement.axs[plot_name][i])
+                            if ds_name != ref_data_source_name and ref_field is not None:
+                                ref_depth = ref_field[depth_coord_name].values
+                                if ref_depth.shape != depth.shape or not np.allclose(ref_depth, depth):
+                                    AnalysisElement.logger.info('%s and %s have different vertical grids, skipping difference',
+                                                                ds_name, ref_data_source_name)
+                                    continue
+                                j = i + len(data_source_name_list) - 1
+                                ax = AnalysisElement.fig[plot_name].add_subplot(nrow, ncol, j+1)
+                                levels = AnalysisElement._var_dict[v]['contours']['difference_plot_levels']
+                                AnalysisElement.axs[plot_name][j], cf_diff = _gen_section_panel(
+                                    ax, "{} - {}".format(ds_name, ref_data_source_name), lat, depth,
+                                    field.values - ref_field.values, levels,
+                                    AnalysisElement._var_dict[v]['contours']['extend'], 'bwr')
+                                AnalysisElement.fig[plot_name].colorbar(cf_diff, ax=AnalysisElement.axs[plot_name][j])
+
+                    AnalysisElement.fig[plot_name].subplots_adjust(hspace=0.45, wspace=0.25, right=0.9)
+                    if i >= 0 and not plot_diff_from_reference:
+                        cax = plt.axes((0.93, 0.15, 0.02, 0.7))
+                        AnalysisElement.fig[plot_name].colorbar(cf, cax=cax)
+
+                    _save_figure(AnalysisElement, plot_name)
+                except Exception: # pylint: disable=broad-except
+                    _plot_failed(AnalysisElement, plot_name)
+
+def _get_zonal_mean(AnalysisElement, ds_name, v, basin_names, depth_coord_name):
+    """
+    Return zonal mean of variable v from data source ds_name as DataArray with dimensions
+    (time, depth, basin, lat); read from / write to cache_dir if cache_data is True.
+    Returns None if variable is not available in data source.
+    """
+    data_source = AnalysisElement.data_sources[ds_name]
+    lat_bin_width = AnalysisElement._global_config['lat_bin_width']
+    if AnalysisElement._global_config['cache_data']:
+        cached_location = '{}/zonal_mean.{}.{}.nc'.format(AnalysisElement._global_config['cache_dir'], ds_name, v)
+        if os.path.exists(cached_location):
+            zonal_mean = xr.open_dataarray(cached_location, decode_times=False).load()
+            if zonal_mean.attrs['lat_bin_width'] == lat_bin_width and \
+               list(zonal_mean['basin'].values) == basin_names:
+                AnalysisElement.logger.debug('Read zonal mean from %s', cached_location)
+                return zonal_mean
+
+    # Find appropriate variable name in dataset
+    if v not in data_source._var_dict or data_source._var_dict[v] not in data_source.ds:
+        AnalysisElement.logger.info('Can not find %s in %s, skipping', v, ds_name)
+        return None
+    ds = data_source.ds
+    field = ds[data_source._var_dict[v]]
+    cells, groups, ngroups = gt.zonal_mean_groups(AnalysisElement._global_config['grid'],
+                                                  _get_static_field(ds, 'TLAT').values,
+                                                  _get_static_field(ds, 'REGION_MASK').values,
+                                                  lat_bin_width, basin_names)
+    zonal_mean = _compute_zonal_means(field, _get_static_field(ds, 'TAREA').values,
+                                      cells, groups, ngroups, AnalysisElement._global_config['max_block_mb'])
+    zonal_mean = xr.DataArray(zonal_mean.reshape(field.shape[:-2] + (len(basin_names), -1)),
+                              dims=field.dims[:-2] + ('basin', 'lat'),
+                              coords={depth_coord_name: field[depth_coord_name].values,
+                                      'basin': basin_names},
+                              attrs={'lat_bin_width': lat_bin_width}, name=v)
+
+    if AnalysisElement._global_config['cache_data']:
+        if not os.path.exists(AnalysisElement._global_config['cache_dir']):
+            call(['mkdir', '-p', AnalysisElement._global_config['cache_dir']])
+        AnalysisElement.logger.info('writing %s', cached_location)
+        # write to a temporary file first so an interrupted run never leaves a truncated cache file
+        # (which the next run would try to read)
+        tmp_location = '{}.{}.tmp'.format(cached_location, os.getpid())
+        zonal_mean.to_netcdf(tmp_location)
+        os.rename(tmp_location, cached_location)
+    return zonal_mean
+
+def _compute_zonal_means(field, area, cells, groups, ngroups, max_block_mb):
+    """
+    Compute area-weighted means of field (time, [depth,] y, x) in every (basin, latitude bin) group
+    with grouped sums (np.bincount) over all depth levels of a block at once; blocks are one time
+    level and as many depth levels as fit in max_block_mb. Returns numpy array with shape
+    (leading dimensions) + (ngroups,)
+    """
+    weights = np.asarray(area).reshape(-1)[cells]
+    ntime = field.sizes['time']
+    nlevels = field.shape[1] if field.ndim == 4 else 1
+    levels_per_block = int(max(1, max_block_mb * 1024.**2 // (8 * field.shape[-2] * field.shape[-1])))
+    zonal_means = np.empty((ntime, nlevels, ngroups))
+    for n in range(ntime):
+        for level_start in range(0, nlevels, levels_per_block):
+            levels = slice(level_start, min(level_start + levels_per_block, nlevels))
+            if field.ndim == 4:
+                block = field[n, levels].values
+            else:
+                block = field[n].values
+            block = block.reshape(-1, block.shape[-2]*block.shape[-1])[:, cells]
+            nlead = block.shape[0]
+            valid = np.isfinite(block)
+            # offset groups so every depth level gets its own set of bins
+            bins = (np.arange(nlead)[:, np.newaxis] * ngroups + groups).reshape(-1)
+            num = np.bincount(bins, weights=np.where(valid, block * weights, 0.).reshape(-1),
+                              minlength=nlead*ngroups)
+            den = np.bincount(bins, weights=np.where(valid, weights, 0.).reshape(-1),
+                              minlength=nlead*ngroups)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                zonal_means[n, levels] = np.where(den > 0, num / den, np.nan).reshape(nlead, ngroups)
+    return zonal_means.reshape(field.shape[:-2] + (ngroups,))
+
+def _gen_section_panel(ax, title_str, lat, depth, field, levels, extend, cmap):
+    """ Contour a depth-latitude section on ax, return ax and the filled contour set """
+    cf = ax.contourf(lat, depth, np.ma.masked_invalid(field), levels=levels, extend=extend, cmap=cmap,
+                     norm=colors.BoundaryNorm(boundaries=levels, ncolors=256))
+    ax.contour(cf, levels=levels, linewidths=0.5, colors='k')
+    ax.set_facecolor('gray')
+    ax.set_ylim(depth.max(), 0.)
+    ax.set_title(title_str)
+    ax.set_xlabel('Latitude')
+    ax.set_ylabel('Depth (m)')
+    return ax, cf
+
+def _compute_regional_means(field, region_mask, area, grid, region_names, time_chunk_size):
+    """
+    Compute area-weighted means of field (time, y, x) over every region as a single sparse
+    matrix product per chunk of time levels; returns (region x time) numpy array
+    """
+    ntime = field.sizes['time']
+    # Land / missing values are constant in time, so weights only depend on first time level
+    valid = np.isfinite(field.isel(time=0).values)
+    weights = gt.region_weight_matrix(grid, region_mask.values, area.values, valid, region_names)
+    empty_regions = weights.getnnz(axis=1) == 0
+
+    regional_means = np.empty((len(region_names), ntime))
+    for time_start in range(0, ntime, time_chunk_size):
+        time_slice = slice(time_start, min(time_start + time_chunk_size, ntime))
+        block = field.isel(time=time_slice).values.reshape(time_slice.stop - time_slice.start, -1)
+        block = np.where(np.isfinite(block), block, 0.)
+        regional_means[:, time_slice] = weights.dot(block.T)
+    regional_means[empty_regions, :] = np.nan
+    return regional_means
+
+def _get_static_field(ds, var_name):
+    """ Return ds[var_name] without a time dimension """
+    if 'time' in ds[var_name].dims:
+        return ds[var_name].isel(time=0)
+    return ds[var_name]
+
+def plot_ensemble_mon_climo_summary(AnalysisElement):
+    """
+    Generate maps of ensemble mean, standard deviation, minimum, maximum, and (if a reference
+    is provided) ensemble mean - reference of monthly climatologies; members are opened,
+    reduced to the fields that are plotted, and added to running statistics one at a time
+    """
+    depth_coord_name = gt.get_grid_info(AnalysisElement._global_config['grid'])['depth_coord_name']
+
+    # where will plots be written?
+    if not os.path.exists(AnalysisElement._global_config['dirout']):
+        call(['mkdir', '-p', AnalysisElement._global_config['dirout']])
+
+    time_periods = AnalysisElement._global_config['climo_time_periods']
+    ref_data_source_name = _get_reference_name(AnalysisElement)
+    members = [ds_name for ds_name in AnalysisElement.data_source_labels if ds_name != ref_data_source_name]
+    if not members:
+        raise ValueError("'{}' does not have any ensemble members".format(AnalysisElement.analysis_sname))
+
+    def reduce_member(ds_name):
+        """ Return grid fields and reduced fields of every variable for one member, then close it """
+        AnalysisElement.open_data_source(ds_name)
+        data_source = AnalysisElement.data_sources[ds_name]
+        if data_source.ds.dims['time'] != 12:
+            raise ValueError("Dataset '{}' must have time dimension of 12".format(ds_name))
+        time_weights = _get_time_period_weights(data_source, time_periods)
+        grid_fields = dict()
+        for var_name in ['TAREA', 'TLONG', 'TLAT']:
+            grid_fields[var_name] = _get_static_field(data_source.ds, var_name).load()
+        fields = dict()
+        for v in AnalysisElement._global_config['variables']:
+            fields[v] = _reduce_climo_fields(AnalysisElement, ds_name, v, time_weights, depth_coord_name)
+        del AnalysisElement.data_sources[ds_name]
+        return grid_fields, fields
+
+    # (1) Accumulate statistics, one member at a time (next member is read in the background)
+    # (a member or reference that can not be reduced is logged as failed and no plots are made)
+    # (statistics of each variable and level cover all time periods, on the ocean points of any member)
+    ensemble_stats = dict()
+    ensemble_points = dict()
+    grid_fields = None
+    ref_fields = None
+    try:
+        for ds_name, (member_grid_fields, fields) in _prefetch(reduce_member, members,
+                                                               AnalysisElement._global_config['prefetch_depth'],
+                                                               AnalysisElement._global_config['prefetch_max_mb'],
+                                                               _reduced_fields_nbytes):
+            AnalysisElement.logger.info('Adding %s to ensemble statistics', ds_name)
+            if grid_fields is None:
+                grid_fields = member_grid_fields
+            elif member_grid_fields['TAREA'].shape != grid_fields['TAREA'].shape:
+                raise ValueError("Ensemble member '{}' is not on the same grid as '{}'".format(ds_name, members[0]))
+            for v, climo_fields in fields.items():
+                if climo_fields is None:
+                    continue
+                for depth_str, field in climo_fields.items():
+                    key = (v, depth_str)
+                    if key not in ensemble_stats:
+                        ensemble_stats[key] = EnsembleStatistics()
+                        ensemble_points[key] = field['ocean_point'].values
+                    points = ensemble_points[key]
+                    if not np.array_equal(points, field['ocean_point'].values):
+                        # (statistics cover every point where any member has data)
+                        union = np.union1d(points, field['ocean_point'].values)
+                        if union.size > points.size:
+                            ensemble_stats[key].expand(np.searchsorted(union, points), union.size)
+                            ensemble_points[key] = union
+                    ensemble_stats[key].update(_on_ocean_points(field, ensemble_points[key]).values)
+
+        if ref_data_source_name:
+            AnalysisElement.logger.info("Reference dataset: '%s'", ref_data_source_name)
+            ref_grid_fields, ref_fields = reduce_member(ref_data_source_name)
+            if ref_grid_fields['TAREA'].shape != grid_fields['TAREA'].shape:
+                raise ValueError("Reference '{}' is not on the same grid as the ensemble".format(ref_data_source_name))
+    except Exception: # pylint: disable=broad-except
+        _plot_failed(AnalysisElement, 'ensemble-map-{}'.format(AnalysisElement.analysis_sname))
+        return
+
+    # (2) One figure per variable, level and time period (figures with the same layout are reused)
+    templates = dict()
+    for v in AnalysisElement._global_config['variables']:
+        for sel_z in AnalysisElement._global_config['levels']:
+            _, _, depth_str = _get_depth_indexer(sel_z, depth_coord_name)
+            for m, time_period in enumerate(time_periods):
+                if (v, depth_str) not in ensemble_stats:
+                    AnalysisElement.logger.info('Can not find %s in any ensemble member, skipping plot', v)
+                    continue
+                stats = ensemble_stats[(v, depth_str)]
+                points = ensemble_points[(v, depth_str)]
+                contours = AnalysisElement._var_dict[v]['contours']
+                std_levels = [level for level in contours['difference_plot_levels'] if level >= 0]
+
+                #-- name of the plot
+                plot_name = 'ensemble-map-{}_{}_{}_{}'.format(AnalysisElement.analysis_sname,
+                                                              v,
+                                                              depth_str,
+                                                              time_period)
+                if _plot_is_done(AnalysisElement, plot_name):
+                    continue
+                AnalysisElement.logger.info('generating plot: %s', plot_name)
+                nrow, ncol = None, None
+                try:
+                    coords = {'ocean_point': points}
+                    mean_field = xr.DataArray(stats.mean()[m], dims='ocean_point', coords=coords)
+                    panels = [('Ensemble mean', mean_field, contours['levels'], contours['cmap']),
+                              ('Ensemble std. dev.', xr.DataArray(stats.std()[m], dims='ocean_point', coords=coords),
+                               std_levels, 'viridis'),
+                              ('Ensemble min', xr.DataArray(stats.min()[m], dims='ocean_point', coords=coords),
+                               contours['levels'], contours['cmap']),
+                              ('Ensemble max', xr.DataArray(stats.max()[m], dims='ocean_point', coords=coords),
+                               contours['levels'], contours['cmap'])]
+                    if ref_fields and ref_fields[v] is not None:
+                        # (reference keeps its own ocean points; the difference is taken where both have points)
+                        ref_field = ref_fields[v][depth_str].sel(period=time_period, drop=True)
+                        panels.append((ref_data_source_name, ref_field, contours['levels'], contours['cmap']))
+                        panels.append(('Ensemble mean - {}'.format(ref_data_source_name), mean_field - ref_field,
+                                       contours['difference_plot_levels'], 'bwr'))
+
+                    nrow, ncol = pt.get_plot_dims(len(panels))
+                    template = _new_map_figure(AnalysisElement, templates, plot_name, nrow, ncol,
+                                               "{} at {} ({} members)".format(v, depth_str, stats.nmembers))
+
+                    for i, (title_str, field, levels, cmap) in enumerate(panels):
+                        ax = template.panel(i)
+                        AnalysisElement.axs[plot_name][i] = _gen_plot_panel(ax, title_str, field, grid_fields['TAREA'],
+                                                                            AnalysisElement._global_config['stats_in_title'])
+                        lon, lat, field = _get_display_field(AnalysisElement, grid_fields, field)
+                        cf = ax.contourf(lon, lat, field, transform=ccrs.PlateCarree(),
+                                         levels=levels,
+                                         extend=contours['extend'],
+                                         cmap=cmap,
+                                         norm=colors.BoundaryNorm(boundaries=levels, ncolors=256))
+                        ax.contour(cf, transform=ccrs.PlateCarree(), levels=levels, linewidths=0.5, colors='k')
+                        template.colorbar(cf, i)
+
+                    _save_figure(AnalysisElement, plot_name, close=template not in templates.values())
+                except Exception: # pylint: disable=broad-except
+                    _plot_failed(AnalysisElement, plot_name)
+                    templates.pop((nrow, ncol), None)
+
+    for template in templates.values():
+        template.close()
+
+def compute_mon_climo_skill_metrics(AnalysisElement):
+    """
+    Write a table (no figures) of area-weighted bias, RMSE, pattern correlation, and ratio of
+    standard deviations of every data source against the reference, for every variable, level,
+    and time period of the climatology
+    """
+    depth_coord_name = gt.get_grid_info(AnalysisElement._global_config['grid'])['depth_coord_name']
+
+    ref_data_source_name = _get_reference_name(AnalysisElement)
     if not ref_data_source_name:
+        raise ValueError("'{}' must provide a reference that is in datestrs".format(AnalysisElement.analysis_sname))
+    metrics_format = AnalysisElement._global_config['metrics_format']
+    if metrics_format not in ['csv', 'parquet']:
+        raise ValueError("'{}' is not a valid metrics_format".format(metrics_format))
+
+    # where will metrics be written?
+    if not os.path.exists(AnalysisElement._global_config['dirout']):
+        call(['mkdir', '-p', AnalysisElement._global_config['dirout']])
+
+    time_periods = AnalysisElement._global_config['climo_time_periods']
+    ds_names = list(AnalysisElement.data_source_labels)
+    time_weights = dict()
+    for ds_name in ds_names:
+        time_weights[ds_name] = _get_time_period_weights(AnalysisElement.data_sources[ds_name], time_periods)
+    grid_fields = _get_grid_fields(AnalysisElement, ds_names)
+
+    # (a variable that can not be reduced is logged as failed and left out of the table, and
+    #  the table is not recorded in the journal, so --resume computes it again)
+    def reduce_variable(v):
+        try:
+            climo_fields = dict()
+            for ds_name in ds_names:
+                climo_fields[ds_name] = _reduce_climo_fields(AnalysisElement, ds_name, v,
+                                                             time_weights[ds_name], depth_coord_name)
+            return climo_fields
+        except Exception: # pylint: disable=broad-except
+            _plot_failed(AnalysisElement, 'skill-metrics_{}_{}'.format(AnalysisElement.analysis_sname, v))
+            return None
+
+    rows = []
+    table_complete = True
+    for v, climo_fields in _prefetch(reduce_variable, AnalysisElement._global_config['variables'],
+                                     AnalysisElement._global_config['prefetch_depth'],
+                                     AnalysisElement._global_config['prefetch_max_mb'],
+                                     _reduced_fields_nbytes):
+        if climo_fields is None:
+            table_complete = False
+            continue
+        if climo_fields[ref_data_source_name] is None:
+            AnalysisElement.logger.info('Can not find %s in reference, skipping metrics', v)
+            continue
+        for ds_name in ds_names:
+            if climo_fields[ds_name] is None:
+                AnalysisElement.logger.info('Can not find %s in %s, skipping metrics', v, ds_name)
+        var_rows = []
+        try:
+            for sel_z in AnalysisElement._global_config['levels']:
+                _, _, depth_str = _get_depth_indexer(sel_z, depth_coord_name)
+                for fields, area in _stack_fields(climo_fields, depth_str, grid_fields):
+                    if ref_data_source_name not in fields.source.values:
+                        AnalysisElement.logger.warning('%s not on the grid of reference %s, skipping %s metrics at %s',
+                                                       ', '.join(fields.source.values), ref_data_source_name,
+                                                       v, depth_str)
+                        continue
+                    if fields.sizes['source'] == 1:
+                        continue
+                    metrics = _compute_skill_metrics(fields.drop_sel(source=ref_data_source_name),
+                                                     fields.sel(source=ref_data_source_name, drop=True),
+                                                     area.sel(source=ref_data_source_name, drop=True))
+                    for n, ds_name in enumerate(metrics['source'].values):
+                        for m, time_period in enumerate(time_periods):
+                            row = {'variable': v, 'level': depth_str, 'period': time_period,
+                                   'source': ds_name, 'reference': ref_data_source_name}
+                            for metric_name in SKILL_METRICS:
+                                row[metric_name] = float(metrics[metric_name].values[n, m])
+                            var_rows.append(row)
+        except Exception: # pylint: disable=broad-except
+            _plot_failed(AnalysisElement, 'skill-metrics_{}_{}'.format(AnalysisElement.analysis_sname, v))
+            table_complete = False
+            continue
+        rows += var_rows
+
+    table = pd.DataFrame(rows, columns=['variable', 'level', 'period', 'source', 'reference'] + SKILL_METRICS)
+    file_out = '{}/skill-metrics_{}.{}'.format(AnalysisElement._global_config['dirout'],
+                                               AnalysisElement.analysis_sname, metrics_format)
+    AnalysisElement.logger.info('writing %d rows to %s', len(table), file_out)
+    # write to a temporary file first so an interrupted run never leaves a truncated table
+    tmp_file = '{}.{}.tmp'.format(file_out, os.getpid())
+    if metrics_format == 'csv':
+        table.to_csv(tmp_file, index=False, float_format='%.8g')
+    else:
+        table.to_parquet(tmp_file, index=False)
+    os.rename(tmp_file, file_out)
+    if AnalysisElement.journal is not None and table_complete:
+        AnalysisElement.journal.mark_done('table', file_out)
+
+def _compute_skill_metrics(fields, ref_field, area):
+    """
+    Return Dataset of SKILL_METRICS of fields (source, period, ...) against ref_field (period, ...),
+    weighted by area and reduced over all dimensions other than source and period in one
+    vectorized operation (only points that are valid in both field and reference are used)
+    """
+    dims = [dim for dim in fields.dims if dim not in ['source', 'period']]
+    valid = fields.notnull() & ref_field.notnull()
+    weights = area.where(valid, 0.)
+    total_weights = weights.sum(dims)
+
+    def weighted_mean(values):
+        return (values.fillna(0.) * weights).sum(dims) / total_weights
+
+    field_mean = weighted_mean(fields)
+    ref_mean = weighted_mean(ref_field)
+    field_anom = fields - field_mean
+    ref_anom = ref_field - ref_mean
+    field_var = weighted_mean(field_anom * field_anom)
+    ref_var = weighted_mean(ref_anom * ref_anom)
+    metrics = xr.Dataset()
+    metrics['bias'] = field_mean - ref_mean
+    metrics['rmse'] = np.sqrt(weighted_mean((fields - ref_field)**2))
+    metrics['pattern_corr'] = weighted_mean(field_anom * ref_anom) / np.sqrt(field_var * ref_var)
+    metrics['std_ratio'] = np.sqrt(field_var / ref_var)
+    return metrics.transpose('source', 'period')
+
+def _plot_climo(AnalysisElement, time_weights):
+    """ Regardless of data source, generate plots """
+    depth_coord_name = gt.get_grid_info(AnalysisElement._global_config['grid'])['depth_coord_name']
+
+    # where will plots be written?
+    if not os.path.exists(AnalysisElement._global_config['dirout']):
+        call(['mkdir', '-p', AnalysisElement._global_config['dirout']])
+
+    # identify reference (if any provided)
+    ref_data_source_name = _get_reference_name(AnalysisElement)
+    if ref_data_source_name:
+        AnalysisElement.logger.info("Reference dataset: '%s'", ref_data_source_name)
+    else:
         AnalysisElement.logger.info("No reference dataset specified")
+    plot_diff_from_reference = ref_data_source_name and AnalysisElement._global_config['plot_diff_from_reference']
 
     #-- loop over datasets
-    data_source_name_list = AnalysisElement.data_sources.keys()
+    data_source_name_list = list(AnalysisElement.data_source_labels)
     plt_count = len(data_source_name_list)
     if ref_data_source_name:
         data_source_name_list = [ref_data_source_name] + \
@@ -77,161 +656,683 @@ def _plot_climo(AnalysisElement, valid_time_dims):
                                     if data_source_name != ref_data_source_name]
         if AnalysisElement._global_config['plot_diff_from_reference']:
             plt_count = 2*plt_count - 1
-            diff_field = dict()
+    grid_fields = _get_grid_fields(AnalysisElement, data_source_name_list)
+    # (in preview mode, fields are plotted on blocks of cells)
+    plot_grid_fields = _get_preview_grid_fields(AnalysisElement, grid_fields)
 
-    #-- loop over variables
+    # Reduce every data source to all requested (time period, level) fields at once;
+    # fields for upcoming variables are read in a background thread while the current one is plotted
+    # (a variable that can not be reduced is logged as failed and its plots are skipped)
+    def reduce_variable(v):
+        try:
+            return _get_reduced_fields(AnalysisElement, v, data_source_name_list, ref_data_source_name,
+                                       time_weights, depth_coord_name, grid_fields)
+        except Exception: # pylint: disable=broad-except
+            _plot_failed(AnalysisElement, 'state-map-{}_{}'.format(AnalysisElement.analysis_sname, v))
+            return None
+
+    # variables whose plots were all written by a previous run are not reduced again
+    variables = []
     for v in AnalysisElement._global_config['variables']:
+        for sel_z in AnalysisElement._global_config['levels']:
+            _, _, depth_str = _get_depth_indexer(sel_z, depth_coord_name)
+            if not all([_plot_is_done(AnalysisElement, 'state-map-{}_{}_{}_{}'.format(
+                    AnalysisElement.analysis_sname, v, depth_str, time_period))
+                        for time_period in AnalysisElement._global_config['climo_time_periods']]):
+                variables.append(v)
+                break
 
-        nrow, ncol = pt.get_plot_dims(plt_count)
-        AnalysisElement.logger.debug('dimensioning plot canvas: %d x %d (%d total plots)',
-                         nrow, ncol, plt_count)
-        var_in_ref = True
+    # every plot has the same layout, so panels are set up once and reused
+    nrow, ncol = pt.get_plot_dims(plt_count)
+    AnalysisElement.logger.debug('dimensioning plot canvas: %d x %d (%d total plots)',
+                     nrow, ncol, plt_count)
+    templates = dict()
 
-        #-- loop over time periods
-        for time_period in AnalysisElement._global_config['climo_time_periods']:
+    #-- loop over variables
+    for v, reduced_fields in _prefetch(reduce_variable, variables,
+                                       AnalysisElement._global_config['prefetch_depth'],
+                                       AnalysisElement._global_config['prefetch_max_mb'],
+                                       _reduced_fields_nbytes):
+        if reduced_fields is None:
+            continue
+        climo_fields, diff_fields, stats = reduced_fields
 
-            for sel_z in AnalysisElement._global_config['levels']:
+        for sel_z in AnalysisElement._global_config['levels']:
+
+            #-- build indexer for depth
+            _, _, depth_str = _get_depth_indexer(sel_z, depth_coord_name)
 
-                #-- build indexer for depth
-                if isinstance(sel_z, list): # fragile?
-                    is_depth_range = True
-                    indexer = {depth_coord_name:slice(sel_z[0], sel_z[1])}
-                    depth_str = '{:.0f}-{:.0f}m'.format(sel_z[0], sel_z[1])
-                else:
-                    is_depth_range = False
-                    indexer = {depth_coord_name: sel_z, 'method': 'nearest'}
-                    depth_str = '{:.0f}m'.format(sel_z)
+            #-- loop over time periods
+            for time_period in AnalysisElement._global_config['climo_time_periods']:
 
                 #-- name of the plot
                 plot_name = 'state-map-{}_{}_{}_{}'.format(AnalysisElement.analysis_sname,
                                                            v,
                                                            depth_str,
                                                            time_period)
+                if _plot_is_done(AnalysisElement, plot_name):
+                    continue
                 AnalysisElement.logger.info('generating plot: %s', plot_name)
+                try:
+                    #-- generate (or reuse) figure object
+                    template = _new_map_figure(AnalysisElement, templates, plot_name, nrow, ncol,
+                                               "{} at {}".format(v, depth_str))
 
-                #-- generate figure object
-                AnalysisElement.fig[plot_name] = plt.figure(figsize=(ncol*6,nrow*4))
-                AnalysisElement.axs[plot_name] = np.empty(ncol*nrow, dtype=type(None))
-                AnalysisElement.fig[plot_name].suptitle("{} at {}".format(v, depth_str))
+                    # Plot climo state (don't use enumerate to avoid incrementing missing datasets)
+                    i = -1
+                    for ds_name in data_source_name_list:
 
-                # Plot climo state (don't use enumerate to avoid incrementing missing datasets)
-                i = -1
-                for ds_name in data_source_name_list:
+                        if climo_fields[ds_name] is None:
+                            continue
+                        # data found => increment plot counter
+                        i = i+1
 
-                    ds = AnalysisElement.data_sources[ds_name].ds
-                    #-- need to deal with time dimension here....
+                        field = climo_fields[ds_name][depth_str].sel(period=time_period)
+                        TAREA = plot_grid_fields[ds_name]['TAREA']
 
-                    # Find appropriate variable name in dataset or move to next dataset
-                    if v not in AnalysisElement.data_sources[ds_name]._var_dict:
-                        AnalysisElement.logger.info('Can not find %s in %s, skipping plot', v, ds_name)
-                        if ds_name == ref_data_source_name:
-                            var_in_ref = False
-                        continue
-                    var_name = AnalysisElement.data_sources[ds_name]._var_dict[v]
-                    if var_name not in ds:
-                        AnalysisElement.logger.info('Can not find %s in %s, skipping plot', var_name, ds_name)
-                        if ds_name == ref_data_source_name:
-                            var_in_ref = False
-                        continue
-                    # data found => increment plot counter
-                    i = i+1
+                        ax = template.panel(i)
+                        AnalysisElement.axs[plot_name][i] = _gen_plot_panel(ax, ds_name, field, TAREA,
+                                                                            AnalysisElement._global_config['stats_in_title'],
+                                                                            stats[ds_name][depth_str][time_period])
+                        AnalysisElement.logger.info("Plotting {}".format(AnalysisElement.axs[plot_name][i].get_title()))
 
-                    if time_period in valid_time_dims[ds_name]:
-                        field = ds[var_name].sel(**indexer).isel(time=valid_time_dims[ds_name][time_period]).mean('time')
-                    else:
-                        raise KeyError("'{}' is not a known time period for '{}'".format(time_period, ds_name))
+                        lon, lat, field = _get_display_field(AnalysisElement, plot_grid_fields[ds_name], field)
 
-                    plot_diff_from_reference = ref_data_source_name and AnalysisElement._global_config['plot_diff_from_reference']
+                        levels = AnalysisElement._var_dict[v]['contours']['levels']
+                        cf = AnalysisElement.axs[plot_name][i].contourf(lon,lat,field,transform=ccrs.PlateCarree(),
+                                                                        levels=levels,
+                                                                        extend=AnalysisElement._var_dict[v]['contours']['extend'],
+                                                                        cmap=AnalysisElement._var_dict[v]['contours']['cmap'],
+                                                                        norm=colors.BoundaryNorm(boundaries=levels, ncolors=256))
+                        cs = AnalysisElement.axs[plot_name][i].contour(cf, transform=ccrs.PlateCarree(),
+                                                                       levels=AnalysisElement._var_dict[v]['contours']['levels'],
+                                                                       extend=AnalysisElement._var_dict[v]['contours']['extend'],
+                                                                       linewidths=0.5, colors='k')
 
-                    if is_depth_range:
-                        field = field.mean(depth_coord_name)
+                        if plot_diff_from_reference:
+                            template.colorbar(cf, i)
+                            if diff_fields[ds_name] is not None:
+                                diff_field = diff_fields[ds_name][depth_str].sel(period=time_period)
+                                j = i + len(data_source_name_list) - 1
+                                ax = template.panel(j)
+                                AnalysisElement.axs[plot_name][j] = _gen_plot_panel(
+                                    ax, "{} - {}".format(ds_name, ref_data_source_name),
+                                    diff_field, TAREA,
+                                    AnalysisElement._global_config['stats_in_title'],
+                                    stats['{} - {}'.format(ds_name, ref_data_source_name)][depth_str][time_period])
+                                AnalysisElement.logger.info("Plotting {}".format(AnalysisElement.axs[plot_name][j].get_title()))
 
-                    if plot_diff_from_reference:
-                        if ds_name == ref_data_source_name:
-                            ref_field_for_stats = field.copy(deep=True)
-                        else:
-                            diff_field_for_stats = field.copy(deep=True)
-                            diff_field_for_stats.values = field.values - ref_field_for_stats.values
-
-                    ax = AnalysisElement.fig[plot_name].add_subplot(nrow, ncol, i+1, projection=ccrs.Robinson(central_longitude=305.0))
-                    AnalysisElement.axs[plot_name][i] = _gen_plot_panel(ax, ds_name, field, ds['TAREA'], AnalysisElement._global_config['stats_in_title'])
-                    AnalysisElement.logger.info("Plotting {}".format(AnalysisElement.axs[plot_name][i].get_title()))
-
-                    if AnalysisElement._global_config['grid'] == 'POP_gx1v7':
-                        lon, lat, field = pt.adjust_pop_grid(ds.TLONG.values, ds.TLAT.values, field)
-
-                    if ds_name == ref_data_source_name and plot_diff_from_reference:
-                        ref_field = field
-
-                    levels = AnalysisElement._var_dict[v]['contours']['levels']
-                    cf = AnalysisElement.axs[plot_name][i].contourf(lon,lat,field,transform=ccrs.PlateCarree(),
-                                                                    levels=levels,
-                                                                    extend=AnalysisElement._var_dict[v]['contours']['extend'],
-                                                                    cmap=AnalysisElement._var_dict[v]['contours']['cmap'],
-                                                                    norm=colors.BoundaryNorm(boundaries=levels, ncolors=256))
-                    cs = AnalysisElement.axs[plot_name][i].contour(cf, transform=ccrs.PlateCarree(),
-                                                                   levels=AnalysisElement._var_dict[v]['contours']['levels'],
-                                                                   extend=AnalysisElement._var_dict[v]['contours']['extend'],
-                                                                   linewidths=0.5, colors='k')
-
-                    if plot_diff_from_reference:
-                        AnalysisElement.fig[plot_name].colorbar(cf, ax=AnalysisElement.axs[plot_name][i])
-                        if ds_name != ref_data_source_name and var_in_ref:
-                            diff_field[ds_name] = field - ref_field
-                            j = i + len(data_source_name_list) - 1
-                            ax = AnalysisElement.fig[plot_name].add_subplot(nrow, ncol, j+1,
-                                projection=ccrs.Robinson(central_longitude=305.0))
-                            AnalysisElement.axs[plot_name][j] = _gen_plot_panel(
-                                ax, "{} - {}".format(ds_name, ref_data_source_name),
-                                diff_field_for_stats, ds['TAREA'],
-                                AnalysisElement._global_config['stats_in_title'])
-                            AnalysisElement.logger.info("Plotting {}".format(AnalysisElement.axs[plot_name][j].get_title()))
-
-                            levels = AnalysisElement._var_dict[v]['contours']['difference_plot_levels']
-                            cf = AnalysisElement.axs[plot_name][j].contourf(lon,lat,diff_field[ds_name],transform=ccrs.PlateCarree(),
-                                                                            levels=levels,
-                                                                            extend=AnalysisElement._var_dict[v]['contours']['extend'],
-                                                                            norm=colors.BoundaryNorm(boundaries=levels, ncolors=256),
-                                                                            cmap='bwr')
-                            cs = AnalysisElement.axs[plot_name][j].contour(cf, transform=ccrs.PlateCarree(),
-                                                                           levels=levels,
-                                                                           extend=AnalysisElement._var_dict[v]['contours']['extend'],
-                                                                           linewidths=0.5, colors='k')
-                            AnalysisElement.fig[plot_name].colorbar(cf, ax=AnalysisElement.axs[plot_name][j])
-                    del(field)
-
-                AnalysisElement.fig[plot_name].subplots_adjust(hspace=0.45, wspace=0.02, right=0.9)
-                if not (ref_data_source_name and AnalysisElement._global_config['plot_diff_from_reference']):
-                    cax = plt.axes((0.93, 0.15, 0.02, 0.7))
-                    AnalysisElement.fig[plot_name].colorbar(cf, cax=cax)
-
-                if AnalysisElement._global_config['plot_format']:
-                    AnalysisElement.fig[plot_name].savefig('{}/{}.{}'.format(AnalysisElement._global_config['dirout'],
-                                                  plot_name,
-                                                  AnalysisElement._global_config['plot_format']),
-                                bbox_inches='tight', dpi=300, format=AnalysisElement._global_config['plot_format'])
-                plt.close(AnalysisElement.fig[plot_name])
-                if not AnalysisElement._global_config['keep_figs']:
-                    del(AnalysisElement.fig[plot_name])
-                    (AnalysisElement.axs[plot_name])
+                                lon, lat, diff_field = _get_display_field(AnalysisElement, plot_grid_fields[ds_name],
+                                                                          diff_field)
+
+                                levels = AnalysisElement._var_dict[v]['contours']['difference_plot_levels']
+                                cf = AnalysisElement.axs[plot_name][j].contourf(lon,lat,diff_field,transform=ccrs.PlateCarree(),
+                                                                                levels=levels,
+                                                                                extend=AnalysisElement._var_dict[v]['contours']['extend'],
+                                                                                norm=colors.BoundaryNorm(boundaries=levels, ncolors=256),
+                                                                                cmap='bwr')
+                                cs = AnalysisElement.axs[plot_name][j].contour(cf, transform=ccrs.PlateCarree(),
+                                                                               levels=levels,
+                                                                               extend=AnalysisElement._var_dict[v]['contours']['extend'],
+                                                                               linewidths=0.5, colors='k')
+                                template.colorbar(cf, j)
+                        del(field)
+
+                    if not plot_diff_from_reference:
+                        template.colorbar(cf)
+
+                    _save_figure(AnalysisElement, plot_name, close=template not in templates.values())
+                except Exception: # pylint: disable=broad-except
+                    _plot_failed(AnalysisElement, plot_name)
+                    templates.pop((nrow, ncol), None)
+
+    for template in templates.values():
+        template.close()
+
+def fields_in_store(AnalysisElement):
+    """
+    True if AnalysisElement.field_store holds every field _plot_climo needs for this element
+    (in which case the data sources do not need to be opened at all)
+    """
+    store = AnalysisElement.field_store
+    if store is None:
+        return False
+    ds_names = AnalysisElement.data_source_labels
+    ref_data_source_name = _get_reference_name(AnalysisElement)
+    plot_diff_from_reference = ref_data_source_name and AnalysisElement._global_config['plot_diff_from_reference']
+    for ds_name in ds_names:
+        for var_name in ['TAREA', 'TLONG', 'TLAT']:
+            if not store.has_grid_field(ds_name, var_name):
+                return False
+    for v in AnalysisElement._global_config['variables']:
+        for ds_name in ds_names:
+            field_names = [ds_name]
+            # (differences of previews are computed from coarsened fields and never stored)
+            if plot_diff_from_reference and ds_name != ref_data_source_name and \
+               not AnalysisElement._global_config['preview'] and \
+               not (store.is_missing(ds_name, v) or store.is_missing(ref_data_source_name, v)):
+                field_names.append('{} - {}'.format(ds_name, ref_data_source_name))
+            for field_name in field_names:
+                for sel_z in AnalysisElement._global_config['levels']:
+                    _, _, depth_str = _get_depth_indexer(sel_z, None)
+                    for time_period in AnalysisElement._global_config['climo_time_periods']:
+                        if not store.has_field(field_name, v, time_period, depth_str):
+                            return False
+    return True
+
+def _get_display_field(AnalysisElement, grid_fields, field):
+    """
+    Return lon, lat, field ready to contour: field (on ocean points) is scattered back to the 2D
+    grid, averaged (area-weighted) to display resolution on high-resolution grids, then wrapped
+    at the dateline
+    """
+    values = gt.expand_from_ocean_points(field.values, field['ocean_point'].values, grid_fields['TAREA'].shape)
+    lon, lat, values = gt.coarsen_for_display(AnalysisElement._global_config['grid'],
+                                              grid_fields['TLONG'].values, grid_fields['TLAT'].values,
+                                              values, grid_fields['TAREA'].values)
+    return pt.adjust_pop_grid(lon, lat, values)
+
+def _new_map_figure(AnalysisElement, templates, plot_name, nrow, ncol, suptitle):
+    """
+    Start plot_name in the template for an nrow x ncol layout (built the first time it is
+    needed and stored in templates), and return the template; with keep_figs every plot gets
+    its own template, since the figures are kept after they are written
+    """
+    if AnalysisElement._global_config['keep_figs']:
+        template = MapFigureTemplate(nrow, ncol)
+    else:
+        if (nrow, ncol) not in templates:
+            templates[(nrow, ncol)] = MapFigureTemplate(nrow, ncol)
+        template = templates[(nrow, ncol)]
+    AnalysisElement.fig[plot_name] = template.new_plot(suptitle)
+    AnalysisElement.axs[plot_name] = np.empty(ncol*nrow, dtype=type(None))
+    return template
+
+def _plot_is_done(AnalysisElement, plot_name):
+    """ True if the journal records that plot_name was written by a previous run """
+    if AnalysisElement.journal is None:
+        return False
+    return AnalysisElement.journal.is_done('figure', '{}/{}'.format(AnalysisElement._global_config['dirout'],
+                                                                    plot_name))
+
+def _save_figure(AnalysisElement, plot_name, close=True):
+    """
+    Write AnalysisElement.fig[plot_name] (to a temporary file that is renamed, so an interrupted
+    run never leaves a truncated plot), close it, and record it in the journal once it is written;
+    with a figure writer the figure is only rendered here, and encoded / written in the background.
+    close=False leaves the figure open (for figure templates that are reused by the next plot)
+    """
+    plot_format = AnalysisElement._global_config['plot_format']
+    file_out = '{}/{}'.format(AnalysisElement._global_config['dirout'], plot_name)
+
+    def mark_done():
+        if AnalysisElement.journal is not None:
+            AnalysisElement.journal.mark_done('figure', file_out)
+
+    # previews are labelled (the label is removed once the figure is rendered)
+    label = None
+    if AnalysisElement._global_config['preview']:
+        label = AnalysisElement.fig[plot_name].text(0.01, 0.99, 'PREVIEW (low resolution)', color='red',
+                                                    fontsize='x-large', fontweight='bold', va='top')
+
+    if plot_format:
+        options = figure_writer.get_format_options(plot_format, AnalysisElement._global_config['plot_format_options'])
+        if AnalysisElement._global_config['preview']:
+            options['dpi'] = AnalysisElement._global_config['preview_dpi']
+        file_name = '{}.{}'.format(file_out, plot_format)
+        if AnalysisElement.figure_writer is not None:
+            AnalysisElement.figure_writer.submit(AnalysisElement.fig[plot_name], file_name, plot_format, options,
+                                                 name=plot_name, on_written=mark_done)
+        else:
+            figure_writer.write_figure(AnalysisElement.fig[plot_name], file_name, plot_format, options)
+            mark_done()
+    else:
+        mark_done()
+    if label is not None:
+        label.remove()
+    if close:
+        plt.close(AnalysisElement.fig[plot_name])
     if not AnalysisElement._global_config['keep_figs']:
-        del(AnalysisElement.fig)
-        (AnalysisElement.axs)
+        del(AnalysisElement.fig[plot_name])
+        del(AnalysisElement.axs[plot_name])
+
+def _plot_failed(AnalysisElement, plot_name):
+    """ Log the exception being handled, close the partial figure (if any), and record the failure """
+    AnalysisElement.logger.error('Failed to generate %s:\n%s', plot_name, traceback.format_exc())
+    if plot_name in AnalysisElement.fig:
+        plt.close(AnalysisElement.fig.pop(plot_name))
+        AnalysisElement.axs.pop(plot_name, None)
+    AnalysisElement.failed_plots.append(plot_name)
+
+def _get_reference_name(AnalysisElement):
+    """ Return label of reference data source (None if no reference is provided / available) """
+    ref_data_source_name = None
+    if AnalysisElement._global_config['reference']:
+        for source, datestr in AnalysisElement._global_config['reference'].items():
+            ref_data_source_name = "{}.{}".format(source, datestr)
+        if ref_data_source_name not in AnalysisElement.data_source_labels:
+            ref_data_source_name = None
+    return ref_data_source_name
+
+def _get_grid_fields(AnalysisElement, ds_names):
+    """ Return TAREA, TLONG, and TLAT of every data source (from field_store if possible) """
+    store = AnalysisElement.field_store
+    grid_fields = dict()
+    for ds_name in ds_names:
+        grid_fields[ds_name] = dict()
+        for var_name in ['TAREA', 'TLONG', 'TLAT']:
+            if store and store.has_grid_field(ds_name, var_name):
+                grid_fields[ds_name][var_name] = store.get_grid_field(ds_name, var_name)
+            else:
+                grid_fields[ds_name][var_name] = _get_static_field(AnalysisElement.data_sources[ds_name].ds,
+                                                                   var_name).load()
+                if store:
+                    store.put_grid_field(ds_name, var_name, grid_fields[ds_name][var_name])
+    if store:
+        store.flush()
+    return grid_fields
+
+def _get_reduced_fields(AnalysisElement, v, ds_names, ref_data_source_name, time_weights, depth_coord_name,
+                        grid_fields):
+    """
+    Return climo_fields, diff_fields, and stats for variable v; climo_fields[ds_name][depth_str]
+    is a (period, ocean_point) field (None if v is not in ds_name, see _reduce_climo_fields),
+    diff_fields[ds_name] has the same layout for ds_name - reference (None if there is no difference
+    to plot), and stats[field_name][depth_str][time_period] is (min, max, mean, RMS) of every field
+    that is plotted (None if stats are not in the title). Sources on the same grid are stacked along
+    a source dimension so differences and stats are computed with one vectorized operation per level
+    rather than one per source; fields stay on ocean points until they are plotted.
+    Fields are read from AnalysisElement.field_store if possible, and written to it otherwise
+    (inside the diagnostics server, fields are also kept in AnalysisElement.resident_cache).
+    """
+    store = AnalysisElement.field_store
+    resident_cache = AnalysisElement.resident_cache
+    depth_strs = [_get_depth_indexer(sel_z, depth_coord_name)[2] for sel_z in AnalysisElement._global_config['levels']]
+    time_periods = AnalysisElement._global_config['climo_time_periods']
+
+    def in_store(field_name):
+        for depth_str in depth_strs:
+            for time_period in time_periods:
+                if not store.has_field(field_name, v, time_period, depth_str):
+                    return False
+        return True
+
+    def read_from_store(field_name):
+        fields = dict()
+        for depth_str in depth_strs:
+            fields[depth_str] = xr.concat([store.get_field(field_name, v, time_period, depth_str)
+                                           for time_period in time_periods],
+                                          dim='period').assign_coords(period=time_periods)
+        return fields
+
+    def write_to_store(field_name, fields):
+        for depth_str in depth_strs:
+            for time_period in time_periods:
+                store.put_field(field_name, v, time_period, depth_str,
+                                fields[depth_str].sel(period=time_period, drop=True))
+
+    climo_fields = dict()
+    for ds_name in ds_names:
+        if store and in_store(ds_name):
+            AnalysisElement.logger.debug('Reading %s fields for %s from %s', v, ds_name, store.store_dir)
+            climo_fields[ds_name] = None if store.is_missing(ds_name, v) else read_from_store(ds_name)
+            continue
+        # (fields are wrapped in a dictionary because None means v is not in ds_name)
+        resident_key = None
+        resident_fields = None
+        if resident_cache is not None and hasattr(AnalysisElement.data_sources[ds_name], '_resident_key'):
+            resident_key = (AnalysisElement.data_sources[ds_name]._resident_key,
+                            v, tuple(depth_strs), tuple(time_periods),
+                            AnalysisElement._global_config['vertical_interp'])
+            resident_fields = resident_cache.get_reduced_fields(resident_key)
+        if resident_fields is not None:
+            AnalysisElement.logger.debug('Using resident %s fields for %s', v, ds_name)
+            climo_fields[ds_name] = resident_fields['fields']
+        else:
+            climo_fields[ds_name] = _reduce_climo_fields(AnalysisElement, ds_name, v,
+                                                         time_weights[ds_name], depth_coord_name)
+            if resident_key:
+                resident_cache.put_reduced_fields(resident_key, {'fields': climo_fields[ds_name]},
+                                                  _reduced_fields_nbytes(climo_fields[ds_name]))
+        if store:
+            if climo_fields[ds_name] is None:
+                store.put_missing(ds_name, v)
+            else:
+                write_to_store(ds_name, climo_fields[ds_name])
+
+    # preview: differences, stats and plots use fields averaged over blocks of cells
+    # (fields in the store and resident cache are kept at full resolution)
+    preview = AnalysisElement._global_config['preview']
+    if preview:
+        for ds_name in ds_names:
+            if climo_fields[ds_name] is not None:
+                climo_fields[ds_name] = _get_preview_fields(AnalysisElement, climo_fields[ds_name],
+                                                            grid_fields[ds_name]['TAREA'].values)
+        grid_fields = _get_preview_grid_fields(AnalysisElement, grid_fields)
+
+    # (source, period, ocean_point) arrays of every group of same-grid sources (and their areas), by level
+    stacked_fields = dict()
+    for depth_str in depth_strs:
+        stacked_fields[depth_str] = _stack_fields(climo_fields, depth_str, grid_fields)
+
+    # differences from reference: one subtraction for all sources on the reference grid
+    diff_fields = dict.fromkeys(ds_names)
+    stacked_diffs = dict()
+    for depth_str in depth_strs:
+        stacked_diffs[depth_str] = []
+    if ref_data_source_name and AnalysisElement._global_config['plot_diff_from_reference'] and \
+       climo_fields[ref_data_source_name] is not None:
+        for depth_str in depth_strs:
+            for fields, area in stacked_fields[depth_str]:
+                if ref_data_source_name not in fields.source.values or fields.sizes['source'] == 1:
+                    continue
+                others = fields.drop_sel(source=ref_data_source_name)
+                diffs = others - fields.sel(source=ref_data_source_name, drop=True)
+                for ds_name in others.source.values:
+                    if diff_fields[ds_name] is None:
+                        diff_fields[ds_name] = dict()
+                    diff_fields[ds_name][depth_str] = diffs.sel(source=ds_name, drop=True)
+                diff_names = ['{} - {}'.format(ds_name, ref_data_source_name) for ds_name in others.source.values]
+                stacked_diffs[depth_str].append((diffs.assign_coords(source=diff_names),
+                                                 area.drop_sel(source=ref_data_source_name).assign_coords(source=diff_names)))
+        if store and not preview:
+            for ds_name in ds_names:
+                diff_name = '{} - {}'.format(ds_name, ref_data_source_name)
+                if diff_fields[ds_name] is not None and not in_store(diff_name):
+                    write_to_store(diff_name, diff_fields[ds_name])
+
+    # min, max, mean and RMS of every field and difference, one computation per group of sources
+    stats = dict()
+    field_names = list(ds_names)
+    if ref_data_source_name:
+        field_names += ['{} - {}'.format(ds_name, ref_data_source_name) for ds_name in ds_names]
+    for field_name in field_names:
+        stats[field_name] = dict()
+        for depth_str in depth_strs:
+            stats[field_name][depth_str] = dict.fromkeys(time_periods)
+    if AnalysisElement._global_config['stats_in_title']:
+        for depth_str in depth_strs:
+            for fields, area in stacked_fields[depth_str] + stacked_diffs[depth_str]:
+                fmin, fmax, fmean, fRMS = _compute_stats(fields, area)
+                for n, field_name in enumerate(fields.source.values):
+                    for m, time_period in enumerate(time_periods):
+                        stats[field_name][depth_str][time_period] = (fmin[n, m], fmax[n, m], fmean[n, m], fRMS[n, m])
+
+    if store:
+        store.flush()
+    return climo_fields, diff_fields, stats
+
+def _get_preview_grid_fields(AnalysisElement, grid_fields):
+    """
+    Return TAREA, TLONG, and TLAT of blocks of preview_coarsen_factor x preview_coarsen_factor
+    cells for every data source in grid_fields (grid_fields itself if not in preview mode)
+    """
+    if not AnalysisElement._global_config['preview']:
+        return grid_fields
+    factor = AnalysisElement._global_config['preview_coarsen_factor']
+    preview_grid_fields = dict()
+    for ds_name, fields in grid_fields.items():
+        coarse = gt.coarsen_grid(AnalysisElement._global_config['grid'], fields['TLONG'].values,
+                                 fields['TLAT'].values, fields['TAREA'].values, factor)
+        preview_grid_fields[ds_name] = dict()
+        for var_name, values in zip(['TLONG', 'TLAT', 'TAREA'], coarse):
+            preview_grid_fields[ds_name][var_name] = xr.DataArray(values, dims=fields[var_name].dims,
+                                                                  attrs=fields[var_name].attrs)
+    return preview_grid_fields
+
+def _get_preview_fields(AnalysisElement, fields, area):
+    """
+    Return fields[depth_str] ((period, ocean_point) DataArrays) averaged (weighted by area) over
+    blocks of preview_coarsen_factor x preview_coarsen_factor cells, on the ocean points of the
+    coarse grid (blocks with any valid cell)
+    """
+    factor = AnalysisElement._global_config['preview_coarsen_factor']
+    preview_fields = dict()
+    for depth_str, field in fields.items():
+        values = gt.expand_from_ocean_points(field.values, field['ocean_point'].values, area.shape)
+        coarse = np.stack([gt.coarsen_field(period_values, area, factor) for period_values in values])
+        points = np.flatnonzero(np.isfinite(coarse).any(axis=0))
+        preview_fields[depth_str] = xr.DataArray(gt.compress_to_ocean_points(coarse, points), dims=field.dims,
+                                                 coords={'period': field['period'].values, 'ocean_point': points},
+                                                 name=field.name, attrs=field.attrs)
+    return preview_fields
+
+def _stack_fields(climo_fields, depth_str, grid_fields):
+    """
+    Return list of ((source, period, ocean_point) DataArray, (source, ocean_point) TAREA) holding the
+    depth_str fields in climo_fields, one for every group of sources that share a grid (sources where
+    v is missing are left out); fields of a group that are on different ocean points (e.g. a data
+    source without KMT) are aligned on the union of their points
+    """
+    groups = dict()
+    for ds_name, fields in climo_fields.items():
+        if fields is None:
+            continue
+        groups.setdefault(grid_fields[ds_name]['TAREA'].shape, []).append(ds_name)
+
+    stacked_fields = []
+    for group_names in groups.values():
+        fields = xr.concat([climo_fields[ds_name][depth_str] for ds_name in group_names],
+                           dim='source', join='outer').assign_coords(source=group_names)
+        points = fields['ocean_point'].values
+        area = np.stack([gt.compress_to_ocean_points(grid_fields[ds_name]['TAREA'].values, points)
+                         for ds_name in group_names])
+        stacked_fields.append((fields, xr.DataArray(area, dims=('source', 'ocean_point'),
+                                                    coords={'source': group_names, 'ocean_point': points})))
+    return stacked_fields
+
+def _on_ocean_points(field, points):
+    """ Return field ((..., ocean_point) DataArray) at points, with NaN at points where it has no value """
+    if np.array_equal(field['ocean_point'].values, points):
+        return field
+    return field.reindex(ocean_point=points)
+
+def _get_time_period_weights(data_source, time_periods):
+    """
+    Return (period x time) DataArray of weights such that contracting it with a climatology
+    over time gives the mean over every time period in time_periods at once. Each month is
+    weighted by its length (from time_bound) so seasonal and annual means are exact.
+    """
+    ntime = data_source.ds.dims['time']
+    if ntime == 1:
+        # Annual climatology: only the annual mean is available
+        for time_period in time_periods:
+            if time_period != 'ANN':
+                raise KeyError("'{}' is not a known time period for annual climatology".format(time_period))
+        return xr.DataArray(np.ones((len(time_periods), 1)), dims=('period', 'time'),
+                            coords={'period': time_periods})
+
+    try:
+        tb_name, tb_dim = data_source._time_bound_var()
+        days_per_month = data_source.ds[tb_name].diff(tb_dim).values.reshape(-1)
+    except (ValueError, KeyError):
+        days_per_month = np.array(NOLEAP_DAYS_PER_MONTH, dtype=np.float64)
+
+    weights = np.zeros((len(time_periods), ntime))
+    for n, time_period in enumerate(time_periods):
+        if time_period not in CLIMO_TIME_PERIODS:
+            raise KeyError("'{}' is not a known time period".format(time_period))
+        months = CLIMO_TIME_PERIODS[time_period]
+        weights[n, months] = days_per_month[months] / np.sum(days_per_month[months])
+    return xr.DataArray(weights, dims=('period', 'time'), coords={'period': time_periods})
+
+def _reduce_climo_fields(AnalysisElement, ds_name, v, time_weights, depth_coord_name):
+    """
+    Return dictionary of (period, ocean_point) DataArrays of variable v from data source ds_name,
+    keyed by the depth_str of each requested level; each level is reduced to all time periods
+    with a single contraction with time_weights, on ocean points only (the ocean_point coordinate
+    holds the flattened index of each point on the 2D grid, see grid_tools.get_ocean_points).
+    Levels are read in blocks of rows of at most max_block_mb, so a level (or range of levels) of
+    a high-resolution grid is never in memory all at once. If vertical_interp is True, single
+    depths are blended from the two bracketing levels. Returns None if variable is not in data source.
+    """
+    data_source = AnalysisElement.data_sources[ds_name]
+    # Find appropriate variable name in dataset or move to next dataset
+    if v not in data_source._var_dict:
+        AnalysisElement.logger.info('Can not find %s in %s, skipping plot', v, ds_name)
+        return None
+    var_name = data_source._var_dict[v]
+    if var_name not in data_source.ds:
+        AnalysisElement.logger.info('Can not find %s in %s, skipping plot', var_name, ds_name)
+        return None
+
+    # Ocean points of each level are the cells where its shallowest level is active according to
+    # KMT; data sources without KMT (e.g. observations) use the cells where the first field read
+    # at that level has data in the first time level
+    TAREA = _get_static_field(data_source.ds, 'TAREA')
+    ny, nx = TAREA.shape
+    kmt = None
+    if 'KMT' in data_source.ds:
+        kmt = _get_static_field(data_source.ds, 'KMT').values
+    level_indices = xr.DataArray(np.arange(data_source.ds.sizes[depth_coord_name]), dims=depth_coord_name,
+                                 coords={depth_coord_name: data_source.ds.indexes[depth_coord_name]})
+    max_bytes = AnalysisElement._global_config['max_block_mb'] * 1024.**2
+    interp_weights = None
+    if AnalysisElement._global_config['vertical_interp']:
+        interp_weights = gt.vertical_interp_weights(AnalysisElement._global_config['grid'],
+                                                    data_source.ds[depth_coord_name].values,
+                                                    [sel_z for sel_z in AnalysisElement._global_config['levels']
+                                                     if not isinstance(sel_z, list)])
+    climo_fields = dict()
+    for sel_z in AnalysisElement._global_config['levels']:
+        indexer, is_depth_range, depth_str = _get_depth_indexer(sel_z, depth_coord_name)
+        interp_weight = None
+        if interp_weights is not None and not is_depth_range:
+            # read the two levels bracketing sel_z (blended below, block by block)
+            k0, k1, interp_weight = interp_weights[sel_z]
+            field = data_source.ds[var_name].isel({depth_coord_name: [k0, k1]})
+            level = k0
+        else:
+            field = data_source.ds[var_name].sel(**indexer)
+            # (index of the shallowest level read: the same selection applied to the level indices)
+            level = int(level_indices.sel(**indexer).min())
+        if kmt is None:
+            level = (ds_name, depth_str, interp_weight is not None)
+        points = gt.get_ocean_points(AnalysisElement._global_config['grid'], (ny, nx), level, kmt=kmt)
+        valid = None
+        if points is None:
+            valid = np.zeros((ny, nx), dtype=bool)
+
+        field = field.transpose(*([dim for dim in field.dims if dim not in TAREA.dims] + list(TAREA.dims)))
+        rows_per_block = int(max(1, max_bytes // (8 * nx * np.prod(field.shape[:-2]))))
+        reduced = []
+        for row_start in range(0, ny, rows_per_block):
+            rows = slice(row_start, min(row_start + rows_per_block, ny))
+            block = field[..., rows, :].values
+            if interp_weight is not None:
+                block = _blend_levels(block, interp_weight)
+            if valid is None:
+                # (points are increasing, so the points of these rows are contiguous)
+                block_points = points[np.searchsorted(points, rows.start * nx):
+                                      np.searchsorted(points, rows.stop * nx)] - rows.start * nx
+            else:
+                valid[rows] = np.isfinite(block[0]) if not is_depth_range else np.isfinite(block[0]).any(axis=0)
+                block_points = np.flatnonzero(valid[rows])
+            block_reduced = np.tensordot(time_weights.values, gt.compress_to_ocean_points(block, block_points),
+                                         axes=(1, 0))
+            del block
+            if is_depth_range:
+                with np.errstate(invalid='ignore'):
+                    block_reduced = np.nanmean(block_reduced, axis=1)
+            reduced.append(block_reduced)
+        if valid is not None:
+            points = gt.get_ocean_points(AnalysisElement._global_config['grid'], (ny, nx), level, valid=valid)
+        climo_fields[depth_str] = xr.DataArray(np.concatenate(reduced, axis=-1), dims=('period', 'ocean_point'),
+                                               coords={'period': time_weights.period.values, 'ocean_point': points},
+                                               name=var_name)
+    return climo_fields
+
+def _blend_levels(block, weight):
+    """
+    Linear interpolation between two levels: block is (time, 2, y, x); returns (time, y, x). Where
+    only one of the levels is ocean (e.g. the lower level is below the sea floor), that level is used.
+    """
+    upper = block[:, 0]
+    lower = block[:, 1]
+    blended = (1. - weight) * upper + weight * lower
+    return np.where(np.isnan(lower), upper, np.where(np.isnan(upper), lower, blended))
+
+def _reduced_fields_nbytes(fields):
+    """ Memory used by (nested dictionaries / tuples of) fields, e.g. output of _get_reduced_fields() """
+    if fields is None:
+        return 0
+    if isinstance(fields, dict):
+        fields = list(fields.values())
+    if isinstance(fields, (list, tuple)):
+        return sum([_reduced_fields_nbytes(field) for field in fields])
+    return fields.nbytes
+
+def _prefetch(func, keys, lookahead, max_mb, nbytes_func):
+    """
+    Generator that yields (key, func(key)) for every key in keys. While the caller works on
+    one key, func is evaluated for up to lookahead upcoming keys in a background thread;
+    nothing new is started if it would take results waiting to be consumed over max_mb MB
+    (results that are still being computed are assumed to be as large as the latest result).
+    """
+    keys = list(keys)
+    if lookahead < 1:
+        for key in keys:
+            yield key, func(key)
+        return
+
+    pending = dict()
+    max_bytes = max_mb * 1024 * 1024
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for n, key in enumerate(keys):
+            if n not in pending:
+                pending[n] = executor.submit(func, key)
+            result = pending.pop(n).result()
+
+            # Queue up upcoming keys (subject to memory cap) before handing result back
+            result_bytes = nbytes_func(result)
+            for m in range(n+1, min(n+1+lookahead, len(keys))):
+                if m in pending:
+                    continue
+                waiting_bytes = result_bytes
+                for future in pending.values():
+                    if not future.done():
+                        waiting_bytes += result_bytes
+                    elif future.exception() is None:
+                        waiting_bytes += nbytes_func(future.result())
+                if waiting_bytes + result_bytes > max_bytes:
+                    break
+                pending[m] = executor.submit(func, keys[m])
+            yield key, result
+
+def _get_depth_indexer(sel_z, depth_coord_name):
+    """ Return indexer for depth, whether it is a range of depths, and a string for plot names """
+    if isinstance(sel_z, list): # fragile?
+        is_depth_range = True
+        indexer = {depth_coord_name:slice(sel_z[0], sel_z[1])}
+        depth_str = '{:.0f}-{:.0f}m'.format(sel_z[0], sel_z[1])
+    else:
+        is_depth_range = False
+        indexer = {depth_coord_name: sel_z, 'method': 'nearest'}
+        depth_str = '{:.0f}m'.format(sel_z)
+    return indexer, is_depth_range, depth_str
 
 def _compute_stats(field, TAREA):
-    fmin = np.nanmin(field)
-    fmax = np.nanmax(field)
-    fmean = esmlab.statistics.weighted_mean(field, dim=field.dims, weights=TAREA).load().values
-    fRMS = np.sqrt(esmlab.statistics.weighted_mean(field*field, dim=field.dims, weights=TAREA).load().values)
+    """ Stats are reduced over the dims of TAREA (any other dims of field, e.g. source and period, are kept) """
+    dims = [dim for dim in field.dims if dim in TAREA.dims and dim != 'source']
+    fmin = field.min(dims).values
+    fmax = field.max(dims).values
+    fmean = esmlab.statistics.weighted_mean(field, dim=dims, weights=TAREA).load().values
+    fRMS = np.sqrt(esmlab.statistics.weighted_mean(field*field, dim=dims, weights=TAREA).load().values)
     return fmin, fmax, fmean, fRMS
 
-def _gen_plot_panel(ax, title_str, field, TAREA, stats_in_title):
+def _gen_plot_panel(ax, title_str, field, TAREA, stats_in_title, stats=None):
+    """ stats is (min, max, mean, RMS) of field if already computed """
     ax.background_patch.set_facecolor('gray')
     if stats_in_title:
         # TAREA is needed for weighted means
         if 'time' in TAREA.dims:
             TAREA = TAREA.isel(time=0)
-        fmin, fmax, fmean, fRMS = _compute_stats(field, TAREA)
+        if stats is None:
+            if 'ocean_point' in field.dims and 'ocean_point' not in TAREA.dims:
+                TAREA = xr.DataArray(gt.compress_to_ocean_points(TAREA.values, field['ocean_point'].values),
+                                     dims='ocean_point', coords={'ocean_point': field['ocean_point'].values})
+            stats = _compute_stats(field, TAREA)
+        fmin, fmax, fmean, fRMS = stats
         title_str = "{}\nMin: {:.2f}, Max: {:.2f}\nMean: {:.2f}, RMS: {:.2f}".format(
             title_str, fmin, fmax, fmean, fRMS)
     ax.set_title(title_str)
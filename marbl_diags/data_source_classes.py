@@ -3,9 +3,14 @@
 import glob
 import logging
 import os
+import re
 import json
+import numpy as np
 import xarray as xr
-from .generic_classes import GenericDataSource
+from .generic_classes import GenericDataSource, NOLEAP_DAYS_PER_MONTH
+from . import file_catalog
+from . import grid_tools
+from . import manifests
 
 ######################################################################
 
@@ -21,7 +26,11 @@ class CachedClimoData(GenericDataSource):
         self._is_ann_climo = False
         self._is_mon_climo = True
         if data_type == 'zarr':
-            self.ds = xr.open_zarr(data_root, decode_times=False, decode_coords=False) # pylint: disable=invalid-name
+            # caches written by cache_dataset() have consolidated metadata, so only one file needs
+            # to be read to open the store; data is only read for levels that are plotted
+            consolidated = os.path.exists(os.path.join(data_root, '.zmetadata'))
+            self.ds = xr.open_zarr(data_root, decode_times=False, decode_coords=False, # pylint: disable=invalid-name
+                                   consolidated=consolidated)
 
     def _set_var_dict(self):
         if not os.path.exists(self._var_dict_in):
@@ -40,8 +49,18 @@ class CachedClimoData(GenericDataSource):
 
 class CESMData(GenericDataSource):
     """ Class built around reading CESM history files """
-    def __init__(self, variables, operation, datestr_in, **kwargs):
+    def __init__(self, variables, operation, datestr_in, catalog_dir=None, manifest_dir=None,
+                 build_manifests=False, **kwargs):
         super(CESMData, self).__init__(child_class='CESMData', **kwargs)
+        # if catalog_dir is provided, files are found by querying a FileCatalog instead of globbing
+        self._catalog_dir = catalog_dir
+        # if manifest_dir is provided, multi-file datasets are opened from reference manifests
+        # (manifests that do not exist are written first if build_manifests is True)
+        self._manifest_dir = manifest_dir
+        self._build_manifests = build_manifests
+        # output on high-resolution grids is opened with small dask chunks, so climatologies
+        # are computed (and cached) without reading whole 3D fields into memory
+        self._open_chunks = grid_tools.KNOWN_GRIDS.get(kwargs.get('grid'), dict()).get('open_chunks')
         gdargs = dict()
         gdargs['variables'] = variables
         # Set filetype depending on requested operation
@@ -52,8 +71,29 @@ class CESMData(GenericDataSource):
                 gdargs['filetype'] = 'mon_climo'
             elif "single_variable" in kwargs['dataset_format']:
                 gdargs['filetype'] = 'single_variable'
+            elif "time_series" in kwargs['dataset_format']:
+                gdargs['filetype'] = 'time_series'
             else:
                 raise ValueError("Can not find appropriate filetype for %s", operation)
+        elif operation == "mon_climo":
+            if "mon_climo" in kwargs['dataset_format']:
+                gdargs['filetype'] = 'mon_climo'
+            elif "single_variable" in kwargs['dataset_format']:
+                gdargs['filetype'] = 'single_variable'
+            elif "time_series" in kwargs['dataset_format']:
+                gdargs['filetype'] = 'time_series'
+            else:
+                raise ValueError("Can not find appropriate filetype for %s", operation)
+        elif operation is None:
+            # operations that do not act on a climatology need the full time series
+            if "single_variable" in kwargs['dataset_format']:
+                gdargs['filetype'] = 'single_variable'
+            elif "time_series" in kwargs['dataset_format']:
+                gdargs['filetype'] = 'time_series'
+            elif "hist" in kwargs['dataset_format']:
+                gdargs['filetype'] = 'hist'
+            else:
+                raise ValueError("Can not find time series filetype in dataset_format")
         else:
             raise ValueError("'%s' is an unknown operation", operation)
         for key in kwargs['dataset_format'][gdargs['filetype']]:
@@ -78,6 +118,8 @@ class CESMData(GenericDataSource):
     def _get_dataset(self, filetype, dirin, case, stream, datestr, variables):
         """ docstring """
         xr_open_ds = {'decode_coords' : False, 'decode_times' : False, 'data_vars' : 'minimal'}
+        if self._open_chunks:
+            xr_open_ds['chunks'] = self._open_chunks
         if isinstance(datestr, str):
             datestr = [datestr]
 
@@ -88,13 +130,13 @@ class CESMData(GenericDataSource):
             file_name_pattern = []
             for date_str in datestr:
                 file_name_pattern.append('{}/{}.{}.{}.nc'.format(dirin, case, stream, date_str))
-            self._list_files(file_name_pattern)
+            self._list_files(file_name_pattern, case=case, stream=stream)
 
             self.logger.debug('Opening %d files: ', len(self._files))
             for n, file_name in enumerate(self._files): # pylint: disable=invalid-name
                 self.logger.debug('%d: %s', n+1, file_name)
 
-            self.ds = xr.open_mfdataset(self._files, **xr_open_ds)
+            self.ds = self._open_files(xr_open_ds)
 
             tb_name = ''
             if 'bounds' in self.ds['time'].attrs:
@@ -132,7 +174,7 @@ class CESMData(GenericDataSource):
             for n, file_name in enumerate(self._files): # pylint: disable=invalid-name
                 self.logger.debug('%d: %s', n+1, file_name)
 
-            self.ds = xr.open_mfdataset(self._files, **xr_open_ds)
+            self.ds = self._open_files(xr_open_ds)
 
             tb_name = ''
             if 'bounds' in self.ds['time'].attrs:
@@ -163,8 +205,38 @@ class CESMData(GenericDataSource):
                 for date_str in datestr:
                     file_name_pattern.append('{}/{}.{}.{}.{}.nc'.format(
                         dirin, case, stream, self._var_dict[variable], date_str))
-                self._list_files(file_name_pattern)
-                self.ds = xr.merge((self.ds, xr.open_mfdataset(self._files, **xr_open_ds)))
+                self._list_files(file_name_pattern, case=case, stream=stream,
+                                 variables=[self._var_dict[variable]])
+                self.ds = xr.merge((self.ds, self._open_files(xr_open_ds)))
+
+        elif filetype == 'time_series':
+
+            # multi-decade files with one variable each (proc/tseries): datestr is a range of years
+            # (e.g. 0043-0062); only files whose time_bound overlaps it are opened (checked against
+            # the time range stored in the file catalog, if there is one), only time levels inside
+            # it are kept, and data is chunked by year so climatologies and regional means are
+            # computed one year at a time
+            self._is_ann_climo = False
+            self._is_mon_climo = False
+            year_ranges = [_parse_year_range(date_str) for date_str in datestr]
+            xr_open_ds['chunks'] = dict(xr_open_ds.get('chunks') or dict(), time=12)
+            self.ds = xr.Dataset()
+            for variable in variables:
+                file_name_pattern = ['{}/{}.{}.{}.*.nc'.format(dirin, case, stream, self._var_dict[variable])]
+                self._list_files(file_name_pattern, case=case, stream=stream,
+                                 variables=[self._var_dict[variable]])
+                time_ranges = dict()
+                if self._catalog_dir:
+                    with file_catalog.FileCatalog(dirin, self._catalog_dir) as catalog:
+                        time_ranges = catalog.get_time_ranges(self._files)
+                self._files = [file_name for file_name in self._files
+                               if self._file_overlaps_years(file_name, year_ranges, time_ranges.get(file_name))]
+                if not self._files:
+                    raise ValueError('No files with years %s: %s' % (datestr, file_name_pattern))
+                self.logger.debug('Opening %d files for %s', len(self._files), variable)
+                ds = self._open_files(xr_open_ds)
+                in_window = _in_year_ranges(_time_bound_years(ds), year_ranges)
+                self.ds = xr.merge((self.ds, ds.isel(time=np.flatnonzero(in_window))))
 
         else:
             raise ValueError('Unknown format: %s' % filetype)
@@ -172,16 +244,64 @@ class CESMData(GenericDataSource):
         # should this method handle making the 'time' variable functional?
         # (i.e., take mean of time_bound, convert to date object)
 
-    def _list_files(self, glob_pattern):
-        '''Glob for files and check that some were found.'''
+    def _open_files(self, xr_open_ds):
+        '''
+        Open self._files as one dataset: from a reference manifest if one exists in manifest_dir
+        (or build_manifests is True), otherwise with open_mfdataset
+        '''
+        if self._manifest_dir:
+            manifest_file = manifests.get_manifest_file(self._manifest_dir, self._files)
+            if not os.path.exists(manifest_file) and self._build_manifests:
+                manifests.build_manifest(self._files, manifest_file)
+            if os.path.exists(manifest_file):
+                return manifests.open_manifest(manifest_file, decode_times=xr_open_ds['decode_times'],
+                                               decode_coords=xr_open_ds['decode_coords'],
+                                               chunks=xr_open_ds.get('chunks'))
+            self.logger.debug('No manifest for these files in %s', self._manifest_dir)
+        return xr.open_mfdataset(self._files, **xr_open_ds)
+
+    def _list_files(self, glob_pattern, case=None, stream=None, variables=None):
+        '''
+        Glob for files and check that some were found. If there is a file catalog, query
+        it instead; if no file names match and the pattern ends in a range of years
+        (e.g. 0033-0052.nc), the catalog is also searched for files from case and stream
+        in that range of years (restricted to files containing variables).
+        '''
 
         self._files = []
         for glob_pat in glob_pattern:
-            self.logger.debug('glob file search: %s', glob_pat)
-            self._files += sorted(glob.glob(glob_pat))
+            if self._catalog_dir:
+                self.logger.debug('catalog file search: %s', glob_pat)
+                with file_catalog.FileCatalog(os.path.dirname(glob_pat), self._catalog_dir) as catalog:
+                    files = catalog.find_files(os.path.basename(glob_pat), variables)
+                    year_range = re.search(r'\.(\d{4})-(\d{4})\.nc$', glob_pat)
+                    if not files and year_range and case and stream:
+                        files = catalog.find_files_in_range(case, stream, int(year_range.group(1)),
+                                                            int(year_range.group(2)), variables)
+                self._files += files
+            else:
+                self.logger.debug('glob file search: %s', glob_pat)
+                self._files += sorted(glob.glob(glob_pat))
         if not self._files:
             raise ValueError('No files: %s' % glob_pattern)
 
+    def _file_overlaps_years(self, file_name, year_ranges, time_range=None):
+        """
+        Check if any time level of file_name is in year_ranges: from time_range, (time_start,
+        time_end) of the file in the file catalog (days since 0001-01-01, noleap calendar), if
+        known; otherwise only time_bound of file_name is read
+        """
+        if time_range is not None:
+            time_start, time_end = time_range
+            overlaps = any([time_start < 365. * last_year and time_end > 365. * (first_year - 1)
+                            for first_year, last_year in year_ranges])
+        else:
+            with xr.open_dataset(file_name, decode_times=False, decode_coords=False) as ds:
+                overlaps = _in_year_ranges(_time_bound_years(ds), year_ranges).any()
+        if not overlaps:
+            self.logger.debug('Skipping %s: outside of years %s', file_name, year_ranges)
+        return overlaps
+
     def _set_var_dict(self):
         self._var_dict = dict()
         self._var_dict['nitrate'] = 'NO3'
@@ -196,12 +316,21 @@ class CESMData(GenericDataSource):
 
 class WOAData(GenericDataSource):
     """ Class built around reading World Ocean Atlas 2013 reanalysis """
-    def __init__(self, var_dict, **kwargs):
+    def __init__(self, var_dict, climo=None, catalog_dir=None, **kwargs):
         super(WOAData, self).__init__(child_class='WOAData', **kwargs)
+        # if catalog_dir is provided, files are checked against a FileCatalog instead of the file system
+        self._catalog_dir = catalog_dir
         self._set_woa_names()
         gdargs = dict()
-        gdargs['freq'] = 'ann'
-        climo_type = '{}_climo'.format(gdargs['freq'])
+        # (1) monthly climatologies come from the 12 monthly or 4 seasonal files in mon_climo;
+        # (2) everything else (or data sources without mon_climo) uses the annual files
+        if climo == 'mon_climo' and 'mon_climo' in kwargs:
+            climo_type = 'mon_climo'
+            gdargs['freq'] = kwargs['mon_climo'].get('freq', 'mon')
+        else:
+            climo_type = 'ann_climo'
+            gdargs['freq'] = 'ann'
+        self._freq = gdargs['freq']
         gdargs['grid'] = kwargs['grid']
         gdargs['dirin'] = kwargs[climo_type]['dirin']
         if 'filename' in kwargs[climo_type]:
@@ -247,22 +376,35 @@ class WOAData(GenericDataSource):
             self.ds = xr.open_dataset(self._files, decode_times=False)
             self.ds.rename({'depth': 'z_t'}, inplace=True)
         else:
-            self.ds = xr.Dataset()
+            # (1) list files of every variable (one file per variable and month / season)
+            var_files = []
+            file_vars = dict()
             for varname_generic, varname in self._var_dict.items():
                 v = self._woa_names[varname_generic] # pylint: disable=invalid-name
-
                 self._list_files(dirin=dirin, v=v, freq=freq, grid=grid)
-                dsi = xr.open_mfdataset(self._files, decode_times=False)
-
+                var_files.append(self._files)
+                for file_in in self._files:
+                    file_vars[os.path.basename(file_in)] = (v, varname)
+            self._files = [f for files in var_files for f in files]
+
+            # (2) open all files concurrently, then concatenate along time (inner lists) and
+            #     merge variables (outer list) in a single step
+            def _conform(dsi):
+                """ Rename {v}_an to varname and drop the other WOA statistics of v """
+                v, varname = file_vars[os.path.basename(dsi.encoding['source'])] # pylint: disable=invalid-name
                 if '{}_an'.format(v) in dsi.variables and varname != '{}_an'.format(v):
-                    dsi.rename({'{}_an'.format(v):varname}, inplace=True)
-
-                dsi = dsi.drop([k for k in dsi.variables if '{}_'.format(v) in k])
-
-                if self.ds.variables:
-                    self.ds = xr.merge((self.ds, dsi))
-                else:
-                    self.ds = dsi
+                    dsi = dsi.rename({'{}_an'.format(v):varname})
+                return dsi.drop([k for k in dsi.variables if '{}_'.format(v) in k])
+            self.logger.debug('Reading %d WOA files', len(self._files))
+            self.ds = xr.open_mfdataset(var_files, combine='nested', concat_dim=[None, 'time'],
+                                        parallel=True, preprocess=_conform, decode_times=False,
+                                        data_vars='minimal', coords='minimal', compat='override')
+
+            # (3) seasonal files cover three months each
+            if freq == 'seas':
+                self.ds = self.ds.isel(time=np.repeat(np.arange(4), 3))
+            if freq in ['mon', 'seas']:
+                self._set_mon_climo_time()
 
         # Unit conversion (ml/L -> mmol/m3); also shorten micromoles_per_liter
         for varname in self.ds:
@@ -279,11 +421,20 @@ class WOAData(GenericDataSource):
         if freq == 'ann':
             self._is_ann_climo = True
             self._is_mon_climo = False
-        elif freq == 'mon':
+        elif freq in ['mon', 'seas']:
             self._is_ann_climo = False
             self._is_mon_climo = True
         else:
-             raise ValueError("frequency must be 'ann' or 'mon'")
+            raise ValueError("frequency must be 'ann', 'mon', or 'seas'")
+
+    def _set_mon_climo_time(self):
+        """ Replace time axis of the 12-month climatology with noleap mid-month days and time_bound """
+        bounds = np.cumsum([0] + NOLEAP_DAYS_PER_MONTH).astype(np.float64)
+        time_attrs = {'units': 'days since 0001-01-01 00:00:00', 'calendar': 'noleap',
+                      'bounds': 'time_bound'}
+        self.ds = self.ds.assign_coords(time=('time', 0.5 * (bounds[:-1] + bounds[1:]), time_attrs))
+        self.ds['time_bound'] = (('time', 'd2'), np.stack((bounds[:-1], bounds[1:]), axis=1),
+                                 {'units': time_attrs['units'], 'calendar': 'noleap'})
 
     def _list_files(self, dirin, v, freq='ann', grid='1x1d'):
         """ docstring """
@@ -303,16 +454,25 @@ class WOAData(GenericDataSource):
                 raise ValueError('no file template defined for {}'.format(v))
 
         self._files = [os.path.join(dirin, grid, f) for f in files]
+        if self._catalog_dir:
+            with file_catalog.FileCatalog(os.path.join(dirin, grid), self._catalog_dir) as catalog:
+                missing_files = [f for f in files if not catalog.find_files(f)]
+            if missing_files:
+                raise ValueError('No files: %s' % missing_files)
 
     def compute_mon_climatology(self):
         """ WOA2013 data should already be climatology """
         pass
 
+    def should_cache(self):
+        """ Monthly climatologies are assembled from 12 (or 4) files per variable, so cache them """
+        return self._freq != 'ann'
+
 ######################################################################
 
 def woa_time_freq(freq):
     """ docstring """
-    # 13: jfm, 14: amp, 15: jas, 16: ond
+    # 13: jfm, 14: amj, 15: jas, 16: ond
 
     if freq == 'ann':
         time_freq = ['00']
@@ -320,10 +480,47 @@ def woa_time_freq(freq):
         time_freq = ['%02d' % m for m in range(1, 13)]
     elif freq == 'jfm':
         time_freq = ['13']
-    elif freq == 'amp':
+    elif freq == 'amj':
         time_freq = ['14']
     elif freq == 'jas':
         time_freq = ['15']
     elif freq == 'ond':
         time_freq = ['16']
+    elif freq == 'seas':
+        time_freq = ['13', '14', '15', '16']
+    else:
+        raise ValueError("'{}' is not a valid WOA time frequency".format(freq))
     return time_freq
+
+def _parse_year_range(datestr):
+    """ '0043-0062' => (43, 62); a single year '0043' => (43, 43) """
+    match = re.match(r'^(\d+)(?:-(\d+))?$', datestr)
+    if not match:
+        raise ValueError("time_series datestr must be a year or range of years (e.g. 0043-0062), not '{}'".format(datestr))
+    first_year = int(match.group(1))
+    return first_year, int(match.group(2)) if match.group(2) else first_year
+
+def _time_bound_years(ds):
+    """
+    Model year of every time level, from the middle of its time_bound interval (time must be
+    'days since YYYY-...' on a noleap / 365_day calendar); only time and time_bound are read
+    """
+    if 'bounds' in ds['time'].attrs:
+        tb_name = ds['time'].attrs['bounds']
+    elif 'time_bound' in ds:
+        tb_name = 'time_bound'
+    else:
+        raise ValueError('No time_bound variable found')
+    units = ds['time'].attrs.get('units', '')
+    match = re.match(r'^days since (\d+)-', units)
+    if not match or ds['time'].attrs.get('calendar', 'noleap') not in ['noleap', '365_day']:
+        raise ValueError("Can not determine years from time units '{}'".format(units))
+    midpoints = ds[tb_name].values.mean(axis=1)
+    return int(match.group(1)) + np.floor(midpoints / 365.).astype(int)
+
+def _in_year_ranges(years, year_ranges):
+    """ Boolean array, True where years falls inside any (first_year, last_year) of year_ranges """
+    in_ranges = np.zeros(np.shape(years), dtype=bool)
+    for first_year, last_year in year_ranges:
+        in_ranges |= (years >= first_year) & (years <= last_year)
+    return in_ranges
@@ -0,0 +1,160 @@
+""" Functions shared by driver.py, the diagnostics server, and its client """
+
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import yaml
+from . import analysis_class
+from .run_journal import RunJournal
+
+def get_parser():
+    """ Return parser for driver.py command line arguments """
+
+    parser = argparse.ArgumentParser(description="Generate plots based on MARBL diagnostic output",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    # Input file
+    parser.add_argument('-i', '--input_file', action='store', dest='input_file', required=True,
+                        help='YAML file defining analysis element(s) and data sources')
+    parser.add_argument('-d', '--debug', action='store_true', dest='debug', required=False,
+                        help='Write additional messages to stdout')
+    parser.add_argument('--build-manifests', action='store_true', dest='build_manifests', required=False,
+                        help='Write reference manifests (to manifest_dir) for all data sources, then exit')
+    parser.add_argument('--build-cache', action='store_true', dest='build_cache', required=False,
+                        help='Compute and write climatologies (to cache_dir) of all data sources in parallel, then exit')
+    parser.add_argument('--nprocs', action='store', dest='nprocs', type=int, default=os.cpu_count(),
+                        help='Number of processes used by --build-cache')
+    parser.add_argument('--resume', action='store_true', dest='resume', required=False,
+                        help='Skip figures, tables and analysis elements recorded in the journal by a previous run')
+    parser.add_argument('--journal', action='store', dest='journal', default=None,
+                        help='Journal of completed work (default: input file with .journal extension)')
+
+    return parser
+
+def read_input_file(input_file):
+    """
+    Read YAML input file, and the data source and variable definition files it refers to;
+    returns full_input, ds_dict, var_dict
+    """
+    with open(input_file) as file_in:
+        full_input = yaml.load(file_in, Loader=yaml.FullLoader)
+    # Check for correct keys
+    err_found = False
+    for key in ['global_config', 'data_sources', 'variable_definitions', 'analysis']:
+        if key not in full_input:
+            err_found = True
+            print("ERROR: can not find {} key in {}".format(key, input_file))
+    if err_found:
+        raise KeyError("One or more missing keys in {}".format(input_file))
+
+    # Create dictionary for data sources
+    ds_dict = dict()
+    for ds_file in full_input['data_sources']:
+        with open(ds_file) as file_in:
+            ds_dict_in = yaml.load(file_in, Loader=yaml.FullLoader)
+            for ds_name in full_input['data_sources'][ds_file]:
+                if ds_name not in ds_dict_in:
+                    raise KeyError("Can not find {} in {}".format(ds_name, ds_file))
+                if ds_name in ds_dict:
+                    raise KeyError("Data source named {} has already been processed".format(ds_name))
+                ds_dict[ds_name] = dict(ds_dict_in[ds_name])
+            del(ds_dict_in)
+
+    # Create dictionary of variables from requested files
+    with open(full_input['variable_definitions']) as file_in:
+        var_dict = yaml.load(file_in, Loader=yaml.FullLoader)
+
+    return full_input, ds_dict, var_dict
+
+def run(args, resident_cache=None):
+    """
+    Run the analysis described by args (parsed command line from get_parser());
+    resident_cache is a server.ResidentCache when running inside the diagnostics server
+    """
+    full_input, ds_dict, var_dict = read_input_file(args.input_file)
+    if args.build_manifests:
+        if not full_input['global_config'].get('manifest_dir', None):
+            raise KeyError("Must provide 'manifest_dir' in global_config to build manifests")
+        full_input['global_config']['build_manifests'] = True
+
+    if args.build_cache:
+        build_caches(full_input, ds_dict, var_dict, args.nprocs)
+        return
+
+    journal = None
+    if not args.build_manifests:
+        journal_file = args.journal
+        if journal_file is None:
+            journal_file = os.path.splitext(args.input_file)[0] + '.journal'
+        journal = RunJournal(journal_file, resume=args.resume)
+
+    try:
+        AnalysisCategories = dict()
+        for category_name, analysis_dict in full_input['analysis'].items():
+            AnalysisCategories[category_name] = \
+                analysis_class.AnalysisCategory(category_name, analysis_dict, ds_dict,
+                                                var_dict, full_input['global_config'],
+                                                resident_cache=resident_cache, journal=journal)
+
+        # Opening the data sources writes the manifests
+        if args.build_manifests:
+            logging.info('Finished building manifests')
+            return
+        failed_plots = []
+        for AnalysisCategory in AnalysisCategories.values():
+            failed_plots += AnalysisCategory.do_analysis()
+    finally:
+        if journal is not None:
+            journal.close()
+
+    if failed_plots:
+        raise RuntimeError("{} plot(s) failed: {}; fix the problem and rerun with --resume to only redo "
+                           "unfinished work".format(len(failed_plots), ', '.join(failed_plots)))
+
+def build_caches(full_input, ds_dict, var_dict, nprocs):
+    """
+    Write the climatology of every data source that analysis categories with cache_data = True
+    would read but that is not in cache_dir yet, using nprocs processes (one data source each)
+    """
+    logger = logging.getLogger('build_caches')
+    jobs = []
+    for category_name, analysis_dict in full_input['analysis'].items():
+        AnalysisCategory = analysis_class.AnalysisCategory(category_name, analysis_dict, ds_dict, var_dict,
+                                                           full_input['global_config'], open_datasets=False)
+        for data_source in AnalysisCategory.get_uncached_data_sources():
+            jobs.append((category_name, analysis_dict, data_source))
+    if not jobs:
+        logger.info('All climatologies are already cached')
+        return
+    logger.info('Caching %d climatologies with %d processes', len(jobs), min(nprocs, len(jobs)))
+
+    failures = []
+    with ProcessPoolExecutor(max_workers=min(nprocs, len(jobs))) as executor:
+        futures = dict()
+        for category_name, analysis_dict, data_source in jobs:
+            future = executor.submit(_cache_data_source, category_name, analysis_dict, ds_dict, var_dict,
+                                     full_input['global_config'], data_source, nprocs > 1)
+            futures[future] = '{} ({})'.format(data_source[1], category_name)
+        for n, future in enumerate(as_completed(futures)):
+            try:
+                logger.info('[%d/%d] Cached %s in %.1f s', n+1, len(jobs), futures[future], future.result())
+            except Exception as err: # pylint: disable=broad-except
+                logger.error('[%d/%d] Failed to cache %s: %s', n+1, len(jobs), futures[future], err)
+                failures.append(futures[future])
+    if failures:
+        raise RuntimeError("Failed to cache {}".format(', '.join(failures)))
+
+def _cache_data_source(category_name, analysis_dict, ds_dict, var_dict, global_config, data_source,
+                       single_threaded):
+    """ Worker for build_caches(); returns elapsed time (seconds) """
+    start = time.time()
+    if single_threaded:
+        # parallelism comes from the process pool, so keep dask from oversubscribing cores
+        import dask
+        dask.config.set(scheduler='single-threaded')
+    AnalysisCategory = analysis_class.AnalysisCategory(category_name, analysis_dict, ds_dict, var_dict,
+                                                       global_config, open_datasets=False)
+    AnalysisCategory.cache_data_source(*data_source)
+    return time.time() - start
@@ -0,0 +1,83 @@
+""" Statistics of ensembles that are accumulated one member at a time """
+
+import numpy as np
+
+######################################################################
+
+class EnsembleStatistics(object): # pylint: disable=useless-object-inheritance
+    """
+    Running mean, variance (Welford's algorithm), minimum and maximum of a field over ensemble
+    members, so memory use does not depend on ensemble size. Points that are NaN in a member
+    (e.g. land) do not count towards the statistics at that point.
+    """
+    def __init__(self):
+        self.nmembers = 0
+        self._count = None
+        self._mean = None
+        self._m2 = None
+        self._min = None
+        self._max = None
+
+    ###################
+    # PUBLIC ROUTINES #
+    ###################
+
+    def update(self, values):
+        """ Add one ensemble member (array with the same shape for every member) """
+        values = np.asarray(values, dtype=np.float64)
+        if self._count is None:
+            self._count = np.zeros(values.shape)
+            self._mean = np.zeros(values.shape)
+            self._m2 = np.zeros(values.shape)
+            self._min = np.full(values.shape, np.inf)
+            self._max = np.full(values.shape, -np.inf)
+        elif values.shape != self._count.shape:
+            raise ValueError("Ensemble member has shape {}, expected {}".format(values.shape, self._count.shape))
+
+        valid = np.isfinite(values)
+        values = np.where(valid, values, 0.)
+        self._count += valid
+        delta = np.where(valid, values - self._mean, 0.)
+        self._mean += delta / np.maximum(self._count, 1)
+        self._m2 += delta * (values - self._mean) * valid
+        np.fmin(self._min, np.where(valid, values, np.inf), out=self._min)
+        np.fmax(self._max, np.where(valid, values, -np.inf), out=self._max)
+        self.nmembers += 1
+
+    def expand(self, positions, size):
+        """
+        Move statistics of each point (last dimension) to positions in a layout with size points,
+        e.g. when a later member has data at points that earlier members do not have; points
+        that are not in positions have no data yet
+        """
+        if self._count is None:
+            return
+        shape = self._count.shape[:-1] + (size,)
+        for name, fill_value in [('_count', 0.), ('_mean', 0.), ('_m2', 0.), ('_min', np.inf), ('_max', -np.inf)]:
+            expanded = np.full(shape, fill_value)
+            expanded[..., positions] = getattr(self, name)
+            setattr(self, name, expanded)
+
+    def mean(self):
+        """ Ensemble mean (NaN where no member has data) """
+        return self._masked(self._mean, self._count > 0)
+
+    def std(self, ddof=1):
+        """ Ensemble standard deviation (NaN where fewer than ddof+1 members have data) """
+        return self._masked(np.sqrt(self._m2 / np.maximum(self._count - ddof, 1)), self._count > ddof)
+
+    def min(self):
+        """ Ensemble minimum """
+        return self._masked(self._min, self._count > 0)
+
+    def max(self):
+        """ Ensemble maximum """
+        return self._masked(self._max, self._count > 0)
+
+    ####################
+    # PRIVATE ROUTINES #
+    ####################
+
+    @staticmethod
+    def _masked(values, valid):
+        return np.where(valid, values, np.nan)
@@ -0,0 +1,132 @@
+""" Store of reduced fields (the fields that are actually plotted), kept as memory-mapped arrays """
+
+import logging
+import os
+import json
+import hashlib
+import threading
+from subprocess import call
+import numpy as np
+import xarray as xr
+
+######################################################################
+
+# bump when the layout of stored fields changes; stores written by another version are ignored
+STORE_VERSION = 2
+
+######################################################################
+
+class ReducedFieldStore(object): # pylint: disable=useless-object-inheritance
+    """
+    Uncompressed .npy files (read back with np.load(mmap_mode='r')) plus a small json index.
+    Fields are keyed by (data source, variable, time period, level); the index also records
+    variables that are not available in a data source, so a rerun can tell that nothing is
+    missing without opening any data. Dimension coordinates (e.g. the ocean_point indices of
+    compressed fields) are stored in files named by their content, so fields on the same
+    layout share one file.
+    """
+    def __init__(self, store_dir):
+        self.logger = logging.getLogger('ReducedFieldStore')
+        self.store_dir = store_dir
+        self._index_file = os.path.join(store_dir, 'index.json')
+        self._lock = threading.Lock()
+        if not os.path.exists(store_dir):
+            self.logger.info('creating %s', store_dir)
+            call(['mkdir', '-p', store_dir])
+        if os.path.exists(self._index_file):
+            with open(self._index_file) as file_in:
+                self._index = json.load(file_in)
+            if self._index.get('version') != STORE_VERSION:
+                self.logger.info('ignoring %s, written by a different version of the store', self._index_file)
+                self._index = dict()
+        else:
+            self._index = dict()
+        self._index['version'] = STORE_VERSION
+
+    ###################
+    # PUBLIC ROUTINES #
+    ###################
+
+    def has_field(self, ds_name, v, time_period, depth_str):
+        """ Is field (or the fact that v is not in ds_name) in the store? """
+        return self._key(ds_name, v, time_period, depth_str) in self._index or \
+               self._missing_key(ds_name, v) in self._index
+
+    def is_missing(self, ds_name, v):
+        """ Has v been recorded as not available in ds_name? """
+        return self._missing_key(ds_name, v) in self._index
+
+    def get_field(self, ds_name, v, time_period, depth_str):
+        """ Return memory-mapped field as a DataArray """
+        return self._read(self._key(ds_name, v, time_period, depth_str))
+
+    def put_field(self, ds_name, v, time_period, depth_str, field):
+        """ Write field (DataArray) to the store """
+        self._write(self._key(ds_name, v, time_period, depth_str), field)
+
+    def put_missing(self, ds_name, v):
+        """ Record that v is not available in ds_name """
+        with self._lock:
+            self._index[self._missing_key(ds_name, v)] = None
+
+    def has_grid_field(self, ds_name, var_name):
+        """ Is grid variable (e.g. TAREA) for ds_name in the store? """
+        return self._grid_key(ds_name, var_name) in self._index
+
+    def get_grid_field(self, ds_name, var_name):
+        """ Return memory-mapped grid variable as a DataArray """
+        return self._read(self._grid_key(ds_name, var_name))
+
+    def put_grid_field(self, ds_name, var_name, field):
+        """ Write grid variable (DataArray) to the store """
+        self._write(self._grid_key(ds_name, var_name), field)
+
+    def flush(self):
+        """ Write the index (atomically, so an interrupted run never leaves a corrupt index) """
+        with self._lock:
+            tmp_file = '{}.{}.tmp'.format(self._index_file, os.getpid())
+            with open(tmp_file, 'w') as file_out:
+                json.dump(self._index, file_out, separators=(',', ': '), sort_keys=True, indent=3)
+            os.replace(tmp_file, self._index_file)
+
+    ####################
+    # PRIVATE ROUTINES #
+    ####################
+
+    @staticmethod
+    def _key(ds_name, v, time_period, depth_str):
+        return '|'.join([ds_name, v, time_period, depth_str])
+
+    @staticmethod
+    def _missing_key(ds_name, v):
+        return '|'.join([ds_name, v, 'missing'])
+
+    @staticmethod
+    def _grid_key(ds_name, var_name):
+        return '|'.join([ds_name, 'grid', var_name])
+
+    def _read(self, key):
+        entry = self._index[key]
+        data = np.load(os.path.join(self.store_dir, entry['file']), mmap_mode='r')
+        coords = {dim: np.load(os.path.join(self.store_dir, file_name))
+                  for dim, file_name in entry['coords'].items()}
+        return xr.DataArray(data, dims=entry['dims'], coords=coords, name=entry['name'])
+
+    def _write(self, key, field):
+        file_name = '{}.npy'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+        self._save(file_name, field.values)
+        coords = dict()
+        for dim in field.dims:
+            if dim in field.coords:
+                values = np.ascontiguousarray(field[dim].values)
+                coords[dim] = '{}.npy'.format(hashlib.sha1(values.tobytes()).hexdigest())
+                if not os.path.exists(os.path.join(self.store_dir, coords[dim])):
+                    self._save(coords[dim], values)
+        with self._lock:
+            self._index[key] = {'file': file_name, 'dims': list(field.dims), 'coords': coords, 'name': field.name}
+
+    def _save(self, file_name, values):
+        # write to a temporary file and rename, so readers never see a partial file
+        tmp_file = os.path.join(self.store_dir, '{}.{}.tmp.npy'.format(file_name, os.getpid()))
+        np.save(tmp_file, np.ascontiguousarray(values))
+        os.replace(tmp_file, os.path.join(self.store_dir, file_name))
@@ -0,0 +1,76 @@
+"""
+Map figures that are built once and reused: setting up a figure with a grid of GeoAxes
+(projections, backgrounds, colorbar axes) costs more than contouring a field on small grids,
+so every plot with the same layout draws into the same figure, replacing only the contours,
+colorbars, and titles of the previous plot
+"""
+
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as plt
+from matplotlib.colorbar import make_axes_gridspec
+import cartopy.crs as ccrs
+
+# Projection of every map panel
+MAP_PROJECTION = ccrs.Robinson(central_longitude=305.0)
+
+######################################################################
+
+class MapFigureTemplate(object): # pylint: disable=useless-object-inheritance
+    """
+    Figure with nrow x ncol map panels; panels and colorbar axes are created the first time they
+    are used and kept (hidden when a plot does not use them). Call new_plot() before drawing each
+    plot; the figure must be rendered (e.g. by _save_figure) before the next call to new_plot()
+    """
+    def __init__(self, nrow, ncol):
+        self.nrow = nrow
+        self.ncol = ncol
+        self.fig = plt.figure(figsize=(ncol*6, nrow*4))
+        self.fig.subplots_adjust(hspace=0.45, wspace=0.02, right=0.9)
+        self._axs = dict()
+        self._caxs = dict()
+
+    ###################
+    # PUBLIC ROUTINES #
+    ###################
+
+    def new_plot(self, suptitle):
+        """ Hide every panel and colorbar of the previous plot, and set title of the figure """
+        for ax in list(self._axs.values()) + [cax for cax, _ in self._caxs.values()]:
+            ax.set_visible(False)
+        self.fig.suptitle(suptitle)
+        return self.fig
+
+    def panel(self, i):
+        """ Return empty GeoAxes of panel i (0-based, numbered like add_subplot) """
+        if i not in self._axs:
+            self._axs[i] = self.fig.add_subplot(self.nrow, self.ncol, i+1, projection=MAP_PROJECTION)
+        ax = self._axs[i]
+        for artist in list(ax.collections):
+            artist.remove()
+        # autoscale to the next field only, as on a new axes
+        ax.ignore_existing_data_limits = True
+        ax.set_visible(True)
+        return ax
+
+    def colorbar(self, mappable, i=None):
+        """
+        Draw colorbar of mappable next to panel i, like fig.colorbar(mappable, ax=panel(i));
+        i = None => one colorbar to the right of all panels
+        """
+        if i not in self._caxs:
+            if i is None:
+                self._caxs[i] = (self.fig.add_axes((0.93, 0.15, 0.02, 0.7)), dict())
+            else:
+                self._caxs[i] = make_axes_gridspec(self._axs[i])
+        cax, colorbar_kwargs = self._caxs[i]
+        # colorbars position their axes with a locator that wraps the current one, so drop the
+        # locator of the previous colorbar (otherwise every reuse shrinks the colorbar)
+        cax.cla()
+        cax.set_axes_locator(None)
+        cax.set_visible(True)
+        return self.fig.colorbar(mappable, cax=cax, **colorbar_kwargs)
+
+    def close(self):
+        """ Close figure """
+        plt.close(self.fig)
@@ -0,0 +1,143 @@
+"""
+Write figures in background threads: figures are rendered on the calling thread (matplotlib is
+not thread-safe), but compressing and writing the output happens in a thread pool, so the next
+plot can be set up while earlier ones are still being encoded
+"""
+
+import io
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Output settings for each plot_format; plot_format_options in the YAML input file overrides them
+# (compress_level is zlib level 0-9 for png, quality is 1-95 for jpg)
+DEFAULT_FORMAT_OPTIONS = {'png': {'dpi': 300, 'compress_level': 6},
+                          'jpg': {'dpi': 300, 'quality': 90},
+                          'pdf': {'dpi': 300},
+                          'svg': {'dpi': 300},
+                          'eps': {'dpi': 300}}
+
+# Formats that are rendered to a bitmap and encoded with PIL in the background
+_RASTER_FORMATS = {'png': 'PNG', 'jpg': 'JPEG'}
+
+def get_format_options(plot_format, plot_format_options=None):
+    """ Return output settings for plot_format: DEFAULT_FORMAT_OPTIONS updated with plot_format_options """
+    if plot_format not in DEFAULT_FORMAT_OPTIONS:
+        raise ValueError("'{}' is not a supported plot_format".format(plot_format))
+    options = dict(DEFAULT_FORMAT_OPTIONS[plot_format])
+    if plot_format_options and plot_format in plot_format_options:
+        for key in plot_format_options[plot_format]:
+            if key not in options:
+                raise KeyError("'{}' is not a valid option for plot_format '{}'".format(key, plot_format))
+        options.update(plot_format_options[plot_format])
+    return options
+
+def write_figure(fig, file_out, plot_format, options):
+    """ Render, encode and write fig without a thread pool """
+    _write(_render(fig, plot_format, options), file_out, plot_format, options)
+
+######################################################################
+
+class FigureWriter(object): # pylint: disable=useless-object-inheritance
+    """
+    Pool of nthreads threads that encode and write rendered figures; at most max_pending figures
+    (default: 2 * nthreads) wait to be written, which bounds the memory held by rendered bitmaps.
+    Write errors are logged and returned by flush(), so one bad file does not stop the analysis.
+    """
+    def __init__(self, nthreads=2, max_pending=None):
+        self.logger = logging.getLogger('FigureWriter')
+        if max_pending is None:
+            max_pending = 2 * nthreads
+        self._executor = ThreadPoolExecutor(max_workers=nthreads)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = []
+
+    ###################
+    # PUBLIC ROUTINES #
+    ###################
+
+    def submit(self, fig, file_out, plot_format, options, name=None, on_written=None):
+        """
+        Render fig now, then encode and write it to file_out in the background;
+        on_written() is called (from a worker thread) once file_out is complete
+        """
+        rendered = _render(fig, plot_format, options)
+        self._slots.acquire()
+        future = self._executor.submit(self._write_and_notify, rendered, file_out, plot_format, options,
+                                       on_written)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append((name or file_out, future))
+
+    def flush(self):
+        """ Wait for every submitted figure; returns names of figures that could not be written """
+        failed = []
+        for name, future in self._pending:
+            if future.exception() is not None:
+                failed.append(name)
+        self._pending = []
+        return failed
+
+    def close(self):
+        """ flush(), then stop the worker threads """
+        failed = self.flush()
+        self._executor.shutdown()
+        return failed
+
+    ####################
+    # PRIVATE ROUTINES #
+    ####################
+
+    def _write_and_notify(self, rendered, file_out, plot_format, options, on_written):
+        try:
+            _write(rendered, file_out, plot_format, options)
+        except Exception: # pylint: disable=broad-except
+            self.logger.error('Failed to write %s:\n%s', file_out, traceback.format_exc())
+            raise
+        if on_written is not None:
+            on_written()
+
+######################################################################
+
+def _render(fig, plot_format, options):
+    """
+    Draw fig (bbox_inches='tight'); raster formats return ('rgba', (width, height), pixels),
+    other formats return ('bytes', None, encoded file contents)
+    """
+    buf = io.BytesIO()
+    if plot_format in _RASTER_FORMATS:
+        fig.savefig(buf, format='rgba', dpi=options['dpi'], bbox_inches='tight')
+        # the Agg canvas keeps the renderer it last drew with, which has the size of the tight bbox
+        renderer = getattr(fig.canvas, 'renderer', None)
+        if renderer is not None:
+            size = (int(renderer.width), int(renderer.height))
+            if size[0] * size[1] * 4 == buf.getbuffer().nbytes:
+                return 'rgba', size, buf.getvalue()
+        # could not determine size of the bitmap, let matplotlib encode it
+        buf = io.BytesIO()
+    fig.savefig(buf, format=plot_format, dpi=options['dpi'], bbox_inches='tight')
+    return 'bytes', None, buf.getvalue()
+
+def _write(rendered, file_out, plot_format, options):
+    """ Encode rendered figure (from _render) and write it to a temporary file that is renamed to file_out """
+    kind, size, data = rendered
+    tmp_file = '{}.{}.{}.tmp'.format(file_out, os.getpid(), threading.get_ident())
+    try:
+        if kind == 'rgba':
+            from PIL import Image
+            image = Image.frombuffer('RGBA', size, data, 'raw', 'RGBA', 0, 1)
+            save_kwargs = {'dpi': (options['dpi'], options['dpi'])}
+            if plot_format == 'png':
+                save_kwargs['compress_level'] = options['compress_level']
+            else:
+                image = image.convert('RGB')
+                save_kwargs['quality'] = options['quality']
+            image.save(tmp_file, format=_RASTER_FORMATS[plot_format], **save_kwargs)
+        else:
+            with open(tmp_file, 'wb') as file_obj:
+                file_obj.write(data)
+        os.rename(tmp_file, file_out)
+    finally:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
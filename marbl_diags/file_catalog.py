@@ -0,0 +1,157 @@
+""" Persistent catalog (SQLite) of the netCDF files in a directory, used instead of globbing """
+
+import logging
+import os
+import re
+import json
+import sqlite3
+import hashlib
+from subprocess import call
+import netCDF4
+
+######################################################################
+
+class FileCatalog(object): # pylint: disable=useless-object-inheritance
+    """
+    One SQLite database per directory (stored in catalog_dir) recording, for every netCDF file,
+    its modification time, case, stream, time range, time_bound variable, and time-dependent
+    variables. refresh() only reads metadata from files that are new or have changed since
+    the last refresh, so after the first run resolving files is a query rather than a glob
+    followed by opening every file. Use as a context manager (or call close()) so the
+    database connection is closed when done.
+    """
+    def __init__(self, dirin, catalog_dir):
+        self.logger = logging.getLogger('FileCatalog')
+        self.dirin = os.path.abspath(dirin)
+        if not os.path.exists(catalog_dir):
+            self.logger.info('creating %s', catalog_dir)
+            call(['mkdir', '-p', catalog_dir])
+        self.db_file = os.path.join(catalog_dir, 'catalog.{}.sqlite'.format(
+            hashlib.sha1(self.dirin.encode('utf-8')).hexdigest()[:16]))
+        self._conn = sqlite3.connect(self.db_file)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, mtime REAL, '
+                           'case_name TEXT, stream TEXT, time_start REAL, time_end REAL, '
+                           'time_bound TEXT, variables TEXT)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS directory (dirin TEXT PRIMARY KEY, mtime REAL)')
+        self._conn.commit()
+        try:
+            self.refresh()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    ###################
+    # PUBLIC ROUTINES #
+    ###################
+
+    def close(self):
+        """ Close the database connection """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def refresh(self):
+        """ Update the catalog for files that were added, changed, or removed since last refresh """
+        dir_mtime = os.stat(self.dirin).st_mtime
+        row = self._conn.execute('SELECT mtime FROM directory WHERE dirin = ?', (self.dirin,)).fetchone()
+
+        # Files are only added / removed / replaced if the directory mtime changes
+        # (files modified in place are not detected)
+        if row is not None and row[0] == dir_mtime:
+            return
+
+        known_mtimes = dict(self._conn.execute('SELECT name, mtime FROM files').fetchall())
+        on_disk = dict()
+        for entry in os.scandir(self.dirin):
+            if entry.name.endswith('.nc') and entry.is_file():
+                on_disk[entry.name] = entry.stat().st_mtime
+
+        removed = [name for name in known_mtimes if name not in on_disk]
+        if removed:
+            self.logger.debug('Removing %d files from catalog', len(removed))
+            self._conn.executemany('DELETE FROM files WHERE name = ?', [(name,) for name in removed])
+        updated = [name for name, mtime in on_disk.items() if known_mtimes.get(name) != mtime]
+        if updated:
+            self.logger.info('Adding %d files in %s to catalog', len(updated), self.dirin)
+        for name in updated:
+            self._conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (name, on_disk[name]) + self._read_metadata(name))
+        self._conn.execute('INSERT OR REPLACE INTO directory VALUES (?, ?)', (self.dirin, dir_mtime))
+        self._conn.commit()
+
+    def find_files(self, name_pattern, variables=None):
+        """
+        Return sorted list of full paths of files whose names match name_pattern (glob syntax)
+        and (if variables is not None) contain at least one of variables
+        """
+        names = [row[0] for row in self._conn.execute(
+            'SELECT name, variables FROM files WHERE name GLOB ? ORDER BY name', (name_pattern,)).fetchall()
+                 if variables is None or set(json.loads(row[1])).intersection(variables)]
+        return [os.path.join(self.dirin, name) for name in names]
+
+    def find_files_in_range(self, case, stream, year_start, year_end, variables=None):
+        """
+        Return sorted list of full paths of files from case and stream that are entirely
+        within model years year_start through year_end (inclusive); time is assumed to be
+        days since 0001-01-01 in the noleap calendar
+        """
+        names = [row[0] for row in self._conn.execute(
+            'SELECT name, variables FROM files WHERE case_name = ? AND stream = ? AND '
+            'time_start >= ? AND time_end <= ? ORDER BY name',
+            (case, stream, 365.*(year_start-1), 365.*year_end)).fetchall()
+                 if variables is None or set(json.loads(row[1])).intersection(variables)]
+        return [os.path.join(self.dirin, name) for name in names]
+
+    def get_time_ranges(self, file_names):
+        """
+        Return dictionary with (time_start, time_end), the range of time_bound (or time), of
+        every file in file_names (full paths) that is in the catalog and has a time axis
+        """
+        time_ranges = dict()
+        for file_name in file_names:
+            if os.path.dirname(os.path.abspath(file_name)) != self.dirin:
+                continue
+            row = self._conn.execute('SELECT time_start, time_end FROM files WHERE name = ?',
+                                     (os.path.basename(file_name),)).fetchone()
+            if row is not None and row[0] is not None:
+                time_ranges[file_name] = row
+        return time_ranges
+
+    ####################
+    # PRIVATE ROUTINES #
+    ####################
+
+    def _read_metadata(self, name):
+        """ Return (case, stream, time_start, time_end, time_bound, variables) for file """
+        with netCDF4.Dataset(os.path.join(self.dirin, name)) as nc_file:
+            case = getattr(nc_file, 'title', None)
+            variables = [var_name for var_name, var in nc_file.variables.items()
+                         if 'time' in var.dimensions and var_name != 'time']
+            time_bound = None
+            time_start = time_end = None
+            if 'time' in nc_file.variables:
+                time_bound = getattr(nc_file.variables['time'], 'bounds', None)
+                if time_bound is None and 'time_bound' in nc_file.variables:
+                    time_bound = 'time_bound'
+                if time_bound in nc_file.variables:
+                    time_values = nc_file.variables[time_bound][:]
+                else:
+                    time_values = nc_file.variables['time'][:]
+                if time_values.size > 0:
+                    time_start = float(time_values.min())
+                    time_end = float(time_values.max())
+        # File names look like {case}.{stream}.[{variable}.]{date}.nc
+        stream = None
+        if case and name.startswith(case + '.'):
+            stream = re.sub(r'\.[^.]+\.nc$', '', name[len(case)+1:])
+            for var_name in variables:
+                if stream.endswith('.' + var_name):
+                    stream = stream[:-len(var_name)-1]
+                    break
+        return case, stream, time_start, time_end, time_bound, json.dumps(variables)
@@ -5,8 +5,14 @@ import os
 import json
 from subprocess import call
 from datetime import datetime
+import numpy as np
+import xarray as xr
+import numcodecs
 import esmlab
 
+# Days per month in the noleap calendar
+NOLEAP_DAYS_PER_MONTH = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
 ######################################################################
 
 class GenericDataSource(object): # pylint: disable=useless-object-inheritance
@@ -18,6 +24,8 @@ class GenericDataSource(object): # pylint: disable=useless-object-inheritance
         self.source = kwargs['source']
         self.ds = None # pylint: disable=invalid-name
         self._var_dict = None
+        # dask chunks used when opening data (set by data sources on high-resolution grids)
+        self._open_chunks = None
         self._set_var_dict()
 
     ###################
@@ -27,14 +35,31 @@ class GenericDataSource(object): # pylint: disable=useless-object-inheritance
     def compute_mon_climatology(self):
         """ Compute a monthly climatology """
 
-        ds = esmlab.core.climatology(self.ds, freq='mon')
+        ds = self._compute_regular_mon_climatology()
+        if ds is None:
+            self.logger.debug('time axis is not complete years of monthly means, calling esmlab')
+            ds = self._compute_generic_mon_climatology()
         self.ds = ds
 
-    def cache_dataset(self, cached_location, cached_var_dict):
+    def should_cache(self):
+        """ Is the climatology of this data source worth caching? (not if it was read in as a climatology) """
+        return not (self._is_mon_climo or self._is_ann_climo)
+
+    def cache_dataset(self, cached_location, cached_var_dict, compressor=None, float32=False,
+                      level_dim='z_t'):
         """
         Function to write output:
            - optionally add some file-level attrs
+           - chunk so each chunk holds one level (level_dim) and all time levels, as plots read
+             one level of the climatology at a time (on grids opened with chunks in nlat, the
+             cache is split in nlat the same way, so no chunk holds a whole high-resolution level)
+           - optionally downcast 64-bit floating point data to 32 bits (except time bounds and
+             other coordinate-like variables)
+           - compress with compressor, a dictionary with keys cname, clevel, and shuffle
+             (None => no compression)
            - switch method based on file extension
+           - write to a temporary location that is renamed when complete, so an interrupted
+             run never leaves a partial cache that looks complete
         """
 
         diro = os.path.dirname(cached_var_dict)
@@ -66,17 +91,69 @@ class GenericDataSource(object): # pylint: disable=useless-object-inheritance
         #     dsattrs.update(dsattrs)
         self.ds.attrs.update(dsattrs)
 
+        ds_out = self.ds.copy()
+        if float32:
+            # bounds and other coordinate-like variables keep full precision (time_bound is
+            # used to weight months, and rounded bounds would no longer match the time axis)
+            keep_float64 = set()
+            for var_name in ds_out.variables:
+                attrs = ds_out[var_name].attrs
+                encoding = ds_out[var_name].encoding
+                if 'bounds' in attrs:
+                    keep_float64.add(attrs['bounds'])
+                for coordinates in [attrs.get('coordinates'), encoding.get('coordinates')]:
+                    if coordinates:
+                        keep_float64.update(coordinates.split())
+            try:
+                keep_float64.add(self._time_bound_var()[0])
+            except (ValueError, KeyError):
+                pass
+            for var_name in ds_out.data_vars:
+                if var_name in keep_float64:
+                    continue
+                if ds_out[var_name].dtype == np.float64 and 'time' in ds_out[var_name].dims:
+                    ds_out[var_name] = ds_out[var_name].astype(np.float32)
+        chunks = dict([(dim, -1) for dim in ds_out.dims])
+        if level_dim in chunks:
+            chunks[level_dim] = 1
+        if self._open_chunks and 'nlat' in self._open_chunks and 'nlat' in chunks:
+            chunks['nlat'] = min(self._open_chunks['nlat'], ds_out.dims['nlat'])
+
         ext = os.path.splitext(cached_location)[1]
+        tmp_location = '{}.{}.tmp'.format(cached_location, os.getpid())
+        if os.path.exists(tmp_location):
+            call(['rm', '-fr', tmp_location])
         if ext == '.nc':
+            encoding = dict()
+            for var_name in ds_out.data_vars:
+                if compressor and level_dim in ds_out[var_name].dims:
+                    var_chunks = [ds_out.dims[dim] if chunks[dim] == -1 else chunks[dim]
+                                  for dim in ds_out[var_name].dims]
+                    encoding[var_name] = {'zlib': True, 'complevel': min(compressor['clevel'], 9),
+                                          'shuffle': compressor['shuffle'] != 'noshuffle',
+                                          'chunksizes': var_chunks}
             self.logger.info('writing %s', cached_location)
-            self.ds.to_netcdf(cached_location, compute=True)
+            ds_out.to_netcdf(tmp_location, encoding=encoding, compute=True)
 
         elif ext == '.zarr':
+            if compressor:
+                blosc_shuffle = {'noshuffle': numcodecs.Blosc.NOSHUFFLE, 'shuffle': numcodecs.Blosc.SHUFFLE,
+                                 'bitshuffle': numcodecs.Blosc.BITSHUFFLE}[compressor['shuffle']]
+                zarr_compressor = numcodecs.Blosc(cname=compressor['cname'], clevel=compressor['clevel'],
+                                                  shuffle=blosc_shuffle)
+            else:
+                zarr_compressor = None
+            ds_out = ds_out.chunk(chunks)
+            encoding = dict([(var_name, {'compressor': zarr_compressor}) for var_name in ds_out.variables])
+            for var_name in ds_out.variables:
+                # encoding from the original netCDF files would conflict with new chunks
+                ds_out[var_name].encoding.pop('chunks', None)
             self.logger.info('writing %s', cached_location)
-            self.ds.to_zarr(cached_location, compute=True)
+            ds_out.to_zarr(tmp_location, encoding=encoding, consolidated=True, compute=True)
 
         else:
             raise ValueError('Unknown output file extension: {ext}')
+        os.rename(tmp_location, cached_location)
 
     ####################
     # PRIVATE ROUTINES #
@@ -94,6 +171,71 @@ class GenericDataSource(object): # pylint: disable=useless-object-inheritance
         tb_dim = self.ds[tb_name].dims[1]
         return tb_name, tb_dim
 
+    def _compute_generic_mon_climatology(self):
+        """ Compute a monthly climatology with esmlab (works for any time axis) """
+        return esmlab.core.climatology(self.ds, freq='mon')
+
+    def _get_regular_monthly_nyears(self):
+        """
+        If the time axis is complete noleap years of monthly means (Jan - Dec, no gaps), return
+        number of years; otherwise return None
+        """
+        if 'time' not in self.ds.dims or self.ds.dims['time'] == 0 or self.ds.dims['time'] % 12 != 0:
+            return None
+        try:
+            tb_name, _ = self._time_bound_var()
+        except ValueError:
+            return None
+        # Need to know that time_bound[0, 0] is the start of a year
+        units = self.ds['time'].attrs.get('units', '')
+        calendar = self.ds['time'].attrs.get('calendar', '')
+        if not (units.startswith('days since') and units.split()[2].endswith('-01-01')):
+            return None
+        if calendar not in ['noleap', '365_day']:
+            return None
+        time_bound = self.ds[tb_name].values
+        if time_bound[0, 0] % 365 != 0:
+            return None
+        if not np.array_equal(time_bound[1:, 0], time_bound[:-1, 1]):
+            return None
+        days_per_month = (time_bound[:, 1] - time_bound[:, 0]).reshape(-1, 12)
+        if not np.all(days_per_month == NOLEAP_DAYS_PER_MONTH):
+            return None
+        return days_per_month.shape[0]
+
+    def _compute_regular_mon_climatology(self):
+        """
+        Compute a monthly climatology by reshaping every time-dependent variable to
+        (nyears, 12, ...) and averaging over years; this avoids decoding / grouping by time and
+        keeps dask chunks intact. Returns None if time axis is not complete years of monthly means
+        (in which case _compute_generic_mon_climatology() should be used instead)
+        """
+        nyears = self._get_regular_monthly_nyears()
+        if nyears is None:
+            return None
+        self.logger.debug('computing climatology from %d complete years of monthly means', nyears)
+        tb_name, tb_dim = self._time_bound_var()
+
+        ds = xr.Dataset(attrs=self.ds.attrs)
+        for var_name, da in self.ds.variables.items():
+            if var_name in ['time', tb_name]:
+                continue
+            if 'time' not in da.dims:
+                ds[var_name] = da
+                continue
+            da = da.transpose('time', *[dim for dim in da.dims if dim != 'time'])
+            data = da.data.reshape((nyears, 12) + da.shape[1:]).mean(axis=0)
+            ds[var_name] = xr.Variable(da.dims, data, attrs=da.attrs, encoding=da.encoding)
+
+        # Same conventions as esmlab: time_bound starts at 0, time is middle of time_bound
+        time_bound = self.ds[tb_name].values.reshape((nyears, 12, 2)).mean(axis=0)
+        time_bound = time_bound - time_bound[0, 0]
+        ds['time'] = xr.Variable('time', time_bound.mean(axis=1), attrs=self.ds['time'].attrs)
+        ds[tb_name] = xr.Variable(('time', tb_dim), time_bound, attrs=self.ds[tb_name].attrs)
+        ds['month'] = xr.Variable('time', np.arange(1, 13, dtype=np.int32),
+                                  attrs={'long_name': 'Month', 'units': 'month'})
+        return ds.set_coords([coord for coord in self.ds.coords if coord in ds])
+
     def _set_var_dict(self):
         """
         Each class derived from GenericDataSource needs to map from generic variable names to
@@ -0,0 +1,294 @@
+""" Functions that precompute (and cache) grid-dependent quantities used by analysis_ops """
+
+import hashlib
+import numpy as np
+import scipy.sparse
+
+# Geometry computed by functions in this module is stored in _grid_cache so it is only
+# computed once per grid (keys always start with the name of the grid)
+_grid_cache = dict()
+
+# Grids that can be analyzed: name of the vertical coordinate, and dask chunks used when opening
+# model output on the grid (None => one chunk per file; high-resolution output is split so no
+# chunk holds more than one level of one year)
+KNOWN_GRIDS = {'POP_gx3v7': {'depth_coord_name': 'z_t', 'open_chunks': None},
+               'POP_gx1v7': {'depth_coord_name': 'z_t', 'open_chunks': None},
+               'POP_tx0.1v2': {'depth_coord_name': 'z_t', 'open_chunks': {'time': 12, 'z_t': 1, 'nlat': 600}},
+               'POP_tx0.1v3': {'depth_coord_name': 'z_t', 'open_chunks': {'time': 12, 'z_t': 1, 'nlat': 600}}}
+
+# Fields are coarsened before contouring so maps have at most this many points in longitude
+DISPLAY_MAX_NLON = 400
+
+def get_grid_info(grid):
+    """ Return entry of KNOWN_GRIDS for grid """
+    if grid not in KNOWN_GRIDS:
+        raise ValueError("'{}' is not a known grid".format(grid))
+    return KNOWN_GRIDS[grid]
+
+# Regions available for regional means, defined as lists of values in POP's REGION_MASK
+# (None => every ocean cell)
+POP_REGIONS = [('Global', None),
+               ('Southern Ocean', [1]),
+               ('Pacific Ocean', [2]),
+               ('Indian Ocean', [3]),
+               ('Persian Gulf', [4]),
+               ('Red Sea', [5]),
+               ('Atlantic Ocean', [6]),
+               ('Mediterranean Sea', [7]),
+               ('Labrador Sea', [8]),
+               ('GIN Sea', [9]),
+               ('Arctic Ocean', [10]),
+               ('Hudson Bay', [11]),
+               ('Baltic Sea', [-12]),
+               ('Black Sea', [-13]),
+               ('Caspian Sea', [-14])]
+
+def get_region_names(regions=None):
+    """
+    Input: regions = list of region names (None => all regions in POP_REGIONS)
+    Output: list of region names, after checking that each region is defined
+    """
+    known_regions = [region_name for region_name, _ in POP_REGIONS]
+    if regions is None:
+        return known_regions
+    for region_name in regions:
+        if region_name not in known_regions:
+            raise ValueError("'{}' is not a known region".format(region_name))
+    return list(regions)
+
+def region_weight_matrix(grid, region_mask, area, valid, regions=None):
+    """
+    Input: grid = name of the grid (used as key in _grid_cache)
+           region_mask = 2D array of POP REGION_MASK values
+           area = 2D array of cell areas (e.g. TAREA)
+           valid = 2D boolean array, True where data is available
+           regions = list of region names (None => all regions in POP_REGIONS)
+    Output: sparse (region x cell) matrix with normalized area weights in each row,
+            so (matrix).dot(field.reshape(-1)) is the area-weighted mean in every region
+            (cells where valid is False must be filled with zeroes before the product)
+    """
+    region_names = get_region_names(regions)
+    valid = np.asarray(valid, dtype=bool)
+    key = (grid, 'region_weight_matrix', tuple(region_names),
+           hashlib.sha1(np.packbits(valid)).hexdigest())
+    if key in _grid_cache:
+        return _grid_cache[key]
+
+    region_mask = np.asarray(region_mask).reshape(-1)
+    area = np.where(valid, np.asarray(area), 0.).reshape(-1)
+    region_defs = dict(POP_REGIONS)
+    rows = []
+    cols = []
+    for row, region_name in enumerate(region_names):
+        if region_defs[region_name] is None:
+            in_region = region_mask != 0
+        else:
+            in_region = np.isin(region_mask, region_defs[region_name])
+        cells = np.flatnonzero(np.logical_and(in_region, area > 0))
+        rows.append(np.full(cells.size, row))
+        cols.append(cells)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    weights = scipy.sparse.csr_matrix((area[cols], (rows, cols)),
+                                      shape=(len(region_names), region_mask.size))
+
+    # Normalize each row (regions without valid cells are left as all zeroes)
+    row_sums = np.asarray(weights.sum(axis=1)).reshape(-1)
+    row_sums = np.where(row_sums > 0, 1. / np.where(row_sums > 0, row_sums, 1.), 0.)
+    weights = scipy.sparse.diags(row_sums).dot(weights).tocsr()
+
+    _grid_cache[key] = weights
+    return weights
+
+# Basins available for zonal means, defined as lists of values in POP's REGION_MASK
+# (None => every ocean cell)
+POP_BASINS = [('Global', None),
+              ('Atlantic', [6, 7, 8, 9, 10, 11]),
+              ('Pacific', [2]),
+              ('Indian', [3])]
+
+def get_basin_names(basins=None):
+    """
+    Input: basins = list of basin names (None => all basins in POP_BASINS)
+    Output: list of basin names, after checking that each basin is defined
+    """
+    known_basins = [basin_name for basin_name, _ in POP_BASINS]
+    if basins is None:
+        return known_basins
+    for basin_name in basins:
+        if basin_name not in known_basins:
+            raise ValueError("'{}' is not a known basin".format(basin_name))
+    return list(basins)
+
+def get_lat_bin_edges(lat_bin_width):
+    """ Return edges of latitude bins spanning -90 to 90 degrees """
+    nbins = int(np.ceil(180. / lat_bin_width))
+    return np.linspace(-90., -90. + nbins * lat_bin_width, nbins + 1)
+
+def zonal_mean_groups(grid, tlat, region_mask, lat_bin_width, basins=None):
+    """
+    Input: grid = name of the grid (used as key in _grid_cache)
+           tlat = 2D array of cell latitudes
+           region_mask = 2D array of POP REGION_MASK values
+           lat_bin_width = width of latitude bins (degrees)
+           basins = list of basin names (None => all basins in POP_BASINS)
+    Output: cells, groups, ngroups
+            cells = flattened index of every (cell, basin) pair, so a cell appears once
+                    for each basin it belongs to
+            groups = basin_index * nlat_bins + lat_bin_index for each entry of cells
+            ngroups = number of basins * number of latitude bins
+    """
+    basin_names = get_basin_names(basins)
+    tlat = np.asarray(tlat)
+    region_mask = np.ascontiguousarray(region_mask)
+    key = (grid, 'zonal_mean_groups', tuple(basin_names), lat_bin_width, tlat.shape,
+           hashlib.sha1(region_mask).hexdigest())
+    if key in _grid_cache:
+        return _grid_cache[key]
+
+    lat_bin_edges = get_lat_bin_edges(lat_bin_width)
+    nbins = lat_bin_edges.size - 1
+    tlat = tlat.reshape(-1)
+    region_mask = region_mask.reshape(-1)
+    lat_bin = np.clip(np.digitize(tlat, lat_bin_edges) - 1, 0, nbins - 1)
+    basin_defs = dict(POP_BASINS)
+    cells = []
+    groups = []
+    for basin_index, basin_name in enumerate(basin_names):
+        if basin_defs[basin_name] is None:
+            in_basin = region_mask != 0
+        else:
+            in_basin = np.isin(region_mask, basin_defs[basin_name])
+        basin_cells = np.flatnonzero(in_basin)
+        cells.append(basin_cells)
+        groups.append(basin_index * nbins + lat_bin[basin_cells])
+    cells = np.concatenate(cells)
+    groups = np.concatenate(groups)
+
+    _grid_cache[key] = (cells, groups, len(basin_names) * nbins)
+    return _grid_cache[key]
+
+def get_ocean_points(grid, shape, level, kmt=None, valid=None):
+    """
+    Input: grid = name of the grid (used as key in _grid_cache)
+           shape = (ny, nx) of the horizontal grid
+           level = index (0-based) of the shallowest level of the fields that will be gathered if
+                   kmt is provided; otherwise any other (hashable) name of the level
+           kmt = 2D array of POP KMT (number of active levels in each column)
+           valid = 2D boolean array, True where the first field read at level has data (used if
+                   kmt is None)
+    Output: flattened (increasing) index of every cell that is active at level (KMT > level, or
+            valid), computed once per (grid, KMT, level) so every field read at that level shares it;
+            fields gathered at these indices (compress_to_ocean_points) hold no land values, so
+            reductions, differences and stats on them do not process the land cells of the 2D layout.
+            Returns None if neither kmt nor valid is provided and level has not been computed yet.
+    """
+    key = (grid, 'ocean_points', tuple(shape), level)
+    if kmt is not None:
+        # runs on one grid may still differ in bathymetry, so KMT is part of the key
+        kmt = np.ascontiguousarray(kmt)
+        key += (hashlib.sha1(kmt).hexdigest(),)
+    if key not in _grid_cache:
+        if kmt is not None:
+            _grid_cache[key] = np.flatnonzero(np.asarray(kmt).reshape(-1) > level)
+        elif valid is not None:
+            _grid_cache[key] = np.flatnonzero(np.asarray(valid, dtype=bool))
+        else:
+            return None
+    return _grid_cache[key]
+
+def compress_to_ocean_points(values, points):
+    """ Gather (..., ny, nx) array at points (from get_ocean_points) into a (..., npoints) array """
+    values = np.asarray(values)
+    return values.reshape(values.shape[:-2] + (-1,))[..., points]
+
+def expand_from_ocean_points(values, points, shape):
+    """ Scatter (..., npoints) array back to (..., ny, nx) = (..., *shape), with NaN at inactive cells """
+    values = np.asarray(values)
+    expanded = np.full(values.shape[:-1] + (shape[0] * shape[1],), np.nan, dtype=values.dtype)
+    expanded[..., points] = values
+    return expanded.reshape(values.shape[:-1] + tuple(shape))
+
+def vertical_interp_weights(grid, depths, levels):
+    """
+    Input: grid = name of the grid (used as key in _grid_cache)
+           depths = 1D array of (increasing) depths of the model / dataset levels
+           levels = requested depths (same units as depths)
+    Output: dictionary mapping each requested depth to (k0, k1, weight), so the field at that depth
+            is (1 - weight) * field[k0] + weight * field[k1] (linear in depth; requested depths
+            above the first or below the last level use that level)
+    """
+    depths = np.asarray(depths, dtype=np.float64)
+    key = (grid, 'vertical_interp_weights', hashlib.sha1(depths.tobytes()).hexdigest(), tuple(levels))
+    if key in _grid_cache:
+        return _grid_cache[key]
+
+    weights = dict()
+    for level in levels:
+        k1 = int(np.clip(np.searchsorted(depths, level), 1, depths.size - 1))
+        k0 = k1 - 1
+        weight = float(np.clip((level - depths[k0]) / (depths[k1] - depths[k0]), 0., 1.))
+        weights[level] = (k0, k1, weight)
+    _grid_cache[key] = weights
+    return weights
+
+def get_display_coarsening(shape):
+    """ Number of cells (in each direction) averaged into one displayed cell for a grid of shape (ny, nx) """
+    return int(np.ceil(float(shape[1]) / DISPLAY_MAX_NLON))
+
+def coarsen_for_display(grid, tlon, tlat, field, area):
+    """
+    Input: grid = name of the grid (used as key in _grid_cache)
+           tlon, tlat = 2D arrays of cell longitudes and latitudes
+           field = 2D array to plot (NaN at land cells)
+           area = 2D array of cell areas (e.g. TAREA)
+    Output: lon, lat, field averaged over blocks of get_display_coarsening() x get_display_coarsening()
+            cells (see coarsen_grid and coarsen_field). Grids that are already coarse are returned as is.
+    """
+    factor = get_display_coarsening(np.shape(tlon))
+    if factor == 1:
+        return tlon, tlat, field
+    lon, lat, _ = coarsen_grid(grid, tlon, tlat, area, factor)
+    return lon, lat, coarsen_field(field, area, factor)
+
+def coarsen_grid(grid, tlon, tlat, area, factor):
+    """
+    Input: grid = name of the grid (used as key in _grid_cache)
+           tlon, tlat = 2D arrays of cell longitudes and latitudes
+           area = 2D array of cell areas (e.g. TAREA)
+           factor = number of cells (in each direction) in a block
+    Output: lon, lat, area of blocks of factor x factor cells; block centers are computed from
+            unit vectors so blocks crossing the dateline or near the poles are placed correctly,
+            and the area of a block is the total area of its cells
+    """
+    area = np.asarray(area, dtype=np.float64)
+    key = (grid, 'coarse_grid', factor, area.shape)
+    if key not in _grid_cache:
+        lon_rad = np.deg2rad(np.asarray(tlon, dtype=np.float64))
+        lat_rad = np.deg2rad(np.asarray(tlat, dtype=np.float64))
+        xyz = [_block_sum(area * np.cos(lat_rad) * np.cos(lon_rad), factor),
+               _block_sum(area * np.cos(lat_rad) * np.sin(lon_rad), factor),
+               _block_sum(area * np.sin(lat_rad), factor)]
+        lon = np.mod(np.rad2deg(np.arctan2(xyz[1], xyz[0])), 360.)
+        lat = np.rad2deg(np.arctan2(xyz[2], np.hypot(xyz[0], xyz[1])))
+        _grid_cache[key] = (lon, lat, _block_sum(area, factor))
+    return _grid_cache[key]
+
+def coarsen_field(field, area, factor):
+    """
+    Area-weighted mean of the valid cells of 2D array field in each block of factor x factor
+    cells (NaN if a block has none)
+    """
+    field = np.asarray(field, dtype=np.float64)
+    weights = np.where(np.isfinite(field), np.asarray(area, dtype=np.float64), 0.)
+    num = _block_sum(np.where(weights > 0, field * weights, 0.), factor)
+    den = _block_sum(weights, factor)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 0, num / den, np.nan)
+
+def _block_sum(values, factor):
+    """ Sum 2D array over blocks of factor x factor cells (padding the last blocks with zeroes) """
+    ny, nx = values.shape
+    pad = ((0, -ny % factor), (0, -nx % factor))
+    values = np.pad(values, pad, mode='constant')
+    return values.reshape(values.shape[0] // factor, factor, values.shape[1] // factor, factor).sum(axis=(1, 3))
@@ -0,0 +1,89 @@
+""" Virtual datasets: reference manifests describing where every chunk of a multi-file dataset lives """
+
+import logging
+import os
+import json
+import hashlib
+from subprocess import call
+import xarray as xr
+from kerchunk.hdf import SingleHdf5ToZarr
+from kerchunk.netCDF3 import NetCDF3ToZarr
+from kerchunk.combine import MultiZarrToZarr
+
+logger = logging.getLogger('manifests')
+
+# First bytes of the netCDF formats that can be scanned, and the scanner for each
+# (CESM output is often netCDF3 classic / 64-bit offset rather than netCDF4 / HDF5)
+_FILE_SIGNATURES = [(b'\x89HDF\r\n\x1a\n', SingleHdf5ToZarr),
+                    (b'CDF\x01', NetCDF3ToZarr),
+                    (b'CDF\x02', NetCDF3ToZarr)]
+
+def _get_scanner(file_name):
+    """ Return kerchunk class that can scan file_name (None if its format is not supported) """
+    with open(file_name, 'rb') as file_in:
+        header = file_in.read(8)
+    for signature, scanner in _FILE_SIGNATURES:
+        if header.startswith(signature):
+            return scanner
+    return None
+
+def get_manifest_file(manifest_dir, files):
+    """
+    Name of the manifest for a list of netCDF files (depends only on the file names, so no file
+    is touched; manifests need to be rebuilt if files are modified)
+    """
+    file_ids = [os.path.abspath(file_name) for file_name in sorted(files)]
+    return os.path.join(manifest_dir, 'manifest.{}.json'.format(
+        hashlib.sha1('\n'.join(file_ids).encode('utf-8')).hexdigest()))
+
+def build_manifest(files, manifest_file, concat_dim='time'):
+    """
+    Scan netCDF (HDF5 or netCDF3) files once and write a consolidated reference manifest to
+    manifest_file: byte ranges of every variable chunk in every file, plus coordinates merged along
+    concat_dim (variables without concat_dim are taken from the first file). Returns False (and
+    writes no manifest) if a file is in a format that can not be scanned, e.g. CDF5
+    """
+    scanners = dict()
+    for file_name in files:
+        scanners[file_name] = _get_scanner(file_name)
+        if scanners[file_name] is None:
+            logger.warning('Can not build a manifest for %s (unsupported file format), files will be opened directly',
+                           file_name)
+            return False
+
+    diro = os.path.dirname(manifest_file)
+    if not os.path.exists(diro):
+        logger.info('creating %s', diro)
+        call(['mkdir', '-p', diro])
+
+    logger.info('Scanning %d files for %s', len(files), manifest_file)
+    single_file_refs = []
+    for file_name in sorted(files):
+        logger.debug('Scanning %s', file_name)
+        single_file_refs.append(scanners[file_name](file_name, inline_threshold=300).translate())
+    if len(single_file_refs) == 1:
+        refs = single_file_refs[0]
+    else:
+        # variables without concat_dim (grid variables, z_t, ...) are identical in every file
+        with xr.open_dataset(sorted(files)[0], decode_times=False, decode_coords=False) as first_ds:
+            static_vars = [var_name for var_name, var in first_ds.variables.items()
+                           if concat_dim not in var.dims]
+        refs = MultiZarrToZarr(single_file_refs, concat_dims=[concat_dim],
+                               identical_dims=static_vars).translate()
+
+    tmp_file = '{}.{}.tmp'.format(manifest_file, os.getpid())
+    with open(tmp_file, 'w') as file_out:
+        json.dump(refs, file_out)
+    os.replace(tmp_file, manifest_file)
+    return True
+
+def open_manifest(manifest_file, decode_times=False, decode_coords=False, chunks=None):
+    """
+    Open the dataset described by manifest_file; data is only read for chunks that are used
+    (chunks = dask chunks, None => chunks of the original files)
+    """
+    logger.debug('Opening virtual dataset %s', manifest_file)
+    return xr.open_dataset('reference://', engine='zarr', chunks={} if chunks is None else chunks,
+                           decode_times=decode_times, decode_coords=decode_coords,
+                           backend_kwargs={'consolidated': False,
+                                           'storage_options': {'fo': manifest_file}})
@@ -15,7 +15,11 @@ def get_plot_dims(num_vars):
 
 def adjust_pop_grid(tlon, tlat, field):
     """
-    docstring
+    Input: tlon, tlat = 2D arrays of cell longitudes and latitudes on a POP grid (any resolution)
+           field = 2D array on the same grid
+    Output: lon, lat, field with a cyclic column appended and longitudes made continuous along
+            every row (including rows of the tripole / displaced pole region that do not circle
+            the globe), so cartopy can contour them
     """
     ni = tlon.shape[1]
     xL = int(ni/2 - 1)
@@ -24,13 +28,17 @@ def adjust_pop_grid(tlon, tlat, field):
     tlon = np.where(np.greater_equal(tlon,min(tlon[:,0])),tlon-360.,tlon)
     lon  = np.concatenate((tlon,tlon+360.),1)
     lon = lon[:,xL:xR]
-
-    if ni == 320:
-        lon[367:-3,0] = lon[367:-3,0]+360.
     lon = lon - 360.
-    lon = np.hstack((lon,lon[:,0:1]+360.))
-    if ni == 320:
-        lon[367:,-1] = lon[367:,-1] - 360.
+
+    #-- remove jumps of 360 degrees along each row, keeping the middle of the row in place
+    mid = lon.shape[1] // 2
+    unwrapped = np.rad2deg(np.unwrap(np.deg2rad(lon), axis=1))
+    lon = unwrapped + (lon[:,mid] - unwrapped[:,mid])[:,np.newaxis]
+
+    #-- cyclic column is the first column shifted to be continuous with the last one
+    #   (+360 for rows that circle the globe, unshifted for rows that fold back near the pole)
+    cyclic = lon[:,0:1] + 360. * np.round((lon[:,-1:] - lon[:,0:1]) / 360.)
+    lon = np.hstack((lon,cyclic))
 
     #-- trick cartopy into doing the right thing:
     #   it gets confused when the cyclic coords are identical
@@ -0,0 +1,60 @@
+""" Journal of completed units of work, so an interrupted run can be resumed (driver.py --resume) """
+
+import logging
+import os
+import json
+import threading
+
+######################################################################
+
+class RunJournal(object): # pylint: disable=useless-object-inheritance
+    """
+    Append-only file with one json line per completed unit of work, e.g.
+    {"kind": "figure", "name": "/path/to/plot.png"}. Each line is written with a single write()
+    followed by fsync, so a killed run loses at most the (partial, ignored) last line.
+    Kinds used by the package: 'figure' and 'table' (output file written), and 'element'
+    (every output of an analysis element written). Cached climatologies are not journaled: they
+    are written to a temporary file that is renamed, so any cache file that exists is complete
+    and is reused on the next run.
+    """
+    def __init__(self, journal_file, resume=False):
+        self.logger = logging.getLogger('RunJournal')
+        self.journal_file = journal_file
+        self._done = set()
+        self._lock = threading.Lock()
+        if resume and os.path.exists(journal_file):
+            with open(journal_file) as file_in:
+                for line in file_in:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._done.add((entry['kind'], entry['name']))
+            self.logger.info('Resuming: %d units of work completed in previous runs', len(self._done))
+        diro = os.path.dirname(os.path.abspath(journal_file))
+        if not os.path.exists(diro):
+            os.makedirs(diro)
+        self._file = open(journal_file, 'a' if resume else 'w')
+
+    ###################
+    # PUBLIC ROUTINES #
+    ###################
+
+    def is_done(self, kind, name):
+        """ Was unit of work (kind, name) completed in this or a previous run? """
+        with self._lock:
+            return (kind, name) in self._done
+
+    def mark_done(self, kind, name):
+        """ Record that unit of work (kind, name) is complete """
+        with self._lock:
+            if (kind, name) in self._done:
+                return
+            self._done.add((kind, name))
+            self._file.write(json.dumps({'kind': kind, 'name': name}) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        """ Close journal file """
+        self._file.close()
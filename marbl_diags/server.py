@@ -0,0 +1,206 @@
+"""
+Long-running diagnostics server: jobs (same command line as driver.py) are submitted over a
+Unix socket and run in a process that keeps opened data sources, reduced fields, and grid
+geometry in memory between jobs
+"""
+
+import logging
+import os
+import sys
+import json
+import socketserver
+import threading
+import traceback
+from collections import OrderedDict
+from . import driver_tools
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.marbl_diags.sock')
+
+######################################################################
+
+class ResidentCache(object): # pylint: disable=useless-object-inheritance
+    """
+    In-memory caches that outlive a single job: data sources (after any climatology has been
+    computed) keyed by a description of how they were opened, and reduced 2D fields keyed by
+    data source, variable, levels and time periods. Both are evicted least-recently-used first:
+    data sources when there are more than max_data_sources of them or their estimated size
+    (variables held in memory; lazy dask arrays cost nothing until computed) exceeds
+    max_data_sources_mb, and reduced fields when their total size exceeds max_reduced_fields_mb.
+    The most recently used entry is always kept. Grid geometry (grid_tools) is kept at module
+    level, so it is already resident for as long as the server is running.
+    """
+    def __init__(self, max_data_sources=8, max_reduced_fields_mb=4096, max_data_sources_mb=8192):
+        self.logger = logging.getLogger('ResidentCache')
+        self.max_data_sources = max_data_sources
+        self.max_data_sources_mb = max_data_sources_mb
+        self.max_reduced_fields_mb = max_reduced_fields_mb
+        self._data_sources = OrderedDict()
+        self._data_sources_nbytes = 0
+        self._reduced_fields = OrderedDict()
+        self._reduced_fields_nbytes = 0
+        self._lock = threading.Lock()
+
+    ###################
+    # PUBLIC ROUTINES #
+    ###################
+
+    def get_data_source(self, key):
+        """ Return data source opened with key (None if it is not resident) """
+        with self._lock:
+            if key not in self._data_sources:
+                return None
+            self._data_sources.move_to_end(key)
+            return self._data_sources[key][0]
+
+    def put_data_source(self, key, data_source):
+        """ Keep data_source resident, evicting least recently used data sources if necessary """
+        nbytes = _dataset_nbytes(data_source.ds)
+        with self._lock:
+            data_source._resident_key = key
+            if key in self._data_sources:
+                self._data_sources_nbytes -= self._data_sources[key][1]
+            self._data_sources[key] = (data_source, nbytes)
+            self._data_sources.move_to_end(key)
+            self._data_sources_nbytes += nbytes
+            while len(self._data_sources) > 1 and \
+                  (len(self._data_sources) > self.max_data_sources or
+                   self._data_sources_nbytes > self.max_data_sources_mb * 1024.**2):
+                old_key, (_, old_nbytes) = self._data_sources.popitem(last=False)
+                self._data_sources_nbytes -= old_nbytes
+                self.logger.info('Evicting data source %s (%.1f MB)', old_key, old_nbytes / 1024.**2)
+                self._evict_reduced_fields(old_key)
+
+    def get_reduced_fields(self, key):
+        """ Return reduced fields stored with key (None if they are not resident) """
+        with self._lock:
+            if key not in self._reduced_fields:
+                return None
+            self._reduced_fields.move_to_end(key)
+            return self._reduced_fields[key][0]
+
+    def put_reduced_fields(self, key, fields, nbytes):
+        """ Keep fields (nbytes in size) resident, evicting least recently used fields if necessary """
+        with self._lock:
+            if key in self._reduced_fields:
+                self._reduced_fields_nbytes -= self._reduced_fields[key][1]
+            self._reduced_fields[key] = (fields, nbytes)
+            self._reduced_fields.move_to_end(key)
+            self._reduced_fields_nbytes += nbytes
+            while self._reduced_fields_nbytes > self.max_reduced_fields_mb * 1024.**2 and \
+                  len(self._reduced_fields) > 1:
+                _, (_, old_nbytes) = self._reduced_fields.popitem(last=False)
+                self._reduced_fields_nbytes -= old_nbytes
+
+    def summary(self):
+        """ One-line description of what is resident """
+        with self._lock:
+            return '{} data sources ({:.1f} MB), {} reduced fields ({:.1f} MB)'.format(
+                len(self._data_sources), self._data_sources_nbytes / 1024.**2,
+                len(self._reduced_fields), self._reduced_fields_nbytes / 1024.**2)
+
+    ####################
+    # PRIVATE ROUTINES #
+    ####################
+
+    def _evict_reduced_fields(self, data_source_key):
+        """ Drop reduced fields computed from an evicted data source (lock must be held) """
+        for key in [key for key in self._reduced_fields if key[0] == data_source_key]:
+            self._reduced_fields_nbytes -= self._reduced_fields.pop(key)[1]
+
+def _dataset_nbytes(ds):
+    """ Estimated memory held by ds: size of every variable that is loaded (not backed by dask) """
+    if ds is None:
+        return 0
+    return sum([var.nbytes for var in ds.variables.values() if var.chunks is None])
+
+######################################################################
+
+class _SocketLogHandler(logging.Handler):
+    """ Send log records to the client that submitted the job """
+    def __init__(self, wfile):
+        super(_SocketLogHandler, self).__init__()
+        self._wfile = wfile
+
+    def emit(self, record):
+        try:
+            self._wfile.write((json.dumps({'log': self.format(record)}) + '\n').encode('utf-8'))
+            self._wfile.flush()
+        except (OSError, ValueError):
+            # client went away; keep running the job so its results are still resident / cached
+            pass
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """
+    Run one job: request is a json line {'argv': [...], 'cwd': ...}; every log message is sent back
+    as {'log': ...} and the last line is {'status': 'ok'} or {'status': 'error', 'message': ...}
+    """
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        log_handler = _SocketLogHandler(self.wfile)
+        log_handler.setFormatter(logging.Formatter('%(levelname)s (%(funcName)s): %(message)s'))
+        root_logger = logging.getLogger()
+        root_logger.addHandler(log_handler)
+        cwd = os.getcwd()
+        status = {'status': 'ok'}
+        try:
+            args = driver_tools.get_parser().parse_args(request['argv'])
+            root_logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+            # input files use paths relative to the directory the client was run from
+            os.chdir(request.get('cwd', cwd))
+            driver_tools.run(args, resident_cache=self.server.resident_cache)
+        except SystemExit as err:
+            status = {'status': 'error', 'message': 'invalid arguments (exit code {})'.format(err.code)}
+        except Exception as err: # pylint: disable=broad-except
+            root_logger.error(traceback.format_exc())
+            status = {'status': 'error', 'message': '{}: {}'.format(type(err).__name__, err)}
+        finally:
+            os.chdir(cwd)
+            root_logger.removeHandler(log_handler)
+        logging.getLogger('server').info('Job finished (%s); resident: %s', status['status'],
+                                         self.server.resident_cache.summary())
+        try:
+            self.wfile.write((json.dumps(status) + '\n').encode('utf-8'))
+        except OSError:
+            pass
+
+class DiagnosticsServer(socketserver.UnixStreamServer):
+    """ Jobs are run one at a time (matplotlib is not thread-safe), in the order they arrive """
+    def __init__(self, socket_path=DEFAULT_SOCKET, max_data_sources=8, max_reduced_fields_mb=4096,
+                 max_data_sources_mb=8192):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.resident_cache = ResidentCache(max_data_sources, max_reduced_fields_mb, max_data_sources_mb)
+        super(DiagnosticsServer, self).__init__(socket_path, _JobHandler)
+        # only the user running the server may submit jobs
+        os.chmod(socket_path, 0o600)
+
+    def server_close(self):
+        super(DiagnosticsServer, self).server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+######################################################################
+
+def submit_job(argv, socket_path=DEFAULT_SOCKET, cwd=None, out=sys.stdout):
+    """
+    Run driver.py command line argv (list of strings) on the server listening on socket_path;
+    log messages are written to out as they arrive. Returns True if the job succeeded.
+    """
+    import socket
+    if cwd is None:
+        cwd = os.getcwd()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps({'argv': list(argv), 'cwd': os.path.abspath(cwd)}) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as rfile:
+            for line in rfile:
+                reply = json.loads(line.decode('utf-8'))
+                if 'log' in reply:
+                    out.write(reply['log'] + '\n')
+                    out.flush()
+                    continue
+                if reply['status'] != 'ok':
+                    out.write('ERROR: {}\n'.format(reply['message']))
+                return reply['status'] == 'ok'
+    out.write('ERROR: connection to {} closed before job finished\n'.format(socket_path))
+    return False
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+A script that does some basic unit testing on the reductions used by analysis_ops
+(ensemble statistics, skill metrics, time period weights, and precomputed grid weights)
+"""
+
+import sys
+import numpy as np
+import xarray as xr
+from marbl_diags.ensemble_tools import EnsembleStatistics
+from marbl_diags import analysis_ops
+from marbl_diags import generic_classes
+from marbl_diags import grid_tools as gt
+
+class ClimoDataSource(generic_classes.GenericDataSource):
+    """ Monthly (or annual) climatology held in memory, for functions that take a data source """
+    def __init__(self, ntime):
+        super(ClimoDataSource, self).__init__(child_class='unit_test', source='memory')
+        end_date = np.cumsum(generic_classes.NOLEAP_DAYS_PER_MONTH)[:ntime] if ntime > 1 else np.array([365])
+        start_date = np.append(0, end_date[:-1])
+        self.ds = xr.Dataset({'time_bound': (('time', 'd2'), np.array([start_date, end_date]).transpose())},
+                             coords={'time': end_date})
+        self.ds.time.attrs['bounds'] = 'time_bound'
+
+    def _set_var_dict(self):
+        pass
+
+class AnalysisToolsUnitTests(object): # pylint: disable=useless-object-inheritance
+    """ Unit tests of functions that work on small in-memory fields (or an in-memory data source) """
+    def __init__(self):
+        self._test_names = []
+        self._test_results = []
+        self.fail_cnt = 0
+        self._rng = np.random.RandomState(0)
+
+    def _append_result(self, test_name, test_result):
+        self._test_names.append(test_name)
+        if test_result:
+            result = 'PASS'
+        else:
+            result = 'FAIL'
+            self.fail_cnt += 1
+        self._test_results.append(result)
+
+    def unit_tests(self):
+        """ Run unit tests """
+        self.ensemble_statistics_tests()
+        self.skill_metrics_tests()
+        self.time_period_weights_tests()
+        self.vertical_interp_tests()
+        self.regional_mean_tests()
+        self.zonal_mean_tests()
+        self.coarsen_tests()
+
+    def ensemble_statistics_tests(self):
+        """ EnsembleStatistics (accumulated one member at a time) matches numpy over stacked members """
+        members = self._rng.normal(10., 3., size=(5, 4, 6))
+        members[:, 0, 0] = np.nan  # land in every member
+        members[1:, 1, 1] = np.nan # only one member has data
+        members[2, 2, 2] = np.nan  # missing in one member
+        stats = EnsembleStatistics()
+        for member in members:
+            stats.update(member)
+
+        # Test: ensemble mean, min, and max match np.nanmean, np.nanmin, np.nanmax
+        ocean = np.isfinite(members).any(axis=0)
+        self._append_result('Ensemble mean, min, max match numpy',
+                            np.allclose(stats.mean()[ocean], np.nanmean(members[:, ocean], axis=0)) and
+                            np.allclose(stats.min()[ocean], np.nanmin(members[:, ocean], axis=0)) and
+                            np.allclose(stats.max()[ocean], np.nanmax(members[:, ocean], axis=0)) and
+                            stats.nmembers == 5)
+
+        # Test: ensemble standard deviation matches np.nanstd (ddof=1) where two or more members have data
+        enough = np.isfinite(members).sum(axis=0) > 1
+        self._append_result('Ensemble std. dev. matches numpy',
+                            np.allclose(stats.std()[enough], np.nanstd(members[:, enough], axis=0, ddof=1)))
+
+        # Test: points without enough data are NaN
+        self._append_result('Ensemble statistics are NaN without data',
+                            np.isnan(stats.mean()[0, 0]) and np.isnan(stats.std()[0, 0]) and
+                            np.isnan(stats.std()[1, 1]) and stats.mean()[1, 1] == members[0, 1, 1])
+
+        # Test: statistics of members on fewer points, expanded to all points before the last
+        # member, match statistics of members on all points
+        flat = members.reshape(5, -1)
+        first_points = np.flatnonzero(np.isfinite(flat[:-1]).any(axis=0))
+        expanded = EnsembleStatistics()
+        for member in flat[:-1]:
+            expanded.update(member[first_points])
+        expanded.expand(first_points, flat.shape[1])
+        expanded.update(flat[-1])
+        self._append_result('Expanded ensemble statistics match',
+                            np.allclose(expanded.mean(), stats.mean().reshape(-1), equal_nan=True) and
+                            np.allclose(expanded.std(), stats.std().reshape(-1), equal_nan=True) and
+                            np.allclose(expanded.max(), stats.max().reshape(-1), equal_nan=True))
+
+    def skill_metrics_tests(self):
+        """ Area-weighted skill metrics of three sources against a reference, small enough to check by hand """
+        # the last point is land in the reference (and is ignored); 'masked' is also missing the first point
+        ref_field = xr.DataArray([[1., 2., 3., np.nan]], dims=('period', 'ocean_point'))
+        area = xr.DataArray([1., 1., 2., 5.], dims='ocean_point')
+        fields = xr.DataArray([[[2., 4., 6., 100.]],      # 2 x reference
+                               [[np.nan, 2., 3., 0.]],    # reference, with a masked point
+                               [[3., 2., 1., 7.]]],       # 4 - reference
+                              dims=('source', 'period', 'ocean_point'),
+                              coords={'source': ['double', 'masked', 'reversed']})
+        metrics = analysis_ops._compute_skill_metrics(fields, ref_field, area) # pylint: disable=protected-access
+
+        # reference mean is (1 + 2 + 2*3) / 4 = 2.25
+        # double: mean (2 + 4 + 2*6) / 4 = 4.5, squared errors (1 + 4 + 2*9) / 4 = 5.75
+        # masked: only the last two points count, so it matches the reference exactly
+        # reversed: mean (3 + 2 + 2*1) / 4 = 1.75
+        expected = {'bias': [2.25, 0., -0.5],
+                    'rmse': [np.sqrt(5.75), 0., np.sqrt((4. + 0. + 2*4.) / 4.)],
+                    'pattern_corr': [1., 1., -1.],
+                    'std_ratio': [2., 1., 1.]}
+        for metric_name in analysis_ops.SKILL_METRICS:
+            self._append_result('Skill metric {} matches hand calculation'.format(metric_name),
+                                np.allclose(metrics[metric_name].values[:, 0], expected[metric_name]))
+
+    def time_period_weights_tests(self):
+        """ Weights of each month in seasonal and annual means are proportional to the length of the month """
+        time_periods = ['DJF', 'ANN']
+        weights = analysis_ops._get_time_period_weights(ClimoDataSource(12), time_periods) # pylint: disable=protected-access
+        days = np.array(generic_classes.NOLEAP_DAYS_PER_MONTH, dtype=np.float64)
+
+        # Test: DJF weights are Dec, Jan, Feb lengths / 90 days; ANN weights are month lengths / 365 days
+        expected_djf = np.zeros(12)
+        expected_djf[[11, 0, 1]] = days[[11, 0, 1]] / 90.
+        self._append_result('Time period weights match noleap month lengths',
+                            weights.dims == ('period', 'time') and weights.shape == (2, 12) and
+                            np.allclose(weights.sel(period='DJF'), expected_djf) and
+                            np.allclose(weights.sel(period='ANN'), days / 365.) and
+                            np.allclose(weights.sum('time'), 1.))
+
+        # Test: contracting the climatology of month number (1 - 12) gives its weighted mean
+        # DJF: (31*12 + 31*1 + 28*2) / 90 = 459 / 90; ANN: sum(days * month) / 365 = 2382 / 365
+        field = xr.DataArray(np.arange(1., 13.), dims='time')
+        means = xr.dot(weights, field, dims='time')
+        self._append_result('Time period means are weighted by month length',
+                            np.allclose(means.values, [459. / 90., 2382. / 365.]))
+
+        # Test: an annual climatology only has the annual mean
+        try:
+            analysis_ops._get_time_period_weights(ClimoDataSource(1), ['ANN', 'JJA']) # pylint: disable=protected-access
+            raised = False
+        except KeyError:
+            raised = True
+        annual = analysis_ops._get_time_period_weights(ClimoDataSource(1), ['ANN']) # pylint: disable=protected-access
+        self._append_result('Annual climatology only has ANN weights',
+                            raised and annual.shape == (1, 1) and annual.values[0, 0] == 1.)
+
+    def vertical_interp_tests(self):
+        """ Interpolation to requested depths (vertical_interp_weights, then _blend_levels) """
+        depths = np.array([5., 15., 25., 40.])
+        # field is linear in depth, so interpolated values are exact between levels
+        field = np.empty((1, depths.size, 2, 3))
+        field[...] = (2. * depths + 1.)[np.newaxis, :, np.newaxis, np.newaxis]
+        # land: below the sea floor at depth index 2 in one column, and at every depth in another
+        field[0, 2:, 0, 1] = np.nan
+        field[0, :, 0, 2] = np.nan
+        levels = [15., 20., 30., 0., 100.]
+        weights = gt.vertical_interp_weights('test_grid', depths, levels)
+
+        def interp(level):
+            k0, k1, weight = weights[level]
+            return analysis_ops._blend_levels(field[:, [k0, k1]], weight)[0] # pylint: disable=protected-access
+
+        # Test: a requested depth that is a level returns that level
+        self._append_result('Vertical interpolation at a level',
+                            np.allclose(interp(15.), field[0, 1], equal_nan=True))
+
+        # Test: depths between levels are linear in depth (20 m is halfway between 15 m and 25 m)
+        self._append_result('Vertical interpolation between levels',
+                            weights[20.] == (1, 2, 0.5) and np.isclose(weights[30.][2], 1./3.) and
+                            np.allclose(interp(20.)[1, :], 41.) and np.allclose(interp(30.)[1, :], 61.))
+
+        # Test: depths above the first level use the first level, depths below the last use the last
+        self._append_result('Vertical interpolation above top level',
+                            weights[0.] == (0, 1, 0.) and np.allclose(interp(0.)[1, :], 11.))
+        self._append_result('Vertical interpolation below bottom level',
+                            weights[100.] == (2, 3, 1.) and np.allclose(interp(100.)[1, :], 81.))
+
+        # Test: where the lower level is land, the upper (ocean) level is used; land stays NaN
+        self._append_result('Vertical interpolation at land points',
+                            interp(20.)[0, 1] == field[0, 1, 0, 1] and np.isnan(interp(20.)[0, 2]) and
+                            np.isnan(interp(30.)[0, 1]) and interp(20.)[0, 0] == 41.)
+
+    def regional_mean_tests(self):
+        """ Regional means from region_weight_matrix (one sparse product) match masked np.average """
+        region_mask = self._rng.choice([0, 1, 2, 3, 6, 7, -12], size=(12, 16))
+        area = self._rng.uniform(1., 3., size=region_mask.shape)
+        field = self._rng.normal(size=(3,) + region_mask.shape)
+        field[:, region_mask == 0] = np.nan
+        field[:, 4, 5:9] = np.nan # missing data at ocean points
+        region_names = ['Global', 'Pacific Ocean', 'Atlantic Ocean', 'Baltic Sea', 'Red Sea']
+        regional_means = analysis_ops._compute_regional_means(xr.DataArray(field, dims=('time', 'nlat', 'nlon')), # pylint: disable=protected-access
+                                                              xr.DataArray(region_mask), xr.DataArray(area),
+                                                              'test_grid', region_names, time_chunk_size=2)
+
+        # Test: every region (and time level) matches np.average over the valid cells of the region
+        region_defs = dict(gt.POP_REGIONS)
+        same = True
+        for n, region_name in enumerate(region_names[:-1]):
+            if region_defs[region_name] is None:
+                in_region = region_mask != 0
+            else:
+                in_region = np.isin(region_mask, region_defs[region_name])
+            in_region = np.logical_and(in_region, np.isfinite(field[0]))
+            expected = [np.average(field[t][in_region], weights=area[in_region]) for t in range(field.shape[0])]
+            same = same and np.allclose(regional_means[n, :], expected)
+        self._append_result('Regional means match masked np.average', same)
+
+        # Test: regions without any cells (no Red Sea in region_mask) are NaN
+        self._append_result('Regional means are NaN in empty regions', np.isnan(regional_means[-1, :]).all())
+
+    def zonal_mean_tests(self):
+        """ Zonal means from zonal_mean_groups (grouped sums with np.bincount) match a loop over latitude bins """
+        tlat = np.repeat(np.linspace(-79., 79., 10)[:, np.newaxis], 12, axis=1)
+        region_mask = self._rng.choice([0, 2, 3, 6, 8], size=tlat.shape)
+        area = self._rng.uniform(1., 3., size=tlat.shape)
+        field = self._rng.normal(size=(2, 3) + tlat.shape)
+        field[:, :, region_mask == 0] = np.nan
+        field[:, 2, 3:6, :] = np.nan # below the sea floor
+        basin_names = ['Global', 'Atlantic', 'Pacific']
+        lat_bin_width = 20.
+        cells, groups, ngroups = gt.zonal_mean_groups('test_grid', tlat, region_mask, lat_bin_width, basin_names)
+        # (max_block_mb is small enough that every depth level is its own block)
+        zonal_means = analysis_ops._compute_zonal_means(xr.DataArray(field, dims=('time', 'z_t', 'nlat', 'nlon')), # pylint: disable=protected-access
+                                                        area, cells, groups, ngroups, max_block_mb=1e-6)
+        lat_bin_edges = gt.get_lat_bin_edges(lat_bin_width)
+        nbins = lat_bin_edges.size - 1
+        zonal_means = zonal_means.reshape(field.shape[:2] + (len(basin_names), nbins))
+
+        # Test: every (time, depth, basin, latitude bin) matches np.average over the cells in the bin
+        basin_defs = dict(gt.POP_BASINS)
+        same = zonal_means.shape == (2, 3, 3, nbins)
+        for b, basin_name in enumerate(basin_names):
+            if basin_defs[basin_name] is None:
+                in_basin = region_mask != 0
+            else:
+                in_basin = np.isin(region_mask, basin_defs[basin_name])
+            for j in range(nbins):
+                in_bin = in_basin & (tlat >= lat_bin_edges[j]) & (tlat < lat_bin_edges[j+1])
+                for n in range(field.shape[0]):
+                    for k in range(field.shape[1]):
+                        in_bin_k = in_bin & np.isfinite(field[n, k])
+                        if in_bin_k.any():
+                            expected = np.average(field[n, k][in_bin_k], weights=area[in_bin_k])
+                            same = same and np.isclose(zonal_means[n, k, b, j], expected)
+                        else:
+                            same = same and np.isnan(zonal_means[n, k, b, j])
+        self._append_result('Zonal means match loop over latitude bins', same)
+
+        # Test: a different REGION_MASK on the same grid is not taken from the cache
+        other_cells, _, _ = gt.zonal_mean_groups('test_grid', tlat, np.where(region_mask == 2, 0, region_mask),
+                                                 lat_bin_width, basin_names)
+        self._append_result('Zonal mean groups depend on REGION_MASK', other_cells.size < cells.size)
+
+    def coarsen_tests(self):
+        """ Area-weighted coarsening (preview mode) keeps the area integral of the field """
+        # shape is not a multiple of factor, so the last blocks are partial
+        tlon, tlat = np.meshgrid(np.linspace(1., 359., 18), np.linspace(-70., 70., 13))
+        area = self._rng.uniform(1., 3., size=tlat.shape)
+        field = self._rng.normal(size=tlat.shape)
+        factor = 4
+        _, _, block_area = gt.coarsen_grid('test_grid', tlon, tlat, area, factor)
+        coarse_field = gt.coarsen_field(field, area, factor)
+
+        # Test: field * area summed over blocks matches the sum over cells
+        self._append_result('Coarsened field keeps global integral',
+                            coarse_field.shape == (4, 5) and
+                            np.isclose((coarse_field * block_area).sum(), (field * area).sum()))
+
+        # Test: with land, the integral over the ocean area of each block is kept; all-land blocks are NaN
+        field[:4, :4] = np.nan
+        field[5:9, 2:7] = np.nan
+        coarse_field = gt.coarsen_field(field, area, factor)
+        ocean_area = gt._block_sum(np.where(np.isfinite(field), area, 0.), factor) # pylint: disable=protected-access
+        self._append_result('Coarsened field keeps ocean integral',
+                            np.isnan(coarse_field[0, 0]) and np.isfinite(coarse_field[1, 1]) and
+                            np.isclose(np.nansum(coarse_field * ocean_area), np.nansum(field * area)))
+
+    def print_test_results(self):
+        """ print unit test results to screen """
+        for n, (name, result) in enumerate(zip(self._test_names, self._test_results)):
+            print('Test {} ({}): {}'.format(n+1, name, result))
+        print('{} test failure(s)'.format(self.fail_cnt))
+
+unit_tests = AnalysisToolsUnitTests()
+unit_tests.unit_tests()
+unit_tests.print_test_results()
+
+sys.exit(min(unit_tests.fail_cnt, 1))
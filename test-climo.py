@@ -57,14 +57,34 @@ class UnitTestDataSource(generic_classes.GenericDataSource):
         self._test_names.append('Initial time dimension is 24')
         self._append_result(self.ds.dims['time'] == 24)
 
+        # Test 2: time axis is recognized as 2 complete years of monthly means
+        self._test_names.append('Time axis is 2 complete years of monthly means')
+        self._append_result(self._get_regular_monthly_nyears() == 2)
+
+        # Test 3: fast path and esmlab produce identical climatologies
+        self._test_names.append('Fast path climatology matches esmlab climatology')
+        ds_fast = self._compute_regular_mon_climatology()
+        ds_generic = self._compute_generic_mon_climatology()
+        self._append_result(ds_fast.dims['time'] == ds_generic.dims['time'] and
+                            np.allclose(ds_fast.var_to_average.values, ds_generic.var_to_average.values,
+                                        rtol=0, atol=1e-12) and
+                            np.allclose(ds_fast.time_bound.values, ds_generic.time_bound.values))
+
+        # Test 4: fast path is not used if a month is missing
+        self._test_names.append('Fast path not used for incomplete years')
+        ds_full = self.ds
+        self.ds = ds_full.isel(time=slice(0, 23))
+        self._append_result(self._compute_regular_mon_climatology() is None)
+        self.ds = ds_full
+
         # Run compute_mon_climatology
         self.compute_mon_climatology()
 
-        # Test 2: time dimension is now len 12
+        # Test 5: time dimension is now len 12
         self._test_names.append('After computing climatology, time dimension is 12')
         self._append_result(self.ds.dims['time'] == 12)
 
-        # Test 3: All 'var_to_average' values are 1/2
+        # Test 6: All 'var_to_average' values are 1/2
         self._test_names.append('All climatological averages are 0.5')
         self._append_result(all(abs(self.ds.var_to_average.values - 0.5) < 1e-10))
 